@@ -0,0 +1,9 @@
+from __future__ import annotations
+import multiprocessing
+import sys
+from .cli import main
+
+# Worker processes (sharded backups) import this module again; only the parent runs the CLI.
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,454 @@
+from __future__ import annotations
+import bisect
+import fnmatch
+import json
+import os
+import struct
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import lz4.block
+import lz4.frame
+import pyzstd
+from .utils import read_exact
+from .metrics import Metrics
+from .throttle import PriorityPools
+
+# Payload format inside the encrypted container (the plaintext the crypto layer sees):
+# magic(4)=SBA1 | codec(1) | level(1, signed) | block_size(4)
+# then blocks: method(1) | stored_len(4) | raw_len(4) | stored bytes
+# terminated by an END block (method 0, both lengths 0).
+# Every block is compressed on its own, so blocks are compressed and decompressed in parallel.
+# After the END block comes the index, framed like a block and holding compressed JSON:
+#   {"version": 1, "blocks": [[payload_offset, raw_offset, raw_len], ...],
+#    "files": [{"name", "type", "size", "mtime", "mode", "offset", "data", "sha256", "compressed"}, ...]}
+# where offset/data are the member's tar header/data positions in the uncompressed tar stream,
+# and finally a trailer: magic(4)=SBAI | index payload offset(8).
+# Streaming readers stop at the END block; random-access readers start from the trailer.
+# Older backups carry a bare LZ4 frame instead; open_payload tells them apart by the magic.
+
+PAYLOAD_MAGIC = b"SBA1"
+PAYLOAD_HEADER = struct.Struct(">4sBbI")
+BLOCK_HEADER = struct.Struct(">BII")
+BLOCK_SIZE = 4 * 1024 * 1024
+
+INDEX_TRAILER = struct.Struct(">4sQ")
+INDEX_MAGIC = b"SBAI"
+INDEX_VERSION = 1
+
+METHOD_END = 0
+METHOD_LZ4 = 1
+METHOD_ZSTD = 2
+METHOD_STORE = 3
+# zstd with a trained dictionary (repository chunks only): dictionary id(4) | zstd frame
+METHOD_ZSTD_DICT = 4
+DICT_ID = struct.Struct(">I")
+
+# codec name -> (header id, block method, default level)
+CODECS = {
+    "lz4-fast": (1, METHOD_LZ4, 1),
+    "lz4-hc": (2, METHOD_LZ4, 9),
+    "zstd": (3, METHOD_ZSTD, 3),
+}
+DEFAULT_CODEC = "lz4-fast"
+CODEC_NAMES = {codec_id: name for name, (codec_id, _, _) in CODECS.items()}
+# codec name -> (lowest, highest) level. lz4-fast levels are acceleration factors; zstd's negative
+# levels are its fast modes, down to what the payload header's signed level byte holds.
+LEVELS = {
+    "lz4-fast": (1, 127),
+    "lz4-hc": (1, 12),
+    "zstd": (max(pyzstd.compressionLevel_values.min, -128), pyzstd.compressionLevel_values.max),
+}
+
+# Files at least this big are sampled before archiving; smaller ones are never worth a block switch.
+SAMPLE_MIN_FILE_SIZE = 256 * 1024
+SAMPLE_SIZE = 64 * 1024
+# A sample that lz4 cannot shrink below this ratio is treated as incompressible.
+INCOMPRESSIBLE_RATIO = 0.95
+# Formats that are already compressed; these skip sampling entirely.
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+    ".mp4", ".m4v", ".mkv", ".mov", ".avi", ".webm", ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".7z", ".rar",
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".jar", ".apk", ".whl", ".sbk",
+}
+
+# Tar member written first in backups of incremental jobs:
+# {"kind": "full"|"incremental", "job": name, "parent": parent archive filename, "deleted": [arcnames]}
+META_NAME = ".securebackup/increment.json"
+
+_pools = PriorityPools(os.cpu_count() or 1, "sbk-compress")
+
+
+def _pool() -> ThreadPoolExecutor:
+    # lz4 and pyzstd release the GIL while (de)compressing, so blocks scale across cores.
+    return _pools.get()
+
+
+def _max_inflight() -> int:
+    return 2 * (os.cpu_count() or 1)
+
+
+def resolve_codec(codec: Optional[str], level: Optional[int]) -> Tuple[str, int]:
+    """Validates a job's codec/level settings and fills in defaults."""
+    codec = codec or DEFAULT_CODEC
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec '{codec}'. Choose one of: {', '.join(CODECS)}")
+    if level is None or level == "":
+        return codec, CODECS[codec][2]
+    try:
+        level = int(level)
+    except (TypeError, ValueError):
+        raise ValueError(f"Compression level must be a whole number, not '{level}'.") from None
+    low, high = LEVELS[codec]
+    if not low <= level <= high:
+        raise ValueError(f"Compression level {level} is out of range for {codec} ({low} to {high}).")
+    return codec, level
+
+
+def compress_block(codec: Optional[str], level: int, data: bytes,
+                   zstd_dict: Optional[pyzstd.ZstdDict] = None) -> Tuple[int, bytes]:
+    """
+    Compresses one block; codec None stores it as is. Blocks that don't shrink are stored too.
+    zstd_dict, a trained dictionary, is used with the zstd codec.
+    """
+    if codec is None:
+        return METHOD_STORE, data
+    if codec == "lz4-fast":
+        # For lz4-fast the level is the acceleration factor: higher is faster.
+        method, out = METHOD_LZ4, lz4.block.compress(data, mode="fast", acceleration=max(level, 1), store_size=False)
+    elif codec == "lz4-hc":
+        method, out = METHOD_LZ4, lz4.block.compress(data, mode="high_compression", compression=level, store_size=False)
+    elif zstd_dict is not None:
+        method, out = METHOD_ZSTD_DICT, DICT_ID.pack(zstd_dict.dict_id) + pyzstd.compress(data, level, zstd_dict.as_digested_dict)
+    else:
+        method, out = METHOD_ZSTD, pyzstd.compress(data, level)
+    if len(out) >= len(data):
+        return METHOD_STORE, data
+    return method, out
+
+
+def decompress_block(method: int, data: bytes, raw_len: int,
+                     dictionaries: Optional[Callable[[int], pyzstd.ZstdDict]] = None) -> bytes:
+    """dictionaries looks up a trained dictionary by id, for blocks compressed with one."""
+    if method == METHOD_STORE:
+        out = data
+    elif method == METHOD_LZ4:
+        out = lz4.block.decompress(data, uncompressed_size=raw_len)
+    elif method == METHOD_ZSTD:
+        out = pyzstd.decompress(data)
+    elif method == METHOD_ZSTD_DICT and dictionaries is not None:
+        out = pyzstd.decompress(data[DICT_ID.size:], dictionaries(DICT_ID.unpack_from(data)[0]).as_digested_dict)
+    else:
+        raise ValueError(f"Unknown block method {method}, archive corrupted?")
+    if len(out) != raw_len:
+        raise ValueError("Block size mismatch, archive corrupted?")
+    return out
+
+
+def match_patterns(name: str, patterns: Optional[List[str]]) -> bool:
+    """True if name is selected by any of the patterns (exact path, folder prefix or glob); no patterns selects all."""
+    if not patterns:
+        return True
+    for pattern in patterns:
+        pattern = pattern.strip().rstrip("/")
+        if name == pattern or name.startswith(pattern + "/") or fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+def entry_type(tarinfo) -> str:
+    """Entry type name used in the index for a tarfile.TarInfo."""
+    if tarinfo.isreg():
+        return "file"
+    if tarinfo.isdir():
+        return "dir"
+    if tarinfo.issym():
+        return "symlink"
+    if tarinfo.islnk():
+        return "hardlink"
+    return "other"
+
+
+def is_compressible(path, size: int, sample: Optional[bytes] = None) -> bool:
+    """
+    Quick guess whether a file is worth compressing: known compressed formats are not, and
+    for other large files the first SAMPLE_SIZE bytes are trial-compressed with fast lz4.
+    sample may hold the start of the file if the caller has already read it.
+    """
+    if os.path.splitext(str(path))[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return False
+    if size < SAMPLE_MIN_FILE_SIZE:
+        return True
+    if sample is not None:
+        sample = sample[:SAMPLE_SIZE]
+    else:
+        try:
+            with open(path, "rb") as f:
+                sample = f.read(SAMPLE_SIZE)
+        except OSError:
+            return True
+    return len(lz4.block.compress(sample, mode="fast", store_size=False)) < len(sample) * INCOMPRESSIBLE_RATIO
+
+
+class BlockWriter:
+    """
+    Write-only file object producing an SBA1 payload.
+    Incoming bytes are cut into BLOCK_SIZE blocks, compressed on a thread pool and written in order.
+    set_compression(False) switches to stored blocks for incompressible data (starting a new block).
+    """
+
+    def __init__(self, fileobj, codec: Optional[str] = None, level: Optional[int] = None, block_size: int = BLOCK_SIZE,
+                 metrics: Optional[Metrics] = None, resume: Optional[Dict[str, Any]] = None):
+        self.codec, self.level = resolve_codec(codec, level)
+        self._metrics = metrics or Metrics()
+        self._fout = fileobj
+        self._block_size = block_size
+        self._buf = bytearray()
+        self._futures: deque = deque()
+        self.closed = False
+        self.index_block: Optional[bytes] = None
+        if resume is not None:
+            # Carry on after a checkpoint (see state()); the header is already written.
+            self.blocks = resume["blocks"]
+            self._payload_offset = resume["payload_offset"]
+            self._raw_offset = resume["raw_offset"]
+            self._compress = resume["compress"]
+            return
+        self.blocks: List[List[int]] = []
+        self._payload_offset = PAYLOAD_HEADER.size
+        self._raw_offset = 0
+        self._compress = True
+        fileobj.write(PAYLOAD_HEADER.pack(PAYLOAD_MAGIC, CODECS[self.codec][0], self.level, block_size))
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        # Position in the uncompressed stream; tarfile uses it for its member offsets.
+        return self._raw_offset + sum(raw_len for raw_len, _ in self._futures) + len(self._buf)
+
+    def _submit(self, data: bytes) -> None:
+        codec = self.codec if self._compress else None
+        self._futures.append((len(data), _pool().submit(self._metrics.timed, "compress", compress_block, codec, self.level, data)))
+        while len(self._futures) > _max_inflight():
+            self._write_next()
+
+    def _write_block(self, method: int, stored: bytes, raw_len: int) -> None:
+        self._fout.write(BLOCK_HEADER.pack(method, len(stored), raw_len))
+        self._fout.write(stored)
+        self._payload_offset += BLOCK_HEADER.size + len(stored)
+
+    def _write_next(self) -> None:
+        raw_len, future = self._futures.popleft()
+        start = time.perf_counter()
+        method, stored = future.result()
+        self._metrics.add("compress", bytes_in=raw_len, bytes_out=len(stored), stall=time.perf_counter() - start)
+        self.blocks.append([self._payload_offset, self._raw_offset, raw_len])
+        self._raw_offset += raw_len
+        self._write_block(method, stored, raw_len)
+
+    def write(self, data) -> int:
+        self._buf += data
+        while len(self._buf) >= self._block_size:
+            self._submit(bytes(self._buf[:self._block_size]))
+            del self._buf[:self._block_size]
+        return len(data)
+
+    def set_compression(self, enabled: bool) -> None:
+        if enabled == self._compress:
+            return
+        # Cut the block here so compressed and stored data never share a block.
+        if self._buf:
+            self._submit(bytes(self._buf))
+            self._buf = bytearray()
+        self._compress = enabled
+
+    def flush(self) -> None:
+        self._fout.flush()
+
+    def state(self) -> Dict[str, Any]:
+        """
+        Ends the current block and writes every block so far, then returns what resume= needs
+        to carry on from here (the blocks themselves are left to the caller to keep).
+        """
+        if self._buf:
+            self._submit(bytes(self._buf))
+            self._buf = bytearray()
+        while self._futures:
+            self._write_next()
+        return {"payload_offset": self._payload_offset, "raw_offset": self._raw_offset, "compress": self._compress}
+
+    def close(self, files: Optional[List[Dict[str, Any]]] = None) -> None:
+        """Writes the remaining blocks, the END marker and the index of blocks and files."""
+        if self.closed:
+            return
+        self.closed = True
+        if self._buf:
+            self._submit(bytes(self._buf))
+            self._buf = bytearray()
+        while self._futures:
+            self._write_next()
+        self._write_block(METHOD_END, b"", 0)
+        index = json.dumps({"version": INDEX_VERSION, "blocks": self.blocks, "files": files or []},
+                           separators=(",", ":")).encode("utf-8")
+        index_offset = self._payload_offset
+        method, stored = compress_block(self.codec, self.level, index)
+        self._write_block(method, stored, len(index))
+        self.index_block = BLOCK_HEADER.pack(method, len(stored), len(index)) + stored
+        self._fout.write(INDEX_TRAILER.pack(INDEX_MAGIC, index_offset))
+        self._fout.flush()
+
+
+class BlockReader:
+    """Read-only file object over an SBA1 payload; blocks are read ahead and decompressed in parallel."""
+
+    def __init__(self, fileobj, magic: bytes = b"", metrics: Optional[Metrics] = None):
+        self._metrics = metrics or Metrics()
+        header = magic + read_exact(fileobj, PAYLOAD_HEADER.size - len(magic))
+        if len(header) != PAYLOAD_HEADER.size or header[:4] != PAYLOAD_MAGIC:
+            raise ValueError("Archive payload header corrupted")
+        _, codec_id, self.level, self.block_size = PAYLOAD_HEADER.unpack(header)
+        self.codec = CODEC_NAMES.get(codec_id, "unknown")
+        self._fin = fileobj
+        self._futures: deque = deque()
+        self._done = False
+        self._pending = b""
+        self._pos = 0
+        self.closed = False
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self) -> None:
+        while not self._done and len(self._futures) < _max_inflight():
+            header = read_exact(self._fin, BLOCK_HEADER.size)
+            if len(header) != BLOCK_HEADER.size:
+                raise ValueError("Archive truncated: missing end-of-archive marker")
+            method, stored_len, raw_len = BLOCK_HEADER.unpack(header)
+            if method == METHOD_END:
+                self._done = True
+                break
+            stored = read_exact(self._fin, stored_len)
+            if len(stored) != stored_len:
+                raise ValueError("Archive truncated inside a block")
+            self._futures.append((stored_len, _pool().submit(self._metrics.timed, "decompress", decompress_block, method, stored, raw_len)))
+
+    def read(self, size: int = -1) -> bytes:
+        # Small reads advance an offset into the current block instead of re-slicing what is left of it.
+        available = len(self._pending) - self._pos
+        while size < 0 or available < size:
+            self._fill()
+            if not self._futures:
+                break
+            stored_len, future = self._futures.popleft()
+            start = time.perf_counter()
+            raw = future.result()
+            self._metrics.add("decompress", bytes_in=stored_len, bytes_out=len(raw), stall=time.perf_counter() - start)
+            self._pending = self._pending[self._pos:] + raw if available else raw
+            self._pos = 0
+            available = len(self._pending)
+            if size >= 0 and available:
+                break
+        if size < 0 or size >= available:
+            data = self._pending[self._pos:] if self._pos else self._pending
+            self._pending, self._pos = b"", 0
+        else:
+            data = self._pending[self._pos:self._pos + size]
+            self._pos += size
+        return data
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class _Prefixed:
+    """Re-attaches bytes that were already consumed while sniffing a magic number."""
+
+    def __init__(self, prefix: bytes, fileobj):
+        self._prefix = prefix
+        self._fin = fileobj
+
+    def read(self, size: int = -1) -> bytes:
+        if self._prefix:
+            if size < 0:
+                data, self._prefix = self._prefix + self._fin.read(), b""
+            else:
+                data, self._prefix = self._prefix[:size], self._prefix[size:]
+            return data
+        return self._fin.read(size)
+
+
+def open_payload(fileobj, metrics: Optional[Metrics] = None):
+    """Returns a decompressing reader for the decrypted payload, whichever codec wrote it."""
+    magic = read_exact(fileobj, 4)
+    if magic == PAYLOAD_MAGIC:
+        return BlockReader(fileobj, magic=magic, metrics=metrics)
+    # Backups written before block compression are a single LZ4 frame.
+    return lz4.frame.LZ4FrameFile(_Prefixed(magic, fileobj), mode="rb")
+
+
+def read_index(container) -> Optional[Dict[str, Any]]:
+    """
+    Reads the archive index through a random-access container (anything with .size and .pread).
+    Returns None for archives written without one. Only the end of the payload is read, so the
+    index of a split backup whose first volume is damaged can still be read.
+    """
+    end = container.size - INDEX_TRAILER.size
+    if end < PAYLOAD_HEADER.size:
+        return None
+    magic, offset = INDEX_TRAILER.unpack(container.pread(end, INDEX_TRAILER.size))
+    if magic != INDEX_MAGIC or not PAYLOAD_HEADER.size <= offset <= end - BLOCK_HEADER.size:
+        return None
+    return parse_index(container.pread(offset, end - offset))
+
+
+def parse_index(block: bytes) -> Optional[Dict[str, Any]]:
+    """Decodes an index block as BlockWriter.close() writes it (and keeps in index_block)."""
+    method, stored_len, raw_len = BLOCK_HEADER.unpack_from(block)
+    index = json.loads(decompress_block(method, block[BLOCK_HEADER.size:BLOCK_HEADER.size + stored_len], raw_len))
+    if index.get("version") != INDEX_VERSION:
+        return None
+    return index
+
+
+class RawStream:
+    """
+    Seekable read-only view of the uncompressed tar stream, decompressing only the blocks
+    that are actually read. Built from an archive index and a random-access container.
+    """
+
+    def __init__(self, container, blocks: List[List[int]]):
+        self._container = container
+        self._blocks = blocks
+        self._starts = [b[1] for b in blocks]
+        self._pos = 0
+        self._cached: Tuple[int, bytes] = (-1, b"")
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self._pos = offset if whence == os.SEEK_SET else self._pos + offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def _block(self, i: int) -> bytes:
+        if self._cached[0] != i:
+            payload_offset, _, raw_len = self._blocks[i]
+            method, stored_len, _ = BLOCK_HEADER.unpack(self._container.pread(payload_offset, BLOCK_HEADER.size))
+            stored = self._container.pread(payload_offset + BLOCK_HEADER.size, stored_len)
+            self._cached = (i, decompress_block(method, stored, raw_len))
+        return self._cached[1]
+
+    def read(self, size: int = -1) -> bytes:
+        i = bisect.bisect_right(self._starts, self._pos) - 1
+        if i < 0 or i >= len(self._blocks):
+            return b""
+        _, raw_offset, raw_len = self._blocks[i]
+        if self._pos >= raw_offset + raw_len:
+            return b""
+        start = self._pos - raw_offset
+        data = self._block(i)[start:] if size < 0 else self._block(i)[start:start + size]
+        self._pos += len(data)
+        return data
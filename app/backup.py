@@ -1,57 +1,840 @@
 from __future__ import annotations
 from pathlib import Path
+from datetime import datetime
+import base64
+import bisect
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import stat
 import tarfile
-import lz4.frame as lz4
+import threading
+import time
 import logging
-from typing import List
-from .utils import TEMP_DIR
-from .crypto import encrypt_file
-import io
+from concurrent.futures import Future, as_completed
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from .utils import CHUNK_SIZE
+from .crypto import SegmentedWriter, kdf_params
+from .archive import BlockWriter, DEFAULT_CODEC, META_NAME, entry_type, is_compressible, resolve_codec
+from .manifest import load_manifest, save_manifest, empty_manifest, file_digest, signature
+from .scanner import ScanEntry, ScanStats, scan, scan_tree, prefetch, total_size
+from .metrics import Metrics, Progress, format_stages
+from .catalog import record_backup, job_from_filename
+from .checkpoint import Journal, checkpoint_path, partial_name
+from .pipeline import FanOut, WriteBehind
+from .watcher import Changes
+from .volumes import VolumeWriter, volume_paths
+from .shards import partition, process_pool, shard_name, shard_paths, write_shard_map
+from .throttle import Throttle, enter_background, in_background
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def _create_archive(sources: List[str]) -> bytes:
+try:
+    import grp
+    import pwd
+except ImportError:  # Windows
+    grp = pwd = None
+
+# A backup is committed at the first member boundary after CHECKPOINT_BYTES of encrypted output
+# or CHECKPOINT_INTERVAL seconds, so an interrupted run resumes from there (see checkpoint.py).
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+CHECKPOINT_INTERVAL = 30.0
+RESUME_VERSION = 1
+# With several destinations, one whose writes make no progress for this long is dropped from the run.
+STALL_TIMEOUT = 300.0
+
+_owner_names: Dict[Tuple[str, int], str] = {}
+
+def _owner_name(kind: str, ident: int) -> str:
+    # tarfile.gettarinfo looks these up for every member; cache them instead.
+    key = (kind, ident)
+    if key not in _owner_names:
+        try:
+            _owner_names[key] = pwd.getpwuid(ident).pw_name if kind == "u" else grp.getgrgid(ident).gr_name
+        except (KeyError, AttributeError):
+            _owner_names[key] = ""
+    return _owner_names[key]
+
+def _tarinfo_from_stat(tar: tarfile.TarFile, entry: ScanEntry) -> Optional[tarfile.TarInfo]:
+    """Same as tar.gettarinfo, but reuses the scanner's lstat result instead of calling lstat again."""
+    st = entry.stat
+    mode = st.st_mode
+    tarinfo = tar.tarinfo(entry.arcname)
+    tarinfo.tarfile = tar
+    linkname = ""
+    if stat.S_ISREG(mode):
+        inode = (st.st_ino, st.st_dev)
+        if st.st_nlink > 1 and inode in tar.inodes and entry.arcname != tar.inodes[inode]:
+            # A hard link to a file already in the archive.
+            ftype = tarfile.LNKTYPE
+            linkname = tar.inodes[inode]
+        else:
+            ftype = tarfile.REGTYPE
+            # Only files with other links are ever looked up, which keeps checkpoints small.
+            if inode[0] and st.st_nlink > 1:
+                tar.inodes[inode] = entry.arcname
+    elif stat.S_ISDIR(mode):
+        ftype = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(mode):
+        ftype = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(mode):
+        ftype = tarfile.SYMTYPE
+        linkname = os.readlink(entry.path)
+    elif stat.S_ISCHR(mode):
+        ftype = tarfile.CHRTYPE
+    elif stat.S_ISBLK(mode):
+        ftype = tarfile.BLKTYPE
+    else:
+        return None
+    tarinfo.mode = mode
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.size = st.st_size if ftype == tarfile.REGTYPE else 0
+    tarinfo.mtime = st.st_mtime
+    tarinfo.type = ftype
+    tarinfo.linkname = linkname
+    if pwd is not None:
+        tarinfo.uname = _owner_name("u", st.st_uid)
+        tarinfo.gname = _owner_name("g", st.st_gid)
+    if ftype in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        tarinfo.devmajor = os.major(st.st_rdev)
+        tarinfo.devminor = os.minor(st.st_rdev)
+    return tarinfo
+
+class _HashingReader:
+    """
+    Hashes what tarfile reads, and holds the stream to exactly size bytes: a file that
+    shrank since it was scanned, or that fails to read partway (error is then set), is padded
+    with zeros, so the tar stream stays well-formed.
+    """
+
+    def __init__(self, fileobj, size: int, name: str, metrics: Metrics):
+        self._f = fileobj
+        self._remaining = size
+        self._name = name
+        self._metrics = metrics
+        self.hash = hashlib.sha256()
+        self.error: Optional[OSError] = None
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = b""
+        if self.error is None:
+            start = time.perf_counter()
+            try:
+                data = self._f.read(size)
+            except OSError as e:
+                # The member's header is in the stream already; only padding keeps the rest aligned.
+                self.error = e
+            self._metrics.add("read", seconds=time.perf_counter() - start, bytes_in=len(data))
+            if len(data) < size and self.error is None:
+                logging.warning(f"{self._name} shrank while being archived; padding it with zeros.")
+        if len(data) < size:
+            data += b"\0" * (size - len(data))
+        self._remaining -= len(data)
+        self.hash.update(data)
+        return data
+
+class _Unreadable(Exception):
+    """
+    An entry that could not be read. With record None nothing of it reached the archive;
+    otherwise its member is in the archive, padded with zeros from where the read failed,
+    and record is its index record.
+    """
+
+    def __init__(self, error: OSError, record: Optional[Dict[str, Any]] = None):
+        super().__init__(str(error) or type(error).__name__)
+        self.record = record
+
+def _add_entry(tar: tarfile.TarFile, compressed: BlockWriter, entry: ScanEntry,
+               data: Optional[Future] = None, metrics: Optional[Metrics] = None,
+               open_file: Callable = open) -> Optional[Dict[str, Any]]:
+    """
+    Adds one entry (not recursive) and returns its index record, with the sha256 of regular files.
+    data is the scanner's read-ahead of a small file's contents, if any; other files are
+    opened with open_file. Regular files that look incompressible go into stored blocks
+    instead of the codec. Raises _Unreadable for an entry that cannot be read; any other
+    error, such as a failed write, leaves the tar stream unusable and must end the run.
+    """
+    try:
+        tarinfo = _tarinfo_from_stat(tar, entry)
+    except OSError as e:
+        raise _Unreadable(e) from e
+    if tarinfo is None:
+        logging.warning(f"Unsupported file type, skipping {entry.path}")
+        return None
+    metrics = metrics or Metrics()
+    offset = tar.offset
+    digest = None
+    content = None
+    if tarinfo.isreg() and data is not None:
+        try:
+            start = time.perf_counter()
+            content = data.result()
+            # Read on the scanner's pool; only the time spent waiting for it shows here.
+            metrics.add("read", bytes_in=len(content), stall=time.perf_counter() - start)
+            # Archive what was read, even if the file changed size since the scan.
+            tarinfo.size = len(content)
+        except OSError:
+            content = None
+    f = reader = None
+    if content is None and tarinfo.isreg():
+        try:
+            f = open_file(entry.path, "rb")
+        except OSError as e:
+            raise _Unreadable(e) from e
+    try:
+        compress = not tarinfo.isreg() or is_compressible(entry.path, tarinfo.size, sample=content)
+        compressed.set_compression(compress)
+        if content is not None:
+            tar.addfile(tarinfo, io.BytesIO(content))
+            digest = hashlib.sha256(content).hexdigest()
+        elif f is not None:
+            reader = _HashingReader(f, tarinfo.size, str(entry.path), metrics)
+            tar.addfile(tarinfo, reader)
+            digest = reader.hash.hexdigest()
+        else:
+            tar.addfile(tarinfo)
+    finally:
+        if f is not None:
+            f.close()
+    metrics.file_done(tarinfo.size)
+    padded = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE if tarinfo.isreg() else 0
+    record = {"name": entry.arcname, "type": entry_type(tarinfo), "size": tarinfo.size, "mtime": tarinfo.mtime,
+              "mode": tarinfo.mode, "offset": offset, "data": tar.offset - padded, "sha256": digest,
+              "compressed": compress}
+    if reader is not None and reader.error is not None:
+        raise _Unreadable(reader.error, record)
+    return record
+
+def _add_meta(tar: tarfile.TarFile, meta: Dict[str, Any]) -> None:
+    data = json.dumps(meta).encode("utf-8")
+    tarinfo = tarfile.TarInfo(META_NAME)
+    tarinfo.size = len(data)
+    tarinfo.mtime = int(time.time())
+    tarinfo.mode = 0o600
+    tar.addfile(tarinfo, io.BytesIO(data))
+
+class DestinationError(OSError):
+    """The backup was written, but not to every destination; failed maps each one missed to the reason."""
+
+    def __init__(self, path: Path, failed: Dict[str, str]):
+        super().__init__(f"Backup written to {path.parent}, but not to: "
+                         + "; ".join(f"{d} ({reason})" for d, reason in failed.items()))
+        self.path = path
+        self.failed = failed
+
+
+def _fan_out(dest_dirs: List[Path], name: str, mode: str = "wb", throttle: Optional[Throttle] = None) -> FanOut:
+    """
+    Opens name in every destination, each behind its own writer thread. A destination that
+    cannot be opened is left out (and listed in failed), unless it is the only one.
+    With a throttle, the writer threads share its write limit.
+    """
+    stall = STALL_TIMEOUT if len(dest_dirs) > 1 else None
+    targets, names, failed = [], [], {}
+    for dest_dir in dest_dirs:
+        try:
+            if mode == "wb":
+                dest_dir.mkdir(parents=True, exist_ok=True)
+            f = open(dest_dir / name, mode)
+            targets.append(WriteBehind(throttle.wrap(f) if throttle else f, stall_timeout=stall))
+            names.append(str(dest_dir))
+        except OSError as e:
+            if len(dest_dirs) == 1 or mode != "wb":
+                for target in targets:
+                    target.close()
+                raise
+            logging.error(f"Cannot write to {dest_dir}, carrying on without it. Reason: {e}")
+            failed[str(dest_dir)] = str(e)
+    if not targets:
+        raise OSError(f"Every destination failed: {'; '.join(f'{d}: {r}' for d, r in failed.items())}")
+    fout = FanOut(targets, names)
+    fout.failed.update(failed)
+    return fout
+
+def _resume(journal_path: Path, dest_dirs: List[Path], password: str, run: Dict[str, Any], metrics: Metrics,
+            throttle: Optional[Throttle] = None) -> Optional[Tuple[FanOut, SegmentedWriter, Journal, Dict[str, Any], Dict[str, Any]]]:
+    """
+    Reopens the partial archives of an interrupted run of the same backup after its last checkpoint.
+    Returns (file, writer, journal, interrupted run, resume state), or None after discarding
+    whatever was left when it cannot be resumed. Every destination must hold the same partial archive.
+    """
+    name = partial_name(journal_path)
+    part_paths = [dest_dir / name for dest_dir in dest_dirs] if name else []
+    fout = None
+    reason = "its checkpoint journal is unreadable"
+    try:
+        if part_paths and all(p.exists() for p in part_paths):
+            fout = _fan_out(dest_dirs, name, "r+b", throttle)
+            writer = SegmentedWriter.reopen(fout, password, metrics=metrics, hold=2 * CHECKPOINT_BYTES)
+            journal = Journal(journal_path, writer.checkpoint_key)
+            old_run, checkpoints = journal.load()
+            same = lambda r: {k: v for k, v in r.items() if k not in ("output", "meta")}
+            if old_run is None or same(old_run) != same(run):
+                reason = "the job or its previous backup has changed"
+            elif not checkpoints:
+                reason = "it stopped before its first checkpoint"
+            elif any(t.seek(0, os.SEEK_END) != writer.committed_size(checkpoints[-1]["segments"]) for t in fout.targets):
+                # Data past the checkpoint may be on disk already; encrypting over it would reuse nonces.
+                reason = "it stopped between checkpoints"
+            else:
+                last = checkpoints[-1]
+                writer.rewind(last["segments"], base64.b64decode(last["tail"]))
+                state = {k: v for k, v in last.items() if k not in ("files", "blocks", "inodes")}
+                for key in ("files", "blocks", "inodes"):
+                    state[key] = [item for c in checkpoints for item in c[key]]
+                return fout, writer, journal, old_run, state
+        else:
+            reason = "its partial archive is missing"
+    except Exception as e:
+        reason = str(e) or type(e).__name__
+    if fout is not None:
+        try:
+            fout.close()
+        except OSError:
+            pass  # the partial archives are discarded below anyway
+    logging.info(f"Could not resume the interrupted backup ({reason}), starting over.")
+    _discard(part_paths)
+    journal_path.unlink(missing_ok=True)
+    return None
+
+def _discard(paths: Iterable[Path]) -> None:
+    for path in paths:
+        try:
+            path.unlink(missing_ok=True)
+        except NotADirectoryError:
+            pass
+        except OSError as e:
+            logging.warning(f"Could not remove {path}. Reason: {e}")
+
+def _reconcile_resumed(new_entries: Dict[str, List[Any]], previous: Dict[str, List[Any]], deleted: List[str],
+                       meta: Dict[str, Any], files: List[Dict[str, Any]], passed: List[ScanEntry]) -> None:
+    """
+    Fixes up the manifest entries of a resumed incremental backup, so that whatever changed
+    while it was interrupted is picked up by the next run rather than assumed backed up.
+    """
+    archived = {record["name"]: record for record in files}
+    for entry in passed:
+        record = archived.get(entry.arcname)
+        size = entry.stat.st_size if record and record["type"] == "file" else 0
+        if record is None or record["size"] != size or record["mtime"] != entry.stat.st_mtime:
+            new_entries.pop(entry.arcname, None)
+    recorded_deleted = set(meta["deleted"])
+    for arcname in deleted:
+        if arcname not in recorded_deleted:
+            # Deleted after the archive's deletion list was written; the next run records it.
+            new_entries[arcname] = previous[arcname]
+    for arcname in recorded_deleted:
+        if arcname in new_entries and arcname not in archived:
+            new_entries.pop(arcname)
+
+def _scan_progress(started: float) -> Callable[[ScanStats], None]:
+    last = [started]
+
+    def report(stats: ScanStats) -> None:
+        now = time.monotonic()
+        if now - last[0] >= 10:
+            last[0] = now
+            logging.info(f"Scanning... {stats}")
+    return report
+
+def _timed_iter(it: Iterable[ScanEntry], metrics: Metrics, stage: str) -> Iterable[ScanEntry]:
+    """Yields from it, adding the time spent waiting for each item to stage."""
+    it = iter(it)
+    while True:
+        start = time.perf_counter()
+        item = next(it, None)
+        metrics.add(stage, seconds=time.perf_counter() - start)
+        if item is None:
+            return
+        yield item
+
+def _compare(entry: ScanEntry, old: Optional[List[Any]], content_hash: bool, entries: Dict[str, List[Any]]) -> bool:
+    """Records entry's new manifest entry in entries; True if it has to be archived."""
+    st = entry.stat
+    sig = signature(st)
+    if old is not None and old[:3] == sig:
+        entries[entry.arcname] = old
+        return False
+    if content_hash and old is not None and old[3] and stat.S_ISREG(st.st_mode):
+        try:
+            digest = file_digest(entry.path)
+        except OSError:
+            digest = None
+        if digest == old[3]:
+            # Only the metadata changed (e.g. touched); the content is already backed up.
+            entries[entry.arcname] = sig + [digest]
+            return False
+    entries[entry.arcname] = sig + [None]
+    return True
+
+def _plan_incremental(sources: List[str], previous: Dict[str, List[Any]], content_hash: bool,
+                      stats: Optional[ScanStats] = None
+                      ) -> Tuple[List[ScanEntry], Dict[str, List[Any]], List[str]]:
+    """
+    Compares the sources against the previous manifest entries.
+    Returns (entries to archive, new manifest entries, deleted arcnames).
+    """
+    changed: List[ScanEntry] = []
+    entries: Dict[str, List[Any]] = {}
+    missing_roots = []
+    available = []
+    for src in sources:
+        p = Path(src)
+        if not os.path.lexists(p):
+            # An unavailable source is not a deletion; keep its entries as they were.
+            logging.warning(f"Source {p} is unavailable, keeping its previous manifest entries.")
+            missing_roots.append(p.name)
+        else:
+            available.append(src)
+    for entry in scan(available, stats, _scan_progress(time.monotonic())):
+        if _compare(entry, previous.get(entry.arcname), content_hash, entries):
+            changed.append(entry)
+    for arcname, old in previous.items():
+        if arcname not in entries and arcname.split("/", 1)[0] in missing_roots:
+            entries[arcname] = old
+    deleted = sorted(a for a in previous if a not in entries)
+    return changed, entries, deleted
+
+def _plan_changes(sources: List[str], previous: Dict[str, List[Any]], content_hash: bool, changes: Changes,
+                  stats: Optional[ScanStats] = None
+                  ) -> Tuple[List[ScanEntry], Dict[str, List[Any]], List[str]]:
     """
-    Creates a .tar.lz4 archive in memory and returns its bytes.
+    Like _plan_incremental, but only looks at what a watcher saw change (see watcher.py) and
+    carries every other previous entry over as it was, so the cost follows the activity
+    rather than the size of the tree.
     """
-    stream = io.BytesIO()
-    
-    with tarfile.open(fileobj=stream, mode="w") as tar:
-        for src in sources:
-            p = Path(src)
+    roots = {Path(src).name: Path(src) for src in sources}
+    entries = dict(previous)
+    changed: List[ScanEntry] = []
+    ordered: Optional[List[str]] = None
+
+    def under(arcname: str) -> List[str]:
+        # Previous entries below arcname: a contiguous range of the sorted names.
+        nonlocal ordered
+        if ordered is None:
+            ordered = sorted(previous)
+        inside = arcname + "/"
+        found = []
+        for name in ordered[bisect.bisect_left(ordered, inside):]:
+            if not name.startswith(inside):
+                break
+            found.append(name)
+        return found
+
+    for arcname in sorted(changes.paths | changes.trees):
+        parts = arcname.split("/")
+        if parts[0] not in roots or any("/".join(parts[:i]) in changes.trees for i in range(1, len(parts))):
+            continue  # not a source any more, or walked with a folder above it
+        root = roots[parts[0]]
+        if not os.path.lexists(root):
+            continue  # an unavailable source is not a deletion
+        path = root.joinpath(*parts[1:])
+        try:
+            st = path.lstat()
+        except (FileNotFoundError, NotADirectoryError):
+            for name in [arcname] + under(arcname):
+                entries.pop(name, None)
+            continue
+        except OSError as e:
+            logging.warning(f"Could not add {path} to archive, skipping. Reason: {e}")
+            continue
+        if arcname in changes.trees and stat.S_ISDIR(st.st_mode):
+            seen = set()
+            for entry in scan_tree(path, arcname, stats):
+                seen.add(entry.arcname)
+                if _compare(entry, previous.get(entry.arcname), content_hash, entries):
+                    changed.append(entry)
+            gone = [name for name in under(arcname) if name not in seen]
+        else:
+            entry = ScanEntry(path, arcname, st)
+            if stats is not None:
+                stats.add(entry)
+            if _compare(entry, previous.get(arcname), content_hash, entries):
+                changed.append(entry)
+            gone = under(arcname) if not stat.S_ISDIR(st.st_mode) else []
+        for name in gone:
+            entries.pop(name, None)
+    order = [Path(src).name for src in sources]
+    changed.sort(key=lambda e: _order_key(order, e.arcname))
+    deleted = sorted(a for a in previous if a not in entries)
+    return changed, entries, deleted
+
+def _order_key(roots: List[str], arcname: str) -> List[Any]:
+    """Sorts entries in scan order: source by source, then depth-first in sorted order."""
+    parts = arcname.split("/")
+    return [roots.index(parts[0]) if parts[0] in roots else len(roots)] + parts
+
+class _Checkpointer:
+    """
+    Commits a backup at member boundaries so an interrupted run can resume: the blocks so far
+    are written, the encrypted segments synced to disk, and what is new goes into the journal
+    (see checkpoint.py). resumed holds the interrupted run's state when this run carries it on.
+    """
+
+    def __init__(self, journal: Journal, writer: SegmentedWriter, sources: List[str],
+                 resumed: Optional[Dict[str, Any]] = None):
+        self.journal = journal
+        self.writer = writer
+        self.resumed = resumed
+        self.committed = resumed is not None
+        # Entries the interrupted run had already got past, with the stat they have now.
+        self.passed: List[ScanEntry] = []
+        self._roots = [Path(s).name for s in sources]
+        self._files = len(resumed["files"]) if resumed else 0
+        self._blocks = len(resumed["blocks"]) if resumed else 0
+        self._inodes = len(resumed["inodes"]) if resumed else 0
+        self._last = time.monotonic()
+
+    def remaining(self, entries: Iterable[ScanEntry]) -> Iterable[ScanEntry]:
+        after = self.resumed["after"] if self.resumed else None
+        for entry in entries:
+            if after is not None and _order_key(self._roots, entry.arcname) <= after:
+                self.passed.append(entry)
+                continue
+            yield entry
+
+    def due(self) -> bool:
+        return self.writer.held >= CHECKPOINT_BYTES or time.monotonic() - self._last >= CHECKPOINT_INTERVAL
+
+    def commit(self, tar: tarfile.TarFile, compressed: BlockWriter, files: List[Dict[str, Any]], last: ScanEntry) -> None:
+        state = compressed.state()
+        segments, tail = self.writer.commit()
+        inodes = list(tar.inodes.items())[self._inodes:]
+        self.journal.append({**state, "segments": segments, "tail": base64.b64encode(tail).decode("ascii"),
+                             "after": _order_key(self._roots, last.arcname), "files": files[self._files:],
+                             "blocks": compressed.blocks[self._blocks:],
+                             "inodes": [[ino, dev, name] for (ino, dev), name in inodes]})
+        self._files, self._blocks = len(files), len(compressed.blocks)
+        self._inodes += len(inodes)
+        self._last = time.monotonic()
+        self.committed = True
+
+def _write_archive(sources: List[str], fileobj: BinaryIO, codec: Optional[str] = None, level: Optional[int] = None,
+                   entries: Optional[Iterable[ScanEntry]] = None, meta: Optional[Dict[str, Any]] = None,
+                   metrics: Optional[Metrics] = None, checkpoint: Optional[_Checkpointer] = None,
+                   throttle: Optional[Throttle] = None, keep_index: Optional[Callable[[bytes], None]] = None
+                   ) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """
+    Streams a block-compressed tar archive of the sources into fileobj, followed by its index.
+    Memory is bounded by the blocks in flight on the compression pool and the scanner's read-ahead,
+    regardless of the dataset size.
+    When entries is given only those scanned entries are archived (non-recursively).
+    With a checkpoint the archive is committed between members as it goes, and a resumed
+    checkpoint carries on where the interrupted run left off. A throttle limits the reads and
+    the entries archived per second. keep_index is handed the finished index block.
+    Returns (arcnames that could not be archived, index records of the archived entries).
+    """
+    metrics = metrics or Metrics()
+    resumed = checkpoint.resumed if checkpoint is not None else None
+    stats = None
+    if entries is None:
+        stats = ScanStats()
+        entries = _timed_iter(scan(sources, stats, _scan_progress(time.monotonic())), metrics, "scan")
+    if checkpoint is not None:
+        entries = checkpoint.remaining(entries)
+    skipped = []
+    files = list(resumed["files"]) if resumed else []
+    compressed = BlockWriter(fileobj, codec, level, metrics=metrics, resume=resumed)
+    # Plain "w" mode (not "w|") writes straight through to the block writer, so set_compression
+    # takes effect exactly at member boundaries; the block writer does the buffering.
+    with tarfile.open(fileobj=compressed, mode="w", copybufsize=CHUNK_SIZE) as tar:
+        if resumed:
+            tar.inodes = {(ino, dev): name for ino, dev, name in resumed["inodes"]}
+        elif meta is not None:
+            _add_meta(tar, meta)
+        open_file = throttle.open if throttle else open
+        for entry, data in prefetch(entries, open_file=open_file):
+            if throttle:
+                throttle.file()
             try:
-                tar.add(p, arcname=p.name)
-            except Exception as e:
-                logging.warning(f"Could not add {p} to archive, skipping. Reason: {e}")
-
-    stream.seek(0)
-    
-    ### CHANGE ###
-    # Replaced the incorrect constant with a valid integer compression level.
-    # A level of 9 is a high-compression, high-speed setting for LZ4.
-    compressed_data = lz4.compress(stream.read(), compression_level=9)
-    
-    return compressed_data
-
-def run_backup(sources: List[str], destination_folder: str, password: str, output_filename: str) -> Path:
-    dest_dir = Path(destination_folder)
-    dest_dir.mkdir(parents=True, exist_ok=True)
-    
-    logging.info("Starting to create in-memory TAR archive...")
-    archive_bytes = _create_archive(sources)
-    logging.info("Archiving and LZ4 compression complete.")
-    
-    out_path = dest_dir / output_filename
-    
-    tmp_archive_path = TEMP_DIR / f"payload_{Path(output_filename).stem}.tar.lz4"
+                record = _add_entry(tar, compressed, entry, data, metrics, open_file)
+            except _Unreadable as e:
+                # Left out of the manifest either way, so the next run reads the file again.
+                skipped.append(entry.arcname)
+                if e.record is None:
+                    logging.warning(f"Could not add {entry.path} to archive, skipping. Reason: {e}")
+                    continue
+                logging.warning(f"Could not read all of {entry.path}; archived it padded with zeros. "
+                                f"Reason: {e}")
+                record = e.record
+            if record is not None:
+                files.append(record)
+            if checkpoint is not None and checkpoint.due():
+                checkpoint.commit(tar, compressed, files, entry)
+        compressed.set_compression(True)
+    compressed.close(files)
+    if keep_index is not None:
+        keep_index(compressed.index_block)
+    stored = sum(1 for f in files if not f["compressed"])
+    if stored:
+        logging.info(f"{stored} incompressible files stored without compression.")
+    if stats is not None:
+        logging.info(f"Scanned {stats}.")
+    return skipped, files
+
+def _count_total(sources: List[str], metrics: Metrics) -> threading.Event:
+    """
+    Sums the sources' file sizes into metrics.total_bytes on a thread of its own, for the ETA of
+    a backup that scans as it archives. Set the returned event to stop counting.
+    """
+    stop = threading.Event()
+    background = in_background()
+
+    def count() -> None:
+        if background:
+            enter_background()
+        total = total_size(sources, stop)
+        if total is not None:
+            metrics.total_bytes = total
+
+    threading.Thread(target=count, name="sbk-count", daemon=True).start()
+    return stop
+
+def _write_shard(dest_dirs: List[Path], name: str, password: str, entries: List[ScanEntry], codec: Optional[str],
+                 level: Optional[int], meta: Optional[Dict[str, Any]], metrics: Metrics, throttle: Optional[Throttle]
+                 ) -> Tuple[List[str], List[Dict[str, Any]], Dict[str, str], bytes]:
+    """
+    Writes one shard of a sharded backup to name + ".part" in every destination. Returns
+    (arcnames that could not be archived, index records, failed destinations, SBK2 header).
+    """
+    fout = _fan_out(dest_dirs, name + ".part", throttle=throttle)
+    with fout:
+        writer = SegmentedWriter(fout, password, metrics=metrics)
+        skipped, files = _write_archive([], writer, codec, level, entries=entries, meta=meta, metrics=metrics,
+                                        throttle=throttle)
+        writer.close()
+        fout.fsync()
+    return skipped, files, dict(fout.failed), writer.header
+
+def _shard_worker(dest_dirs: List[Path], name: str, password: str, entries: List[ScanEntry], codec: Optional[str],
+                  level: Optional[int], limits: Optional[Dict[str, Any]]
+                  ) -> Tuple[List[str], List[Dict[str, Any]], Dict[str, str], bytes, Dict[str, Any]]:
+    """_write_shard in a worker process, under its part of the run's limits; also returns the shard's metrics."""
+    metrics = Metrics()
+    result = _write_shard(dest_dirs, name, password, entries, codec, level, None, metrics,
+                          Throttle(**limits) if limits else None)
+    return (*result, metrics.snapshot())
+
+def _write_shards(sources: List[str], dest_dirs: List[Path], name: str, password: str, shards: int,
+                  entries: Optional[Iterable[ScanEntry]], codec: Optional[str], level: Optional[int],
+                  meta: Optional[Dict[str, Any]], metrics: Metrics, throttle: Optional[Throttle], names: List[str]
+                  ) -> Tuple[List[str], List[Dict[str, Any]], Dict[str, str]]:
+    """
+    Writes a sharded backup (see shards.py): the file shards in worker processes while the
+    metadata shard is written here, then the shard map. The shard names are put in front of
+    names. Returns (arcnames that could not be archived, index records, failed destinations).
+    """
+    if entries is None:
+        stats = ScanStats()
+        entries = list(_timed_iter(scan(sources, stats, _scan_progress(time.monotonic())), metrics, "scan"))
+        metrics.total_bytes = sum(e.stat.st_size for e in entries if stat.S_ISREG(e.stat.st_mode))
+        logging.info(f"Scanned {stats}.")
+    parts = partition(list(entries), shards)
+    part_names = [shard_name(name, n) for n in range(len(parts))]
+    names[:0] = part_names
+    workers = max(1, len(parts) - 1)
+    logging.info(f"Archiving {len(parts) - 1} file shards in worker processes...")
+    results: List[Any] = [None] * len(parts)
+    limits = throttle.limits(workers) if throttle else None
+    with process_pool(workers, kdf_params(), bool(throttle and throttle.background)) as pool:
+        futures = {pool.submit(_shard_worker, dest_dirs, part_names[n], password, parts[n], codec, level, limits): n
+                   for n in range(1, len(parts))}
+        results[0] = _write_shard(dest_dirs, part_names[0], password, parts[0], codec, level, meta, metrics, throttle)
+        for future in as_completed(futures):
+            *result, snapshot = future.result()
+            metrics.merge(snapshot)
+            results[futures[future]] = result
+    skipped, files, failed, headers = [], [], {}, []
+    for part_skipped, part_files, part_failed, part_header in results:
+        skipped += part_skipped
+        files += part_files
+        failed.update(part_failed)
+        headers.append(part_header)
+    live = [d for d in dest_dirs if str(d) not in failed]
+    if not live:
+        raise OSError(f"Every destination failed: {'; '.join(f'{d}: {r}' for d, r in failed.items())}")
+    fout = _fan_out(live, name + ".part", throttle=throttle)
+    with fout:
+        write_shard_map(fout, password, list(zip(part_names, headers)))
+        fout.fsync()
+    failed.update(fout.failed)
+    return skipped, files, failed
+
+def run_backup(sources: List[str], destination_folder: Union[str, List[str]], password: str, output_filename: str,
+               codec: Optional[str] = None, level: Optional[int] = None,
+               job_name: Optional[str] = None, incremental: bool = False, content_hash: bool = False,
+               progress: Optional[Progress] = None, changes: Optional[Changes] = None,
+               volume_size: Optional[int] = None, throttle: Optional[Throttle] = None, shards: int = 1) -> Path:
+    """
+    Writes an encrypted backup of the sources. With incremental=True the job's manifest decides
+    whether this run is a full backup or only contains what changed since the previous run.
+    progress is called about once a second with the run's metrics (see metrics.py) and once at the end.
+    destination_folder may be a list: the archive is produced once and written to every folder
+    concurrently. A destination that fails is dropped while the others carry on; the run then
+    raises DestinationError once the rest are complete. Returns the copy in the first folder written.
+    changes, from a watcher (see watcher.py), limits an incremental run to what may have changed.
+    With volume_size (bytes) the backup is split into numbered volumes of at most that size
+    next to a small volume map under output_filename (see volumes.py). Split backups are
+    written a volume after another without checkpoints, so they start over when interrupted.
+    throttle (see throttle.py) caps the run's reads, writes and files per second.
+    With shards > 1 the files are archived by that many worker processes into shards next to a
+    shard map under output_filename (see shards.py); like split backups, these start over when
+    interrupted, and the two cannot be combined.
+    """
+    dest_dirs = [Path(d) for d in ([destination_folder] if isinstance(destination_folder, str) else destination_folder)]
+    if not dest_dirs:
+        raise ValueError("No destination folder given.")
+    if shards > 1 and volume_size:
+        raise ValueError("A backup cannot be both sharded and split into volumes.")
+    resolve_codec(codec, level)  # bad settings fail here rather than in the first block
+
+    metrics = Metrics("backup", job_name or Path(output_filename).stem, progress)
+
+    entries = meta = manifest = None
+    if incremental:
+        if not job_name:
+            raise ValueError("Incremental backups need a job name to keep their manifest.")
+        manifest = load_manifest(job_name, password)
+        if manifest and manifest["archives"] and not all((d / manifest["archives"][-1]["file"]).exists() for d in dest_dirs):
+            logging.warning("Previous backup in the chain is missing from a destination, making a full backup.")
+            manifest = None
+        kind = "incremental" if manifest else "full"
+        manifest = manifest or empty_manifest(job_name)
+        stats = ScanStats()
+        start = time.perf_counter()
+        if changes is not None and kind == "incremental":
+            logging.info(f"Checking {len(changes.paths) + len(changes.trees):,} changed paths ({kind} backup)...")
+            entries, new_entries, deleted = _plan_changes(sources, manifest["entries"], content_hash, changes, stats)
+        else:
+            logging.info(f"Scanning sources for changes ({kind} backup)...")
+            entries, new_entries, deleted = _plan_incremental(sources, manifest["entries"], content_hash, stats)
+        metrics.add("scan", seconds=time.perf_counter() - start)
+        metrics.total_bytes = sum(e.stat.st_size for e in entries if stat.S_ISREG(e.stat.st_mode))
+        logging.info(f"Scanned {stats}.")
+        meta = {"kind": kind, "job": job_name, "deleted": deleted}
+        if kind == "incremental":
+            meta["parent"] = manifest["archives"][-1]["file"]
+        logging.info(f"{len(entries)} new or changed entries, {len(deleted)} deleted.")
+
+    # Resumable runs are keyed by job, so a timestamped archive name carries over to the resumed run.
+    journal_path = checkpoint_path(job_name or Path(output_filename).stem)
+    run = {"version": RESUME_VERSION, "output": output_filename, "sources": sources, "codec": codec, "level": level,
+           "incremental": incremental, "content_hash": content_hash, "destinations": [str(d) for d in dest_dirs],
+           "kind": meta["kind"] if meta else None, "parent": meta.get("parent") if meta else None, "meta": meta}
+    if volume_size:
+        run["volume_size"] = volume_size
+    if shards > 1:
+        run["shards"] = shards
+    resumed = _resume(journal_path, dest_dirs, password, run, metrics, throttle) if journal_path.exists() else None
+    if resumed is not None:
+        fout, writer, journal, old_run, state = resumed
+        output_filename, meta = old_run["output"], old_run["meta"]
+        logging.info(f"Resuming the interrupted backup {output_filename} after {len(state['files']):,} archived entries.")
+    part_name = output_filename + ".part"
+
+    # Single pass: tar -> block compression -> AES-GCM into a .part file, committed at checkpoints
+    # and renamed to the final name once complete. No in-memory archive and no temp file.
+    # The file is written behind the pipeline on its own thread per destination, so disk writes
+    # overlap the rest and several destinations are filled from the one encrypted stream.
+    logging.info(f"Streaming TAR archive ({codec or DEFAULT_CODEC}) into encrypted file {output_filename} "
+                 f"in {', '.join(str(d) for d in dest_dirs)}...")
+    checkpoint = None
+    names = [output_filename]
+    # Incremental and sharded runs scan before archiving and know their total already; a resumed
+    # run only counts what it adds, so a total of everything would skew its ETA.
+    counting = _count_total(sources, metrics) if entries is None and shards == 1 and resumed is None else None
     try:
-        tmp_archive_path.write_bytes(archive_bytes)
-        
-        logging.info(f"Encrypting file to {out_path}...")
-        encrypt_file(tmp_archive_path, out_path, password)
-        logging.info("Encryption complete.")
+        if shards > 1:
+            skipped, files, failed = _write_shards(sources, dest_dirs, output_filename, password, shards, entries,
+                                                   codec, level, meta, metrics, throttle, names)
+            live = [str(d) for d in dest_dirs if str(d) not in failed]
+            journal = None
+        else:
+            if volume_size:
+                # Volumes first, the map last: the backup only shows up once every volume is in place.
+                fout = VolumeWriter(dest_dirs, output_filename, password, volume_size,
+                                    lambda dirs, name: _fan_out(dirs, name + ".part", throttle=throttle))
+                names = fout.files
+                writer = SegmentedWriter(fout, password, metrics=metrics)
+                journal = state = None
+            elif resumed is None:
+                fout = _fan_out(dest_dirs, part_name, throttle=throttle)
+                writer = SegmentedWriter(fout, password, metrics=metrics, hold=2 * CHECKPOINT_BYTES)
+                journal = Journal.create(journal_path, part_name, writer.checkpoint_key, run)
+                state = None
+            with fout:
+                if journal is not None:
+                    checkpoint = _Checkpointer(journal, writer, sources, state)
+                skipped, files = _write_archive(sources, writer, codec, level, entries=entries, meta=meta,
+                                                metrics=metrics, checkpoint=checkpoint, throttle=throttle,
+                                                keep_index=fout.keep_index if volume_size else None)
+                writer.close()
+                fout.fsync()
+            live, failed = fout.live(), fout.failed
+        written = []
+        for dest in live:
+            try:
+                for name in names:
+                    os.replace(Path(dest) / (name + ".part"), Path(dest) / name)
+                written.append(Path(dest) / output_filename)
+            except OSError as e:
+                logging.error(f"Could not finish the backup in {dest}. Reason: {e}")
+                failed[dest] = str(e)
+        if not written:
+            raise OSError(f"Every destination failed: {'; '.join(f'{d}: {r}' for d, r in failed.items())}")
+        if journal is not None:
+            journal.discard()
+    except BaseException as e:
+        # Never leave a half-written backup at the final path; keep the .part only if it can be resumed.
+        if checkpoint is not None and checkpoint.committed:
+            logging.warning("Backup interrupted; the next run of this job resumes from its last checkpoint.")
+        else:
+            _discard(d / (name + ".part") for d in dest_dirs for name in names)
+            journal_path.unlink(missing_ok=True)
+        metrics.close("failed", str(e) or type(e).__name__)
+        raise
     finally:
-        if tmp_archive_path.exists():
-            tmp_archive_path.unlink()
-        
-    return out_path
\ No newline at end of file
+        if counting is not None:
+            counting.set()
+    _discard(Path(d) / (name + ".part") for d in failed for name in names)
+    # Volumes or shards left over from an earlier backup under the same name (e.g. one split into more volumes).
+    _discard(p for path in written for p in volume_paths(path) + shard_paths(path) if p.name not in names)
+    out_path = written[0]
+    summary = metrics.close()
+    logging.info("Archiving, compression and encryption complete.")
+    logging.info(f"{summary['files']:,} files, {summary['bytes']:,} bytes in {summary['elapsed']:.1f}s "
+                 f"({summary['mb_per_s']:.1f} MB/s, ratio {summary['ratio']}). Stages: {format_stages(summary)}")
+    if throttle and throttle.waited:
+        logging.info(f"Held back {throttle.waited:.1f}s by the job's I/O limits.")
+
+    if incremental:
+        for arcname in skipped:
+            # Not in the archive, so the next run must pick it up again.
+            new_entries.pop(arcname, None)
+        if checkpoint is not None and checkpoint.resumed is not None:
+            _reconcile_resumed(new_entries, manifest["entries"], deleted, meta, files, checkpoint.passed)
+        for record in files:
+            if record["sha256"] and record["name"] in new_entries:
+                new_entries[record["name"]][3] = record["sha256"]
+        if meta["kind"] == "full":
+            manifest["archives"] = []
+        manifest["entries"] = new_entries
+        manifest["archives"].append({"file": output_filename, "kind": meta["kind"], "time": datetime.now().isoformat(timespec="seconds")})
+        save_manifest(job_name, manifest, password)
+
+    try:
+        # One backup, however many destinations hold a copy of it.
+        record_backup(written, job_name or job_from_filename(output_filename), files,
+                      meta["kind"] if meta else "full", meta.get("parent") if meta else None)
+    except (sqlite3.Error, OSError) as e:
+        # The backup itself is fine; rebuild_catalog can pick it up later.
+        logging.warning(f"Could not add {out_path} to the backup catalog. Reason: {e}")
+
+    if failed:
+        raise DestinationError(out_path, dict(failed))
+    return out_path
@@ -0,0 +1,302 @@
+from __future__ import annotations
+import logging
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+from .utils import CATALOG_PATH
+from .shards import shard_paths
+from .volumes import volume_paths
+
+# Local catalog of every backup written on this machine, so searches and retention never have
+# to decrypt an archive. SQLite at CATALOG_PATH:
+#   archives(id, job, path, kind, parent, created, archive_size, files, bytes)
+#   copies(archive_id, path, name, head)
+#   files(archive_id, path, type, size, mtime, sha256)
+# created is an ISO timestamp, so it sorts and compares as text. A file row means the archive
+# holds that version of the path; an incremental backup only lists what changed in it.
+# A backup written to several destinations is one archives row with a copies row per file;
+# archives.path is its first copy. Retention and search count backups, never copies.
+# head holds the first HEAD_BYTES of the file (hex): its random salts are the same in every
+# copy of one backup and in no other backup, so copies are matched by it, never by name.
+# Unlike the archives, the catalog is not encrypted: it holds names, sizes and checksums only.
+# It can always be rebuilt from the archive indexes with rebuild_catalog().
+
+SCHEMA_VERSION = 3
+HEAD_BYTES = 64
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    job TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    parent TEXT,
+    created TEXT NOT NULL,
+    archive_size INTEGER NOT NULL,
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS copies (
+    archive_id INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+    path TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    head TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    archive_id INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS archives_created ON archives(created);
+CREATE INDEX IF NOT EXISTS archives_job_created ON archives(job, created);
+CREATE INDEX IF NOT EXISTS copies_archive ON copies(archive_id);
+CREATE INDEX IF NOT EXISTS copies_head ON copies(head);
+CREATE INDEX IF NOT EXISTS files_path ON files(path, archive_id);
+CREATE INDEX IF NOT EXISTS files_archive ON files(archive_id);
+"""
+
+# Sorts after any character, so path >= prefix AND path < prefix + _MAX_CHAR is an index range scan.
+_MAX_CHAR = "\U0010ffff"
+_TIMESTAMP_SUFFIX = re.compile(r"_\d{8}_\d{6}$")
+
+When = Union[datetime, str, None]
+
+
+@contextmanager
+def _connect(db_path: Optional[Path] = None) -> Iterator[sqlite3.Connection]:
+    # One short-lived connection per call: scheduled jobs record their runs from several threads.
+    conn = sqlite3.connect(str(db_path or CATALOG_PATH), timeout=30)
+    try:
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            conn.execute("PRAGMA journal_mode = WAL")
+            if version == 2 and "head" not in [row[1] for row in conn.execute("PRAGMA table_info(copies)")]:
+                conn.execute("ALTER TABLE copies ADD COLUMN head TEXT")
+            conn.executescript(_SCHEMA)
+            with conn:
+                if version == 1:
+                    _fold_copies(conn)
+                elif version == 2:
+                    _split_copies(conn)
+                conn.execute("DROP INDEX IF EXISTS copies_name")
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _head(path: Union[str, Path]) -> Optional[str]:
+    try:
+        with open(path, "rb") as f:
+            return f.read(HEAD_BYTES).hex() or None
+    except OSError:
+        return None
+
+
+def _fold_copies(conn: sqlite3.Connection) -> None:
+    # Version 1 kept one archives row per destination file; fold the copies of a backup into one.
+    # A file that is gone cannot be matched and keeps a row of its own.
+    owners: Dict[str, int] = {}
+    for row in conn.execute("SELECT id, path FROM archives ORDER BY created, id").fetchall():
+        head = _head(row["path"])
+        owner = owners.setdefault(head, row["id"]) if head else row["id"]
+        conn.execute("INSERT OR IGNORE INTO copies (archive_id, path, name, head) VALUES (?, ?, ?, ?)",
+                     (owner, row["path"], Path(row["path"]).name, head))
+        if owner != row["id"]:
+            conn.execute("DELETE FROM archives WHERE id = ?", (row["id"],))
+
+
+def _split_copies(conn: sqlite3.Connection) -> None:
+    # Version 2 took files of the same job, name and size for copies of one backup. Where they
+    # turn out to be different backups, the row only describes one of them; forget it whole.
+    mixed = 0
+    for archive_id, in conn.execute("SELECT id FROM archives").fetchall():
+        heads = {}
+        for path, in conn.execute("SELECT path FROM copies WHERE archive_id = ?", (archive_id,)).fetchall():
+            heads[path] = _head(path)
+            conn.execute("UPDATE copies SET head = ? WHERE path = ?", (heads[path], path))
+        if len({h for h in heads.values() if h}) > 1:
+            conn.execute("DELETE FROM archives WHERE id = ?", (archive_id,))
+            mixed += 1
+    if mixed:
+        logging.warning(f"Forgot {mixed} catalogued backups that mixed up different backups of the same name; "
+                        f"rebuild the catalog of their folders to list them again.")
+
+
+def _forget(conn: sqlite3.Connection, paths: Iterable[str]) -> None:
+    for path in paths:
+        row = conn.execute("SELECT archive_id FROM copies WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            continue
+        conn.execute("DELETE FROM copies WHERE path = ?", (path,))
+        rest = conn.execute("SELECT path FROM copies WHERE archive_id = ? ORDER BY rowid LIMIT 1", (row[0],)).fetchone()
+        if rest is None:
+            conn.execute("DELETE FROM archives WHERE id = ?", (row[0],))
+        else:
+            conn.execute("UPDATE archives SET path = ? WHERE id = ? AND path = ?", (rest[0], row[0], path))
+
+
+def _iso(when: When, end: bool = False) -> Optional[str]:
+    if when is None or isinstance(when, str):
+        # A bare date as an upper bound means the end of that day.
+        return when + "T23:59:59" if end and when and "T" not in when else when
+    return when.isoformat(timespec="seconds")
+
+
+def _key(path: Union[str, Path]) -> str:
+    return str(Path(path).resolve())
+
+
+def job_from_filename(path: Union[str, Path]) -> str:
+    """Job name a backup file was written for, as far as its name tells (see jobs.get_backup_filename)."""
+    return _TIMESTAMP_SUFFIX.sub("", Path(path).stem)
+
+
+def record_backup(archive_paths: Union[str, Path, List[Union[str, Path]]], job: str, files: List[Dict[str, Any]],
+                  kind: str = "full", parent: Optional[str] = None, created: When = None,
+                  db_path: Optional[Path] = None) -> None:
+    """
+    Records one backup and its index records (name, type, size, mtime, sha256). archive_paths is
+    the backup file, or its copies in each destination it was written to.
+    A file catalogued before with the same head (a copy found in another folder, or this one
+    recorded again) belongs to the same backup: its entry is replaced, keeping its other copies.
+    One with a different head at the same path was overwritten by this backup and is forgotten.
+    The size of a split or sharded backup includes its volumes or shards.
+    """
+    paths = [Path(archive_paths)] if isinstance(archive_paths, (str, Path)) else [Path(p) for p in archive_paths]
+    created = _iso(created) or datetime.now().isoformat(timespec="seconds")
+    total = sum(f["size"] for f in files if f["type"] == "file")
+    size = paths[0].stat().st_size + sum(p.stat().st_size for p in volume_paths(paths[0]) + shard_paths(paths[0]))
+    head = _head(paths[0])
+    keys = [_key(p) for p in paths]
+    with _connect(db_path) as conn:
+        known = [row[0] for row in conn.execute("SELECT DISTINCT archive_id FROM copies WHERE head = ?", (head,))]
+        overwritten = [row[0] for key in keys
+                       for row in conn.execute("SELECT path, archive_id FROM copies WHERE path = ?", (key,))
+                       if row[1] not in known]
+        _forget(conn, overwritten)
+        copies = [row[0] for archive_id in known
+                  for row in conn.execute("SELECT path FROM copies WHERE archive_id = ? ORDER BY rowid", (archive_id,))]
+        copies += [key for key in keys if key not in copies]
+        conn.executemany("DELETE FROM archives WHERE id = ?", ((archive_id,) for archive_id in known))
+        archive_id = conn.execute(
+            "INSERT INTO archives (job, path, kind, parent, created, archive_size, files, bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job, copies[0], kind, parent, created, size, len(files), total)).lastrowid
+        conn.executemany("INSERT INTO copies (archive_id, path, name, head) VALUES (?, ?, ?, ?)",
+                         ((archive_id, path, Path(path).name, head) for path in copies))
+        conn.executemany("INSERT INTO files (archive_id, path, type, size, mtime, sha256) VALUES (?, ?, ?, ?, ?, ?)",
+                         ((archive_id, f["name"], f["type"], f["size"], f.get("mtime"), f.get("sha256")) for f in files))
+
+
+def forget_archive(archive_path: Union[str, Path], db_path: Optional[Path] = None) -> None:
+    """Forgets one copy of a backup; the backup itself goes with its last copy."""
+    with _connect(db_path) as conn:
+        _forget(conn, [_key(archive_path)])
+
+
+def search(prefix: str = "", job: Optional[str] = None, since: When = None, until: When = None,
+           limit: int = 1000, db_path: Optional[Path] = None) -> List[Dict[str, Any]]:
+    """
+    Every backed-up version of the paths under prefix (an exact path or a folder), newest backup first.
+    since/until bound the backup time (datetimes or ISO strings). Rows carry the file's
+    path, type, size, mtime and sha256 plus the archive's job, path, kind and created time.
+    """
+    prefix = prefix.strip().rstrip("/")
+    where, params = [], []
+    if prefix:
+        where.append("(f.path = ? OR (f.path >= ? AND f.path < ?))")
+        params += [prefix, prefix + "/", prefix + "/" + _MAX_CHAR]
+    if job:
+        where.append("a.job = ?")
+        params.append(job)
+    if since:
+        where.append("a.created >= ?")
+        params.append(_iso(since))
+    if until:
+        where.append("a.created <= ?")
+        params.append(_iso(until, end=True))
+    sql = ("SELECT f.path, f.type, f.size, f.mtime, f.sha256, a.job, a.path AS archive, a.kind, a.created "
+           "FROM files f JOIN archives a ON a.id = f.archive_id"
+           + (" WHERE " + " AND ".join(where) if where else "")
+           + " ORDER BY a.created DESC, f.path LIMIT ?")
+    with _connect(db_path) as conn:
+        return [dict(row) for row in conn.execute(sql, params + [limit])]
+
+
+def backups(job: Optional[str] = None, since: When = None, until: When = None,
+            db_path: Optional[Path] = None) -> List[Dict[str, Any]]:
+    """
+    The catalogued backups (optionally of one job and time range), newest first, each with
+    the list of its copies.
+    """
+    where, params = [], []
+    for clause, value in (("job = ?", job), ("created >= ?", _iso(since)), ("created <= ?", _iso(until, end=True))):
+        if value:
+            where.append(clause)
+            params.append(value)
+    sql = "SELECT * FROM archives" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY created DESC, id DESC"
+    with _connect(db_path) as conn:
+        found = [dict(row) for row in conn.execute(sql, params)]
+        for archive in found:
+            archive["copies"] = [row[0] for row in conn.execute("SELECT path FROM copies WHERE archive_id = ? ORDER BY rowid",
+                                                                (archive["id"],))]
+    return found
+
+
+def prune_candidates(job: str, keep: int, db_path: Optional[Path] = None) -> List[Dict[str, Any]]:
+    """
+    Backups of job that a retention of the newest keep full backups would remove, newest first.
+    A backup counts once however many copies it has; removing it means removing all of them.
+    An incremental backup is kept as long as the full backup its chain starts from is kept.
+    """
+    if keep < 1:
+        raise ValueError("Keeping fewer than one full backup would remove them all.")
+    fulls = 0
+    candidates = []
+    for archive in backups(job, db_path=db_path):
+        if fulls >= keep:
+            candidates.append(archive)
+        elif archive["kind"] != "incremental":
+            fulls += 1
+    return candidates
+
+
+def rebuild_catalog(folders: List[str], password: str, db_path: Optional[Path] = None) -> int:
+    """
+    Re-catalogues every .sbk backup in the folders from its index, and forgets catalogued
+    backups in those folders that no longer exist. Returns the number of backups recorded.
+    Backups the password does not open are skipped with a warning.
+    """
+    from .restore import list_archive, read_archive_meta
+    recorded = 0
+    for folder in folders:
+        root = Path(folder).resolve()
+        for archive in sorted(root.glob("*.sbk")):
+            try:
+                files = list_archive(str(archive), password)
+                meta = read_archive_meta(archive, password) or {}
+            except Exception as e:
+                logging.warning(f"Could not read {archive.name}, leaving it out of the catalog. Reason: {str(e) or type(e).__name__}")
+                continue
+            created = datetime.fromtimestamp(archive.stat().st_mtime)
+            record_backup(archive, meta.get("job") or job_from_filename(archive), files, meta.get("kind", "full"),
+                          meta.get("parent"), created, db_path)
+            recorded += 1
+        inside = os.path.join(str(root), "")
+        with _connect(db_path) as conn:
+            gone = [row["path"] for row in conn.execute("SELECT path FROM copies WHERE path >= ? AND path < ?",
+                                                        (inside, inside + _MAX_CHAR))
+                    if Path(row["path"]).parent == root and not Path(row["path"]).exists()]
+            _forget(conn, gone)
+    logging.info(f"Catalogued {recorded} backups.")
+    return recorded
@@ -0,0 +1,90 @@
+from __future__ import annotations
+import hashlib
+import json
+import logging
+import os
+import struct
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from .crypto import encrypt_blob, decrypt_blob
+from .utils import CHECKPOINT_DIR
+
+# Resume journal of a backup in progress, one per job under CHECKPOINT_DIR:
+#   magic(4)=SBCP | name length(2) | partial archive filename (utf-8) | frames
+# and each frame is length(4) | encrypt_blob(key, JSON), the key coming from the partial
+# archive's own header (SegmentedWriter.checkpoint_key). The first frame describes the run
+# ({"run": {...}}); every later one is a checkpoint:
+#   {"segments", "tail", "payload_offset", "raw_offset", "compress", "after", "files", "blocks", "inodes"}
+# where files, blocks and inodes hold only what was added since the previous checkpoint.
+# A torn last frame (a crash while appending) is ignored.
+
+JOURNAL_MAGIC = b"SBCP"
+NAME_LEN = struct.Struct(">H")
+FRAME_LEN = struct.Struct(">I")
+
+
+def checkpoint_path(job_name: str) -> Path:
+    safe = "".join(c for c in job_name if c.isalnum() or c in ("_", "-"))[:40]
+    digest = hashlib.sha256(job_name.encode("utf-8")).hexdigest()[:12]
+    return CHECKPOINT_DIR / f"{safe}_{digest}.sbc"
+
+
+def partial_name(path: Path) -> Optional[str]:
+    """Filename of the partial archive a journal belongs to, or None if there is no usable journal."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(len(JOURNAL_MAGIC) + NAME_LEN.size)
+            if len(head) != len(JOURNAL_MAGIC) + NAME_LEN.size or head[:4] != JOURNAL_MAGIC:
+                return None
+            name = f.read(NAME_LEN.unpack_from(head, 4)[0]).decode("utf-8")
+    except (OSError, UnicodeDecodeError):
+        return None
+    # Only ever a bare filename inside the destination folder.
+    return name if name and Path(name).name == name else None
+
+
+class Journal:
+    def __init__(self, path: Path, key: bytes):
+        self.path = path
+        self._key = key
+
+    @classmethod
+    def create(cls, path: Path, part_name: str, key: bytes, run: Dict[str, Any]) -> "Journal":
+        name = part_name.encode("utf-8")
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(JOURNAL_MAGIC + NAME_LEN.pack(len(name)) + name)
+        os.replace(tmp, path)
+        journal = cls(path, key)
+        journal.append({"run": run})
+        return journal
+
+    def append(self, frame: Dict[str, Any]) -> None:
+        blob = encrypt_blob(self._key, json.dumps(frame, separators=(",", ":")).encode("utf-8"), JOURNAL_MAGIC)
+        with open(self.path, "ab") as f:
+            f.write(FRAME_LEN.pack(len(blob)) + blob)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Returns (the run description, its checkpoints in order)."""
+        frames = []
+        with open(self.path, "rb") as f:
+            f.seek(len(JOURNAL_MAGIC))
+            f.seek(NAME_LEN.unpack(f.read(NAME_LEN.size))[0], os.SEEK_CUR)
+            while True:
+                head = f.read(FRAME_LEN.size)
+                if len(head) != FRAME_LEN.size:
+                    break
+                blob = f.read(FRAME_LEN.unpack(head)[0])
+                try:
+                    frames.append(json.loads(decrypt_blob(self._key, blob, JOURNAL_MAGIC)))
+                except Exception:
+                    logging.warning(f"Ignoring a damaged checkpoint at the end of {self.path.name}.")
+                    break
+        if not frames or "run" not in frames[0]:
+            return None, []
+        return frames[0]["run"], frames[1:]
+
+    def discard(self) -> None:
+        self.path.unlink(missing_ok=True)
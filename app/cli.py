@@ -0,0 +1,299 @@
+from __future__ import annotations
+import argparse
+import getpass
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# Headless entry point: python -m app backup|restore|verify|list|search|prune|catalog|daemon
+# Only what a command needs is imported, so nothing here pulls in the GUI stack, and
+# apscheduler is loaded by the daemon alone. Logs go to stderr; with --json the result
+# is printed to stdout as one JSON document for monitoring.
+
+EXIT_OK = 0
+EXIT_FAILED = 1     # the operation ran and failed (a job, a restore, a verification)
+EXIT_USAGE = 2      # bad arguments or unknown job names (argparse uses 2 as well)
+EXIT_AUTH = 3       # wrong password or tampered data
+
+PASSWORD_ENV = "SECUREBACKUP_PASSWORD"
+
+
+class UsageError(Exception):
+    pass
+
+
+def _positive_int(text: str) -> int:
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{text}' is not a whole number") from None
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return value
+
+
+def _output(args: argparse.Namespace, result: Dict[str, Any], text: str) -> None:
+    if args.json:
+        json.dump(result, sys.stdout, default=str)
+        sys.stdout.write("\n")
+    elif text:
+        print(text)
+
+
+def _exit_code(error: BaseException) -> int:
+    from cryptography.exceptions import InvalidTag
+    return EXIT_AUTH if isinstance(error, InvalidTag) else EXIT_FAILED
+
+
+def _error_text(error: BaseException) -> str:
+    from cryptography.exceptions import InvalidTag
+    if isinstance(error, InvalidTag):
+        return "Wrong password or the file has been tampered with"
+    return str(error) or type(error).__name__
+
+
+class _ProgressSink:
+    """Keeps a run's last metrics snapshot and, with --progress, shows live progress on stderr."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.show = args.progress
+        self.last: Optional[Dict[str, Any]] = None
+
+    def __call__(self, snap: Dict[str, Any]) -> None:
+        from .metrics import format_progress
+        self.last = snap
+        if self.show:
+            end = "\n" if snap["event"] == "summary" else "\r"
+            sys.stderr.write(format_progress(snap).ljust(70) + end)
+            sys.stderr.flush()
+
+
+def _load_jobs() -> List[Dict[str, Any]]:
+    from .config import load_config
+    from .crypto import set_kdf_params
+    cfg = load_config()
+    set_kdf_params(**cfg.get("kdf", {}))
+    return cfg.get("jobs", [])
+
+
+def _password(args: argparse.Namespace) -> str:
+    """Password from --job, a password file, the environment or a prompt, in that order."""
+    if args.job:
+        from .jobs import find_job
+        job = find_job(_load_jobs(), args.job)
+        if job is None:
+            raise UsageError(f"No job named '{args.job}' in the configuration")
+        return job["password"]
+    if args.password_file:
+        with open(args.password_file, encoding="utf-8") as f:
+            return f.readline().rstrip("\r\n")
+    if os.environ.get(PASSWORD_ENV):
+        return os.environ[PASSWORD_ENV]
+    if sys.stdin.isatty():
+        return getpass.getpass("Password: ")
+    raise UsageError(f"No password given: use --job, --password-file or {PASSWORD_ENV}")
+
+
+def cmd_backup(args: argparse.Namespace) -> int:
+    from .jobs import find_job, run_job
+    jobs = _load_jobs()
+    if args.all:
+        selected = [j for j in jobs if j.get("enabled", True)]
+    else:
+        missing = [n for n in args.jobs if find_job(jobs, n) is None]
+        if missing or not args.jobs:
+            _output(args, {"status": "error", "error": f"Unknown jobs: {', '.join(missing)}" if missing else "No jobs given"},
+                    f"Unknown jobs: {', '.join(missing)}" if missing else "Name the jobs to run, or use --all.")
+            return EXIT_USAGE
+        selected = [find_job(jobs, n) for n in args.jobs]
+    results = []
+    code = EXIT_OK
+    for job in selected:
+        started = time.monotonic()
+        sink = _ProgressSink(args)
+        try:
+            path = run_job(job, progress=sink)
+            results.append({"job": job["name"], "status": "ok", "path": str(path),
+                            "seconds": round(time.monotonic() - started, 3), "metrics": sink.last})
+        except Exception as e:
+            logging.error(f"Job '{job['name']}' failed. Reason: {_error_text(e)}")
+            results.append({"job": job["name"], "status": "failed", "error": _error_text(e),
+                            "seconds": round(time.monotonic() - started, 3)})
+            code = max(code, _exit_code(e))
+    text = "\n".join(f"{r['job']}: {r['status']} {r.get('path') or r.get('error')}" for r in results)
+    _output(args, {"status": "ok" if code == EXIT_OK else "failed", "jobs": results}, text)
+    return code
+
+
+def cmd_restore(args: argparse.Namespace) -> int:
+    from .restore import run_restore
+    sink = _ProgressSink(args)
+    run_restore(args.archive, args.output, _password(args), chain=not args.no_chain, patterns=args.pattern or None,
+                progress=sink)
+    _output(args, {"status": "ok", "archive": args.archive, "output": args.output, "metrics": sink.last},
+            f"Restored {args.archive} to {args.output}")
+    return EXIT_OK
+
+
+def cmd_verify(args: argparse.Namespace) -> int:
+    from .restore import verify_archive
+    password = _password(args)
+    results = []
+    code = EXIT_OK
+    for archive in args.archive:
+        sink = _ProgressSink(args)
+        try:
+            result = verify_archive(archive, password, chain=args.chain, progress=sink)
+            results.append({"archive": archive, "status": "ok", **result})
+        except Exception as e:
+            logging.error(f"{archive}: {_error_text(e)}")
+            results.append({"archive": archive, "status": "failed", "error": _error_text(e)})
+            code = max(code, _exit_code(e))
+    text = "\n".join(f"{r['archive']}: OK, {r['entries']} entries, {r['bytes']:,} bytes" if r["status"] == "ok"
+                     else f"{r['archive']}: FAILED, {r['error']}" for r in results)
+    _output(args, {"status": "ok" if code == EXIT_OK else "failed", "archives": results}, text)
+    return code
+
+
+def cmd_list(args: argparse.Namespace) -> int:
+    from .restore import list_archive
+    entries = list_archive(args.archive, _password(args))
+    text = "\n".join(f"{e.get('type', 'file'):8} {e.get('size', 0):>14,}  {e['name']}" for e in entries)
+    _output(args, {"status": "ok", "archive": args.archive, "entries": entries}, text)
+    return EXIT_OK
+
+
+def cmd_search(args: argparse.Namespace) -> int:
+    from .catalog import search
+    rows = search(args.path, job=args.job, since=args.since, until=args.until, limit=args.limit)
+    text = "\n".join(f"{r['created']}  {r['size']:>14,}  {r['path']}  ({r['archive']})" for r in rows)
+    _output(args, {"status": "ok", "results": rows}, text or "No backed-up versions found.")
+    return EXIT_OK
+
+
+def cmd_prune(args: argparse.Namespace) -> int:
+    from .catalog import prune_candidates, forget_archive
+    from .shards import shard_paths
+    from .volumes import volume_paths
+    candidates = prune_candidates(args.job, args.keep)
+    if args.delete:
+        for archive in candidates:
+            for copy in archive["copies"]:
+                for part in volume_paths(copy) + shard_paths(copy):
+                    part.unlink(missing_ok=True)
+                Path(copy).unlink(missing_ok=True)
+                forget_archive(copy)
+    verb = "Deleted" if args.delete else "Would delete"
+    text = "\n".join(f"{verb} {a['created']}  {a['kind']:11} {', '.join(a['copies'])}" for a in candidates)
+    _output(args, {"status": "ok", "deleted": args.delete, "archives": candidates}, text or "Nothing to prune.")
+    return EXIT_OK
+
+
+def cmd_catalog(args: argparse.Namespace) -> int:
+    from .catalog import rebuild_catalog
+    count = rebuild_catalog(args.folder, _password(args))
+    _output(args, {"status": "ok", "archives": count}, f"Catalogued {count} backups.")
+    return EXIT_OK
+
+
+def cmd_daemon(args: argparse.Namespace) -> int:
+    from .config import load_config
+    from .jobs import job_destinations, run_job
+    from .scheduler import BackupScheduler
+    jobs = _load_jobs()
+    sched_cfg = load_config().get("scheduler", {})
+    scheduler = BackupScheduler(sched_cfg.get("max_concurrent", 2), sched_cfg.get("per_device", 1),
+                                sched_cfg.get("memory_budget_mb", 0) * 1024 * 1024)
+    enabled = [j for j in jobs if j.get("enabled", True)]
+    for job in enabled:
+        watcher = scheduler.watch(job) if job.get("watch") else None
+        scheduler.add_or_update_job(job["name"], BackupScheduler.cron_from_job(job), run_job, job, watcher=watcher,
+                                    destination=job_destinations(job))
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    scheduler.start()
+    logging.info(f"Daemon started with {len(enabled)} scheduled jobs.")
+    stop.wait()
+    logging.info("Stopping daemon...")
+    scheduler.stop()
+    return EXIT_OK
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m app", description="SecureBackup without the GUI.")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON on stdout")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only log warnings and errors")
+    parser.add_argument("--progress", action="store_true", help="show live throughput and ETA on stderr")
+    sub = parser.add_subparsers(dest="command", metavar="command")
+
+    p = sub.add_parser("backup", help="run jobs from config.toml now")
+    p.add_argument("jobs", nargs="*", metavar="JOB", help="job names")
+    p.add_argument("--all", action="store_true", help="run every enabled job")
+    p.set_defaults(func=cmd_backup)
+
+    def archive_command(name: str, help_text: str, func, many: bool = False) -> argparse.ArgumentParser:
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("archive", nargs="+" if many else None, help=".sbk backup or repository .snap snapshot")
+        p.add_argument("--job", help="take the password from this configured job")
+        p.add_argument("--password-file", help="read the password from the first line of this file")
+        p.set_defaults(func=func)
+        return p
+
+    p = archive_command("restore", "restore a backup", cmd_restore)
+    p.add_argument("output", help="folder to restore into")
+    p.add_argument("--pattern", action="append", help="restore only matching paths or globs (repeatable)")
+    p.add_argument("--no-chain", action="store_true", help="restore only this archive, not its incremental chain")
+    p = archive_command("verify", "check that backups restore correctly, without writing anything", cmd_verify, many=True)
+    p.add_argument("--chain", action="store_true", help="also check the earlier archives an incremental backup needs")
+    archive_command("list", "list the entries of a backup", cmd_list)
+
+    p = sub.add_parser("search", help="find every backed-up version of a path in the local catalog")
+    p.add_argument("path", nargs="?", default="", help="file or folder path as stored in the backups, e.g. Documents/report.docx")
+    p.add_argument("--job", help="only backups of this job")
+    p.add_argument("--since", help="only backups made at or after this time (ISO format, e.g. 2026-10-06)")
+    p.add_argument("--until", help="only backups made at or before this time (ISO format)")
+    p.add_argument("--limit", type=int, default=1000, help="at most this many results (default 1000)")
+    p.set_defaults(func=cmd_search)
+
+    p = sub.add_parser("prune", help="pick the backups of a job beyond the newest full backups, from the catalog")
+    p.add_argument("job", help="job name")
+    p.add_argument("--keep", type=_positive_int, required=True, help="full backups (with their incrementals) to keep")
+    p.add_argument("--delete", action="store_true", help="delete the picked backups instead of only listing them")
+    p.set_defaults(func=cmd_prune)
+
+    p = sub.add_parser("catalog", help="rebuild the catalog entries for the backups in some folders")
+    p.add_argument("folder", nargs="+", help="folders holding .sbk backups")
+    p.add_argument("--job", help="take the password from this configured job")
+    p.add_argument("--password-file", help="read the password from the first line of this file")
+    p.set_defaults(func=cmd_catalog)
+
+    p = sub.add_parser("daemon", help="run the scheduled jobs from config.toml until stopped")
+    p.set_defaults(func=cmd_daemon)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help(sys.stderr)
+        return EXIT_USAGE
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stderr)
+    try:
+        return args.func(args)
+    except UsageError as e:
+        _output(args, {"status": "error", "error": str(e)}, "")
+        logging.error(str(e))
+        return EXIT_USAGE
+    except Exception as e:
+        _output(args, {"status": "failed", "error": _error_text(e)}, "")
+        logging.error(_error_text(e))
+        return _exit_code(e)
@@ -6,6 +6,11 @@ from .utils import CONFIG_PATH
 
 DEFAULTS = {
     "jobs": [],
+    # scrypt cost for new master keys: n = 2**log2n
+    "kdf": {"log2n": 14, "r": 8, "p": 1},
+    # scheduled runs: at most max_concurrent at once and per_device per destination disk;
+    # memory_budget_mb 0 means half the machine's RAM
+    "scheduler": {"max_concurrent": 2, "per_device": 1, "memory_budget_mb": 0},
 }
 
 def load_config() -> Dict[str, Any]:
@@ -21,5 +26,7 @@ def load_config() -> Dict[str, Any]:
 def save_config(cfg: Dict[str, Any]) -> None:
     # We can remove the old config structure since it's now simplified to just jobs
     config_to_save = {"jobs": cfg.get("jobs", [])}
+    for section in ("kdf", "scheduler"):
+        config_to_save[section] = cfg.get(section, DEFAULTS[section])
     doc = tomlkit.dumps(config_to_save)
     CONFIG_PATH.write_text(doc, encoding="utf-8")
\ No newline at end of file
@@ -1,13 +1,25 @@
 from __future__ import annotations
 from pathlib import Path
+import hashlib
+import hmac as std_hmac
 import os
-from typing import Optional
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF, HKDFExpand
 from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import hmac
-from .utils import KEYCHECK_PATH, CHUNK_SIZE
+from .utils import KEYCHECK_PATH, CHUNK_SIZE, read_exact
+from .metrics import Metrics
+from .pipeline import ReadAhead, WriteBehind
+from .throttle import PriorityPools
 
 backend = default_backend()
 
@@ -20,31 +32,126 @@ def derive_key(password: str, salt: bytes, n: int = 2**14, r: int = 8, p: int =
     kdf = Scrypt(salt=salt, length=length, n=n, r=r, p=p, backend=backend)
     return kdf.derive(password.encode("utf-8"))
 
+# Key hierarchy (SBK2 headers with kdf 2, SKC2 keychecks):
+#   master key  = scrypt(password, master salt, n, r, p), derived once and cached in-process
+#   archive key = HKDF-SHA256(master key, salt=archive salt, info="SecureBackup archive")
+#   segment key = HKDF-Expand(archive key, info="SecureBackup segment" | counter(8))
+# The master salt comes from the keycheck file when there is one, so every archive of an
+# installation shares it and only the first one per session pays for scrypt. The salt and
+# cost parameters are recorded in each header, so archives stay readable anywhere.
+
+
+class KdfParams(NamedTuple):
+    log2n: int = 14
+    r: int = 8
+    p: int = 1
+
+
+MASTER_KEY_TTL = 30 * 60  # seconds a derived master key stays cached
+
+_kdf_params = KdfParams()
+_session_salt = os.urandom(16)
+_cache_secret = os.urandom(32)
+_key_cache: Dict[Tuple[bytes, bytes, KdfParams], Tuple[bytes, float]] = {}
+_key_lock = threading.Lock()
+
+
+def _reasonable(params: KdfParams) -> bool:
+    # Headers record the cost unauthenticated, so readers hold them to the same bounds as writers.
+    return 10 <= params.log2n <= 24 and 1 <= params.r <= 32 and 1 <= params.p <= 16
+
+
+def set_kdf_params(log2n: int = 14, r: int = 8, p: int = 1) -> None:
+    """Sets the scrypt cost used for new master keys (keychecks and archives written from now on)."""
+    params = KdfParams(int(log2n), int(r), int(p))
+    if not _reasonable(params):
+        raise ValueError(f"Unreasonable scrypt parameters {params}")
+    global _kdf_params
+    _kdf_params = params
+
+
+def kdf_params() -> KdfParams:
+    """The scrypt cost new master keys are derived with."""
+    return _kdf_params
+
+
+def master_key(password: str, salt: bytes, params: KdfParams) -> bytes:
+    """scrypt master key, served from the in-process cache while it has not expired."""
+    # The cache is keyed by a MAC of the password rather than the password itself.
+    tag = std_hmac.new(_cache_secret, password.encode("utf-8"), hashlib.sha256).digest()
+    cache_key = (tag, salt, params)
+    now = time.monotonic()
+    with _key_lock:
+        for k in [k for k, (_, expires) in _key_cache.items() if expires <= now]:
+            del _key_cache[k]
+        if cache_key in _key_cache:
+            return _key_cache[cache_key][0]
+        key = derive_key(password, salt, n=2**params.log2n, r=params.r, p=params.p)
+        _key_cache[cache_key] = (key, now + MASTER_KEY_TTL)
+        return key
+
+
+def forget_keys() -> None:
+    """Drops every cached master key."""
+    with _key_lock:
+        _key_cache.clear()
+
+
+def _hkdf(key: bytes, salt: Optional[bytes], info: bytes) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info, backend=backend).derive(key)
+
+
+def _master_salt() -> bytes:
+    """The installation's master salt from the keycheck file, or a per-process one without it."""
+    try:
+        blob = KEYCHECK_PATH.read_bytes()
+    except OSError:
+        return _session_salt
+    if blob[:4] == KEYCHECK_MAGIC and len(blob) >= KEYCHECK_HEADER.size:
+        return KEYCHECK_HEADER.unpack_from(blob)[4]
+    return _session_salt
+
 def _cipher(key: bytes, iv: bytes):
     return Cipher(algorithms.AES(key), modes.GCM(iv), backend=backend)  
 
 # We use a simple verifier: create random 32 bytes, encrypt with derived key, store as keycheck.bin.
 # Later, on password entry, attempt to decrypt — if it fails, password is wrong.
+# file format: magic(4)=SKC2 | log2(n)(1) | r(1) | p(1) | master salt(16) | nonce(12) | ciphertext+tag(48)
+# encrypted with HKDF(master key, info="SecureBackup keycheck"). The older SKCK format
+# (magic | salt(16) | iv(12) | tag(16) | ct(32), keyed by scrypt directly) is still accepted.
+
+KEYCHECK_MAGIC = b"SKC2"
+KEYCHECK_HEADER = struct.Struct(">4sBBB16s")
+
+
+def _write_keycheck(password: str) -> None:
+    salt = os.urandom(16)
+    header = KEYCHECK_HEADER.pack(KEYCHECK_MAGIC, *_kdf_params, salt)
+    key = _hkdf(master_key(password, salt, _kdf_params), None, b"SecureBackup keycheck")
+    KEYCHECK_PATH.write_bytes(header + encrypt_blob(key, os.urandom(32), header))
 
 
 def ensure_keycheck(password: str) -> None:
     if KEYCHECK_PATH.exists():
-        return  
-    salt = os.urandom(16)
-    key = derive_key(password, salt)
-    iv = os.urandom(12)
-    verify_plain = os.urandom(32)
-    encryptor = _cipher(key, iv).encryptor()
-    ct = encryptor.update(verify_plain) + encryptor.finalize()
-    tag = encryptor.tag
-    # file format: magic(4) | salt(16) | iv(12) | tag(16) | ct(32)
-    KEYCHECK_PATH.write_bytes(b"SKCK" + salt + iv + tag + ct)
+        return
+    _write_keycheck(password)
 
 
 def verify_password(password: str) -> bool:
     if not KEYCHECK_PATH.exists():
         return True # first run (will be created by ensure_keycheck)
     blob = KEYCHECK_PATH.read_bytes()
+    if blob[:4] == KEYCHECK_MAGIC and len(blob) > KEYCHECK_HEADER.size:
+        _, log2n, r, p, salt = KEYCHECK_HEADER.unpack_from(blob)
+        header = blob[:KEYCHECK_HEADER.size]
+        if not _reasonable(KdfParams(log2n, r, p)):
+            return False
+        try:
+            key = _hkdf(master_key(password, salt, KdfParams(log2n, r, p)), None, b"SecureBackup keycheck")
+            decrypt_blob(key, blob[KEYCHECK_HEADER.size:], header)
+            return True
+        except Exception:
+            return False
     if len(blob) < 4 + 16 + 12 + 16 + 32 or blob[:4] != b"SKCK":
         return False
     salt = blob[4:20]
@@ -54,59 +161,426 @@ def verify_password(password: str) -> bool:
     try:
         key = derive_key(password, salt)
         decryptor = _cipher(key, iv).decryptor()
-        decryptor.authenticate_tag(tag)
-        _ = decryptor.update(ct) + decryptor.finalize()
-        return True
+        _ = decryptor.update(ct) + decryptor.finalize_with_tag(tag)
     except Exception:
         return False
+    # Upgrade to the cached master-key format now that the password is known to be right.
+    _write_keycheck(password)
+    return True
     
-# File encryption format for backups (.sbk):
+# Legacy file encryption format for backups (.sbk), still readable:
 # magic(4)=SBK1 | salt(16) | iv(12) | tag(16) | ciphertext(streamed)
 
 
 HEADER_MAGIC = b"SBK1"
 HEADER_LEN = 4 + 16 + 12 + 16 # 48 bytes
 
-def encrypt_file(plaintext_path: Path, ciphertext_path: Path, password: str) -> None:
-    salt = os.urandom(16)
-    iv = os.urandom(12)
-    key = derive_key(password, salt)
-
-    cipher = _cipher(key, iv)
-    encryptor = cipher.encryptor()
+class DecryptingReader:
+    """
+    Read-only file object that decrypts an SBK1 container as it is read.
+    The GCM tag is checked when the ciphertext is exhausted; read() raises
+    InvalidTag at that point if the file was tampered with.
+    """
 
-    with open(plaintext_path, "rb") as fin, open(ciphertext_path, "wb") as fout:
-        # Write provisional header with zero tag; we'll seek back to write the real tag after finalize.
-        fout.write(HEADER_MAGIC + salt + iv + (b"\x00" * 16))
-        while True:
-            chunk = fin.read(CHUNK_SIZE)
-            if not chunk:
-                break
-            data = encryptor.update(chunk)
-            if data:
-                fout.write(data)
-        encryptor.finalize()
-        tag = encryptor.tag
-        # Seek to tag position and write it
-        fout.seek(4 + 16 + 12)
-        fout.write(tag)
-
-def decrypt_file(ciphertext_path: Path, out_plain_path: Path, password: str) -> None:
-    with open(ciphertext_path, "rb") as fin, open(out_plain_path, "wb") as fout:
-        header = fin.read(HEADER_LEN)
+    def __init__(self, fileobj, password: str, magic: bytes = b""):
+        header = magic + read_exact(fileobj, HEADER_LEN - len(magic))
         if len(header) != HEADER_LEN or header[:4] != HEADER_MAGIC:
             raise ValueError("Not a SecureBackup file or header corrupted")
         salt = header[4:20]
         iv = header[20:32]
         tag = header[32:48]
         key = derive_key(password, salt)
-        cipher = Cipher(algorithms.AES(key), modes.GCM(iv, tag))
-        decryptor = cipher.decryptor()
+        self._fin = fileobj
+        self._decryptor = Cipher(algorithms.AES(key), modes.GCM(iv, tag), backend=backend).decryptor()
+        self._pending = b""
+        self._eof = False
+        self.closed = False
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size < 0 or len(self._pending) < size):
+            chunk = self._fin.read(CHUNK_SIZE)
+            if not chunk:
+                self._decryptor.finalize()
+                self._eof = True
+                break
+            self._pending += self._decryptor.update(chunk)
+            if size >= 0 and self._pending:
+                break
+        if size < 0 or size >= len(self._pending):
+            data, self._pending = self._pending, b""
+        else:
+            data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def close(self) -> None:
+        self.closed = True
+
+
+# Segmented file format (.sbk, current):
+# magic(4)=SBK2 | kdf(1) | log2(n)(1) | r(1) | p(1) | salt(16) | nonce_prefix(7) | segment_size(4)
+# kdf 2 headers continue with archive salt(16); salt is then the master salt and every segment
+# has its own key from the hierarchy above. kdf 1 headers use scrypt(password, salt) for all segments.
+# Then come the segments, each AES-256-GCM(plaintext[segment_size]) + tag(16).
+# Every segment is authenticated on its own with the (whole) header as associated data.
+# Its nonce is nonce_prefix | counter(4) | last(1), so segments cannot be reordered,
+# and dropping trailing segments fails because the new final segment lacks the last flag.
+# Only the final segment may be shorter than segment_size (it may be empty).
+# A resumed backup continues a container after its last committed segment. It must never
+# re-encrypt a segment whose ciphertext may already be on disk (same key and nonce, different
+# data), which is why only a file ending exactly at a commit is ever resumed.
+
+SEGMENTED_MAGIC = b"SBK2"
+SEGMENTED_HEADER = struct.Struct(">4sBBBB16s7sI")
+KDF_SCRYPT = 1
+KDF_SCRYPT_HKDF = 2
+ARCHIVE_SALT_LEN = 16
+SEGMENT_SIZE = CHUNK_SIZE
+# Largest segment a reader allocates for; the header's segment_size is not authenticated until the first segment is.
+MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+TAG_LEN = 16
+
+_pools = PriorityPools(os.cpu_count() or 1, "sbk-crypto")
+
+
+def _pool() -> ThreadPoolExecutor:
+    # cryptography releases the GIL during AES-GCM, so segments scale across cores.
+    return _pools.get()
+
+
+def _max_inflight() -> int:
+    return 2 * (os.cpu_count() or 1)
+
+
+def _segment_nonce(prefix: bytes, counter: int, last: bool) -> bytes:
+    return prefix + struct.pack(">IB", counter, 1 if last else 0)
+
+
+class _SegmentKeys:
+    """Hands out the AES-GCM instance for each segment of a container."""
+
+    def __init__(self, key: bytes, per_segment: bool):
+        self._key = key
+        self._aead = None if per_segment else AESGCM(key)
+
+    def aead(self, counter: int) -> AESGCM:
+        if self._aead is not None:
+            return self._aead
+        info = b"SecureBackup segment" + counter.to_bytes(8, "big")
+        return AESGCM(HKDFExpand(algorithm=hashes.SHA256(), length=32, info=info, backend=backend).derive(self._key))
+
+
+def _read_segmented_header(fileobj, password: str, magic: bytes = b"") -> Tuple[bytes, bytes, int, _SegmentKeys]:
+    """Parses an SBK2 header. Returns (header bytes, nonce prefix, segment size, keys)."""
+    header = magic + read_exact(fileobj, SEGMENTED_HEADER.size - len(magic))
+    if len(header) != SEGMENTED_HEADER.size or header[:4] != SEGMENTED_MAGIC:
+        raise ValueError("Not a SecureBackup file or header corrupted")
+    _, kdf, log2n, r, p, salt, prefix, segment_size = SEGMENTED_HEADER.unpack(header)
+    if (kdf not in (KDF_SCRYPT, KDF_SCRYPT_HKDF) or not 0 < segment_size <= MAX_SEGMENT_SIZE
+            or not _reasonable(KdfParams(log2n, r, p))):
+        raise ValueError("Unsupported SecureBackup header parameters")
+    if kdf == KDF_SCRYPT:
+        # Older containers: one scrypt key per file, still cached since a restore reads a file more than once.
+        return header, prefix, segment_size, _SegmentKeys(master_key(password, salt, KdfParams(log2n, r, p)), False)
+    archive_salt = read_exact(fileobj, ARCHIVE_SALT_LEN)
+    if len(archive_salt) != ARCHIVE_SALT_LEN:
+        raise ValueError("Not a SecureBackup file or header corrupted")
+    header += archive_salt
+    key = _hkdf(master_key(password, salt, KdfParams(log2n, r, p)), archive_salt, b"SecureBackup archive")
+    return header, prefix, segment_size, _SegmentKeys(key, True)
+
+
+def container_key(fileobj, password: str, info: bytes) -> Tuple[bytes, bytes]:
+    """
+    Reads an SBK2 header and derives the key for info from its archive key, for objects that
+    belong with the container (see volumes.py). Returns (header bytes, key).
+    """
+    header, _, _, keys = _read_segmented_header(fileobj, password)
+    if keys._aead is not None:
+        raise ValueError("This backup format has no archive key")
+    return header, _hkdf(keys._key, None, info)
+
+
+class SegmentedWriter:
+    """
+    Write-only file object producing an SBK2 container.
+    Full segments are encrypted on a thread pool and written in order; no seeking is needed.
+    """
+
+    def __init__(self, fileobj, password: str, segment_size: int = SEGMENT_SIZE, metrics: Optional[Metrics] = None,
+                 hold: int = 0):
+        if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+            raise ValueError(f"Segment size must be between 1 and {MAX_SEGMENT_SIZE} bytes")
+        params = _kdf_params
+        salt = _master_salt()
+        archive_salt = os.urandom(ARCHIVE_SALT_LEN)
+        prefix = os.urandom(7)
+        header = SEGMENTED_HEADER.pack(SEGMENTED_MAGIC, KDF_SCRYPT_HKDF, *params, salt, prefix, segment_size) + archive_salt
+        # Only the first container per session and master salt pays for scrypt.
+        key = _hkdf(master_key(password, salt, params), archive_salt, b"SecureBackup archive")
+        self._setup(fileobj, header, prefix, segment_size, key, metrics, hold)
+        fileobj.write(header)
+
+    def _setup(self, fileobj, header: bytes, prefix: bytes, segment_size: int, key: bytes,
+               metrics: Optional[Metrics], hold: int) -> None:
+        self._metrics = metrics or Metrics()
+        self._header = header
+        self._prefix = prefix
+        self._keys = _SegmentKeys(key, True)
+        # Seals a resumable backup's checkpoint journal; see checkpoint.py.
+        self.checkpoint_key = _hkdf(key, None, b"SecureBackup checkpoint")
+        self._fout = fileobj
+        self._segment_size = segment_size
+        self._buf = bytearray()
+        self._counter = 0
+        self._futures: deque = deque()
+        self._hold = hold
+        self._held: List[bytes] = []
+        self.held = 0
+        self.closed = False
+
+    @classmethod
+    def reopen(cls, fileobj, password: str, metrics: Optional[Metrics] = None, hold: int = 0) -> "SegmentedWriter":
+        """
+        Opens a partly written container (fileobj opened "r+b") to carry on writing it;
+        call rewind() before writing. Only containers with per-segment keys can be reopened.
+        """
+        fileobj.seek(0)
+        header, prefix, segment_size, keys = _read_segmented_header(fileobj, password)
+        if keys._aead is not None:
+            raise ValueError("This backup format cannot be resumed")
+        self = cls.__new__(cls)
+        self._setup(fileobj, header, prefix, segment_size, keys._key, metrics, hold)
+        return self
+
+    @property
+    def header(self) -> bytes:
+        """The container's header, which every segment is authenticated against."""
+        return self._header
+
+    def committed_size(self, segments: int) -> int:
+        """File size of the container after its first segments segments."""
+        return len(self._header) + segments * (self._segment_size + TAG_LEN)
+
+    def rewind(self, segments: int, tail: bytes) -> None:
+        """Continues after the first segments segments, with tail as the not yet encrypted plaintext."""
+        self._fout.seek(self.committed_size(segments))
+        self._fout.truncate()
+        self._counter = segments
+        self._buf = bytearray(tail)
+
+    def writable(self) -> bool:
+        return True
+
+    def _submit(self, data: bytes, last: bool) -> None:
+        nonce = _segment_nonce(self._prefix, self._counter, last)
+        aead = self._keys.aead(self._counter)
+        self._futures.append(_pool().submit(self._metrics.timed, "encrypt", aead.encrypt, nonce, data, self._header))
+        self._counter += 1
+        while len(self._futures) > _max_inflight():
+            self._write_next()
+
+    def _write_next(self) -> None:
+        start = time.perf_counter()
+        ct = self._futures.popleft().result()
+        waited = time.perf_counter() - start
+        self._metrics.add("encrypt", bytes_in=len(ct) - TAG_LEN, bytes_out=len(ct), stall=waited)
+        if self._hold:
+            self._held.append(ct)
+            self.held += len(ct)
+            if self.held > self._hold:
+                self._write_held()
+            return
+        self._write(ct)
+
+    def _write(self, ct: bytes) -> None:
+        start = time.perf_counter()
+        self._fout.write(ct)
+        self._metrics.add("write", seconds=time.perf_counter() - start, bytes_in=len(ct))
+
+    def _write_held(self) -> None:
+        for ct in self._held:
+            self._write(ct)
+        self._held = []
+        self.held = 0
+
+    def commit(self) -> Tuple[int, bytes]:
+        """
+        Writes every full segment so far and syncs the file to disk.
+        Returns (segments on disk, plaintext after them that is not encrypted yet).
+        With hold set, encrypted segments are otherwise kept in memory (up to hold bytes)
+        until the next commit, so a crash rarely leaves anything past the last commit on disk.
+        """
+        while self._futures:
+            self._write_next()
+        self._write_held()
+        self._fout.flush()
+        if hasattr(self._fout, "fsync"):
+            self._fout.fsync()  # pipeline wrappers sync every file they write to
+        else:
+            os.fsync(self._fout.fileno())
+        return self._counter, bytes(self._buf)
+
+    def write(self, data) -> int:
+        self._buf += data
+        # Keep at least one byte back so the final segment is never mistaken for a full one.
+        if len(self._buf) > self._segment_size:
+            # Cut all full segments from one view, then drop them from the buffer in a single move.
+            pos = 0
+            with memoryview(self._buf) as view:
+                while len(self._buf) - pos > self._segment_size:
+                    self._submit(bytes(view[pos:pos + self._segment_size]), last=False)
+                    pos += self._segment_size
+            del self._buf[:pos]
+        return len(data)
+
+    def flush(self) -> None:
+        self._fout.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._submit(bytes(self._buf), last=True)
+        self._buf = bytearray()
+        while self._futures:
+            self._write_next()
+        self._write_held()
+        self._fout.flush()
+
+
+class SegmentedReader:
+    """
+    Read-only file object over an SBK2 container.
+    Segments are read ahead and decrypted on a thread pool; each one is authenticated
+    before any of its bytes are returned, so tampering fails at the affected segment.
+    """
+
+    def __init__(self, fileobj, password: str, magic: bytes = b"", metrics: Optional[Metrics] = None):
+        self._metrics = metrics or Metrics()
+        self._header, self._prefix, segment_size, self._keys = _read_segmented_header(fileobj, password, magic)
+        self._fin = fileobj
+        self._ct_len = segment_size + TAG_LEN
+        self._lookahead = read_exact(fileobj, self._ct_len)
+        self._counter = 0
+        self._done = False
+        self._futures: deque = deque()
+        self._pending = b""
+        self.closed = False
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self) -> None:
+        while not self._done and len(self._futures) < _max_inflight():
+            ct = self._lookahead
+            start = time.perf_counter()
+            nxt = read_exact(self._fin, self._ct_len) if len(ct) == self._ct_len else b""
+            self._metrics.add("read", seconds=time.perf_counter() - start, bytes_in=len(nxt))
+            last = not nxt
+            nonce = _segment_nonce(self._prefix, self._counter, last)
+            aead = self._keys.aead(self._counter)
+            self._futures.append(_pool().submit(self._metrics.timed, "decrypt", aead.decrypt, nonce, ct, self._header))
+            self._counter += 1
+            self._lookahead = nxt
+            self._done = last
+
+    def read(self, size: int = -1) -> bytes:
+        while (size < 0 or len(self._pending) < size) and (self._futures or not self._done):
+            self._fill()
+            start = time.perf_counter()
+            plain = self._futures.popleft().result()
+            self._metrics.add("decrypt", bytes_in=len(plain) + TAG_LEN, bytes_out=len(plain), stall=time.perf_counter() - start)
+            self._pending += plain
+            if size >= 0 and self._pending:
+                break
+        if size < 0 or size >= len(self._pending):
+            data, self._pending = self._pending, b""
+        else:
+            data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class SegmentedRandomAccess:
+    """
+    Random access to the plaintext of an SBK2 container: only the segments covering
+    the requested range are read and authenticated.
+    """
+
+    def __init__(self, fileobj, password: str):
+        fileobj.seek(0)
+        header, self._prefix, self._segment_size, self._keys = _read_segmented_header(fileobj, password)
+        self._header = header
+        self._fin = fileobj
+        self._ct_total = fileobj.seek(0, os.SEEK_END) - len(header)
+        ct_len = self._segment_size + TAG_LEN
+        self._segments = max(1, -(-self._ct_total // ct_len))
+        self.size = self._ct_total - TAG_LEN * self._segments
+        if self.size < 0:
+            raise ValueError("SecureBackup file truncated")
+        self._cache: Dict[int, bytes] = {}
+
+    def _segment(self, index: int) -> bytes:
+        if index not in self._cache:
+            ct_len = self._segment_size + TAG_LEN
+            self._fin.seek(len(self._header) + index * ct_len)
+            ct = read_exact(self._fin, min(ct_len, self._ct_total - index * ct_len))
+            last = index == self._segments - 1
+            if len(self._cache) >= 8:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[index] = self._keys.aead(index).decrypt(_segment_nonce(self._prefix, index, last), ct, self._header)
+        return self._cache[index]
+
+    def pread(self, offset: int, size: int) -> bytes:
+        """Returns up to size plaintext bytes starting at offset."""
+        out = []
+        end = min(offset + size, self.size)
+        while offset < end:
+            index, start = divmod(offset, self._segment_size)
+            piece = self._segment(index)[start:start + end - offset]
+            out.append(piece)
+            offset += len(piece)
+        return b"".join(out)
+
+
+def encrypt_blob(key: bytes, data: bytes, aad: bytes = b"") -> bytes:
+    """Seals a small standalone object: nonce(12) | AES-256-GCM ciphertext + tag."""
+    nonce = os.urandom(12)
+    return nonce + AESGCM(key).encrypt(nonce, data, aad)
+
+
+def decrypt_blob(key: bytes, blob: bytes, aad: bytes = b"") -> bytes:
+    return AESGCM(key).decrypt(blob[:12], blob[12:], aad)
+
+
+def open_reader(fileobj, password: str, metrics: Optional[Metrics] = None):
+    """Returns a decrypting reader for either container format, picked by the file's magic."""
+    magic = read_exact(fileobj, 4)
+    if magic == SEGMENTED_MAGIC:
+        return SegmentedReader(fileobj, password, magic=magic, metrics=metrics)
+    if magic == HEADER_MAGIC:
+        return DecryptingReader(fileobj, password, magic=magic)
+    raise ValueError("Not a SecureBackup file or header corrupted")
+
+
+def encrypt_file(plaintext_path: Path, ciphertext_path: Path, password: str) -> None:
+    # Reading, encryption (on the crypto pool) and writing overlap; see pipeline.py.
+    with ReadAhead(open(plaintext_path, "rb")) as source, WriteBehind(open(ciphertext_path, "wb")) as fout:
+        writer = SegmentedWriter(fout, password)
+        for chunk in source.chunks():
+            writer.write(chunk)
+        writer.close()
+
+def decrypt_file(ciphertext_path: Path, out_plain_path: Path, password: str) -> None:
+    with ReadAhead(open(ciphertext_path, "rb")) as source, WriteBehind(open(out_plain_path, "wb")) as fout:
+        reader = open_reader(source, password)
         while True:
-            chunk = fin.read(CHUNK_SIZE)
+            chunk = reader.read(CHUNK_SIZE)
             if not chunk:
                 break
-            data = decryptor.update(chunk)
-            if data:
-                fout.write(data)
-        decryptor.finalize()
\ No newline at end of file
+            fout.write(chunk)
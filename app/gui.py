@@ -3,11 +3,14 @@ import PySimpleGUI as sg
 import threading
 import base64
 from pathlib import Path
-from datetime import datetime
 from .config import load_config, save_config
 from .backup import run_backup
-from .restore import run_restore
+from .restore import run_restore, list_archive, verify_archive
+from .archive import CODECS, DEFAULT_CODEC, resolve_codec
 from .scheduler import BackupScheduler
+from .crypto import set_kdf_params, forget_keys
+from .jobs import get_backup_filename, job_destinations, run_job
+from .metrics import format_progress
 
 try:
     from plyer import notification
@@ -21,13 +24,7 @@ LOADER_GIF = b'R0lGODlhEAAQAPIAAP///wAAAMLCwkJCQgAAAGJiYoKCgpKSkiH/C05FVFNDQVBFM
 
 # --- Helper Functions ---
 
-def get_backup_filename(name: str) -> str:
-    """Generates a unique backup filename with a timestamp."""
-    dt = datetime.now().strftime("%Y%m%d_%H%M%S")
-    sanitized_name = "".join(c for c in name if c.isalnum() or c in (' ', '_', '-')).rstrip()
-    return f"{sanitized_name}.sbk"
-
-def run_backup_threaded(window: sg.Window, sources: list[str], dest: str, password: str, backup_name: str):
+def run_backup_threaded(window: sg.Window, sources: list[str], dest: str, password: str, backup_name: str, codec: str = DEFAULT_CODEC):
     """Runs the backup process in a thread to avoid freezing the GUI."""
     window.write_event_value("-BACKUP_STATUS-", "Starting backup...")
     window["-RUN_BACKUP-"].update(disabled=True)
@@ -35,7 +32,8 @@ def run_backup_threaded(window: sg.Window, sources: list[str], dest: str, passwo
     
     try:
         output_filename = get_backup_filename(backup_name)
-        backup_path = run_backup(sources, dest, password, output_filename)
+        backup_path = run_backup(sources, dest, password, output_filename, codec=codec,
+                                 progress=lambda snap: window.write_event_value("-BACKUP_PROGRESS-", format_progress(snap)))
         result = f"Success! Backup saved to:\n{backup_path}"
         if NOTIFICATIONS_ENABLED:
             notification.notify(title="SecureBackup", message=f"Backup '{backup_name}' completed successfully.", app_name="SecureBackup")
@@ -46,20 +44,48 @@ def run_backup_threaded(window: sg.Window, sources: list[str], dest: str, passwo
             
     window.write_event_value("-BACKUP_COMPLETE-", result)
 
-def run_restore_threaded(window: sg.Window, encrypted_path: str, output_folder: str, password: str):
+def run_restore_threaded(window: sg.Window, encrypted_path: str, output_folder: str, password: str, patterns: list[str] | None = None):
     """Runs the restore process in a thread."""
     window.write_event_value("-RESTORE_STATUS-", "Starting restore...")
     window["-RUN_RESTORE-"].update(disabled=True)
     window["-RESTORE_LOADER-"].update(visible=True)
     
     try:
-        run_restore(encrypted_path, output_folder, password)
+        run_restore(encrypted_path, output_folder, password, patterns=patterns,
+                    progress=lambda snap: window.write_event_value("-RESTORE_PROGRESS-", format_progress(snap)))
         result = f"Success! Files restored to:\n{output_folder}"
     except Exception as e:
         result = f"Error during restore: {e}"
 
     window.write_event_value("-RESTORE_COMPLETE-", result)
 
+def verify_archive_threaded(window: sg.Window, encrypted_path: str, password: str):
+    """Checks a backup end to end in a thread without restoring anything."""
+    window.write_event_value("-RESTORE_STATUS-", "Verifying backup...")
+    window["-VERIFY_BACKUP-"].update(disabled=True)
+    window["-RESTORE_LOADER-"].update(visible=True)
+    try:
+        result = verify_archive(encrypted_path, password, chain=True,
+                                progress=lambda snap: window.write_event_value("-RESTORE_PROGRESS-", format_progress(snap)))
+        result = f"Backup is OK: {result['entries']:,} entries, {result['bytes']:,} bytes checked."
+    except Exception as e:
+        result = f"Verification failed: {str(e) or 'wrong password or the file has been tampered with'}"
+    window.write_event_value("-VERIFY_COMPLETE-", result)
+
+MAX_LISTED_ENTRIES = 500
+
+def list_archive_threaded(window: sg.Window, encrypted_path: str, password: str):
+    """Lists a backup's contents in a thread; uses the archive index, so it is fast even for huge backups."""
+    try:
+        files = list_archive(encrypted_path, password)
+        lines = [f"{f['name']}{'/' if f['type'] == 'dir' else ''}  ({f['size']:,} bytes)" for f in files[:MAX_LISTED_ENTRIES]]
+        if len(files) > MAX_LISTED_ENTRIES:
+            lines.append(f"... and {len(files) - MAX_LISTED_ENTRIES:,} more entries")
+        result = f"{len(files):,} entries:\n" + "\n".join(lines)
+    except Exception as e:
+        result = f"Error listing backup: {e}"
+    window.write_event_value("-RESTORE_STATUS-", result)
+
 
 # --- UI Layout ---
 
@@ -69,6 +95,12 @@ ICON_EDIT = '✏️'
 ICON_DELETE = '🗑️'
 ICON_SAVE = '💾'
 
+DESTINATION_TYPES = {"Archive (.sbk)": "archive", "Deduplicating repository": "repository"}
+DESTINATION_LABELS = {v: k for k, v in DESTINATION_TYPES.items()}
+# Job settings only config.toml sets; editing a job in the GUI keeps them.
+CONFIG_ONLY_KEYS = ("watch_delay", "dictionary", "volume_size_mb", "read_limit_mb", "write_limit_mb", "file_limit",
+                    "background", "shards")
+
 def build_manual_backup_tab():
     return sg.Frame("Manual One-Off Backup", [
         [sg.Text("Sources (files or folders):")],
@@ -76,23 +108,29 @@ def build_manual_backup_tab():
         [sg.Text("Destination Folder:")],
         [sg.Input(key="-MANUAL_DEST-", size=(60,1)), sg.FolderBrowse("Browse")],
         [sg.Text("Backup Name:", tooltip="Used to name the final backup file."), sg.Input("MyBackup", key="-MANUAL_NAME-", size=(25,1))],
+        [sg.Text("Compression:"), sg.Combo(list(CODECS), key="-MANUAL_CODEC-", default_value=DEFAULT_CODEC, readonly=True)],
         [sg.Text("Password:"), sg.Input(password_char="*", key="-MANUAL_PASS-", size=(30,1))],
         [sg.Button("Run Backup Now", key="-RUN_BACKUP-", button_color=("white", "#0078D7"), font=("Segoe UI", 11))],
         [sg.HorizontalSeparator()],
-        [sg.Image(data=LOADER_GIF, key='-BACKUP_LOADER-', visible=False), sg.Text("Status:", font=("Segoe UI", 10, "bold"))],
+        [sg.Image(data=LOADER_GIF, key='-BACKUP_LOADER-', visible=False), sg.Text("Status:", font=("Segoe UI", 10, "bold")),
+         sg.Text("", key="-BACKUP_PROGRESS-", font=("Segoe UI", 10))],
         [sg.Multiline("", key="-BACKUP_STATUS-", size=(80, 5), disabled=True, autoscroll=True, background_color='#333333', text_color='white')]
     ], font=("Segoe UI", 12, "bold"), relief=sg.RELIEF_GROOVE, pad=(10,10))
 
 def build_restore_tab():
     return sg.Frame("Restore from Backup", [
         [sg.Text("Backup File (.sbk):")],
-        [sg.Input(key="-RESTORE_FILE-", size=(60,1)), sg.FileBrowse("Browse", file_types=(("SecureBackup Files", "*.sbk"),))],
+        [sg.Input(key="-RESTORE_FILE-", size=(60,1)), sg.FileBrowse("Browse", file_types=(("SecureBackup Files", "*.sbk"), ("Repository Snapshots", "*.snap")))],
         [sg.Text("Restore to Folder:")],
         [sg.Input(key="-RESTORE_DEST-", size=(60,1)), sg.FolderBrowse("Browse")],
         [sg.Text("Password:"), sg.Input(password_char="*", key="-RESTORE_PASS-", size=(30,1))],
-        [sg.Button("Restore Files", key="-RUN_RESTORE-", button_color=("white", "#107C10"), font=("Segoe UI", 11))],
+        [sg.Text("Only restore:", tooltip="Optional. Paths, folders or patterns like docs/*.txt, separated by ';'"), sg.Input(key="-RESTORE_PATTERNS-", size=(50,1))],
+        [sg.Button("Restore Files", key="-RUN_RESTORE-", button_color=("white", "#107C10"), font=("Segoe UI", 11)),
+         sg.Button("List Contents", key="-LIST_BACKUP-", font=("Segoe UI", 11)),
+         sg.Button("Verify Backup", key="-VERIFY_BACKUP-", font=("Segoe UI", 11), tooltip="Check that the backup restores correctly without writing any files.")],
         [sg.HorizontalSeparator()],
-        [sg.Image(data=LOADER_GIF, key='-RESTORE_LOADER-', visible=False), sg.Text("Status:", font=("Segoe UI", 10, "bold"))],
+        [sg.Image(data=LOADER_GIF, key='-RESTORE_LOADER-', visible=False), sg.Text("Status:", font=("Segoe UI", 10, "bold")),
+         sg.Text("", key="-RESTORE_PROGRESS-", font=("Segoe UI", 10))],
         [sg.Multiline("", key="-RESTORE_STATUS-", size=(80, 5), disabled=True, autoscroll=True, background_color='#333333', text_color='white')]
     ], font=("Segoe UI", 12, "bold"), relief=sg.RELIEF_GROOVE, pad=(10,10))
     
@@ -101,7 +139,7 @@ def build_schedule_tab():
     cfg = load_config()
     jobs = cfg.get("jobs", [])
     job_table_data = [
-        [job.get("name", ""), job.get("frequency", ""), job.get("time", ""), ", ".join(job.get("sources", [])), job.get("destination", "")]
+        [job.get("name", ""), job.get("frequency", ""), job.get("time", ""), ", ".join(job.get("sources", [])), ", ".join(job_destinations(job))]
         for job in jobs if job.get("enabled", True)
     ]
     
@@ -125,11 +163,19 @@ def build_schedule_tab():
             [sg.Text("Name:", size=(12,1)), sg.Input(key="-JOB_NAME-")],
             [sg.Text("Sources:", size=(12,1)), sg.Input(key="-JOB_SRC-")],
             [sg.Push(), sg.FilesBrowse("Browse Files", target="-JOB_SRC-", size=(12,1)), sg.FolderBrowse("Browse Folder", target="-JOB_SRC-", size=(12,1))],
-            [sg.Text("Destination:", size=(12,1)), sg.Input(key="-JOB_DEST-"), sg.FolderBrowse("Browse")],
+            [sg.Text("Destination:", size=(12,1)), sg.Input(key="-JOB_DEST-", tooltip="Separate several destinations with ';' to write each backup to all of them."), sg.FolderBrowse("Browse")],
+            [sg.Text("Store as:", size=(12,1)), sg.Combo(list(DESTINATION_TYPES), key="-JOB_DEST_TYPE-", default_value="Archive (.sbk)", readonly=True,
+                                                          tooltip="A repository stores each unique chunk once, so repeat backups only add changed data.")],
             [sg.Text("Frequency:", size=(12,1)), sg.Combo(["Daily", "Weekly"], key="-JOB_FREQ-", default_value="Daily", enable_events=True)],
             [sg.Text("Time:", size=(12,1)), sg.Combo([f"{h:02d}" for h in range(24)], key="-JOB_HOUR-", default_value="10"), sg.Text(":"), sg.Combo([f"{m:02d}" for m in range(0,60,5)], key="-JOB_MIN-", default_value="00")],
             [sg.Text("Day of week:", size=(12,1), key="-JOB_DOW_TEXT-", visible=False), sg.Combo(["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"], key="-JOB_DOW-", visible=False)],
+            [sg.Text("Compression:", size=(12,1)), sg.Combo(list(CODECS), key="-JOB_CODEC-", default_value=DEFAULT_CODEC, readonly=True), sg.Text("Level:", tooltip="Leave empty for the codec's default."), sg.Input(key="-JOB_LEVEL-", size=(4,1))],
             [sg.Text("Password:", size=(12,1)), sg.Input(password_char="*", key="-JOB_PASS-")],
+            [sg.Checkbox("Incremental (only back up changes since the last run)", default=False, key="-JOB_INCREMENTAL-"),
+             sg.Checkbox("Compare content hashes", default=False, key="-JOB_HASH-", tooltip="Skip files whose timestamp changed but content did not.")],
+            [sg.Checkbox("Verify each backup after it is written", default=False, key="-JOB_VERIFY-"),
+             sg.Checkbox("Watch for changes", default=False, key="-JOB_WATCH-",
+                         tooltip="Incremental jobs: track changes as they happen and back them up once they settle, without rescanning the sources.")],
             [sg.Checkbox("Enable this job", default=True, key="-JOB_ENABLED-")],
             [sg.Button(f"{ICON_SAVE} Save Job", key="-SAVE_JOB-", button_color=("white", "#107C10")), sg.Button("Cancel", key="-CANCEL_EDIT-")]
         ], font=("Segoe UI", 12, "bold"), relief=sg.RELIEF_GROOVE, pad=(10,10), key="-JOB_EDITOR-", visible=False)]
@@ -156,18 +202,20 @@ def main():
     # ... (event loop needs minor changes)
     cfg = load_config()
     jobs = cfg.get("jobs", [])
-    scheduler = BackupScheduler()
+    set_kdf_params(**cfg.get("kdf", {}))
+    sched_cfg = cfg.get("scheduler", {})
+    scheduler = BackupScheduler(sched_cfg.get("max_concurrent", 2), sched_cfg.get("per_device", 1),
+                                sched_cfg.get("memory_budget_mb", 0) * 1024 * 1024)
     scheduler.start()
     
     editing_job_index = None
 
-    def create_job_function(job: dict):
+    def create_job_function(job: dict, watcher=None):
         # ... (unchanged)
         def job_fn():
             try:
                 backup_name = job["name"]
-                output_filename = get_backup_filename(backup_name)
-                run_backup(job["sources"], job["destination"], job["password"], output_filename)
+                run_job(job, watcher=watcher)
                 if NOTIFICATIONS_ENABLED:
                     notification.notify(title="SecureBackup", message=f"Scheduled backup '{backup_name}' completed successfully.", app_name="SecureBackup")
             except Exception:
@@ -178,7 +226,8 @@ def main():
     for job in jobs:
         if job.get("enabled", True):
             cron_expr = BackupScheduler.cron_from_job(job)
-            scheduler.add_or_update_job(job['name'], cron_expr, create_job_function(job))
+            watcher = scheduler.watch(job) if job.get("watch") else None
+            scheduler.add_or_update_job(job['name'], cron_expr, create_job_function(job, watcher), destination=job_destinations(job))
             
     while True:
         event, values = window.read()
@@ -191,15 +240,19 @@ def main():
             dest = values["-MANUAL_DEST-"].strip()
             name = values["-MANUAL_NAME-"].strip()
             password = values["-MANUAL_PASS-"]
+            codec = values["-MANUAL_CODEC-"] or DEFAULT_CODEC
             if not all([sources, dest, name, password]):
                 sg.popup_error("All fields (Sources, Destination, Name, Password) are required.")
             else:
-                threading.Thread(target=run_backup_threaded, args=(window, sources, dest, password, name), daemon=True).start()
+                threading.Thread(target=run_backup_threaded, args=(window, sources, dest, password, name, codec), daemon=True).start()
 
         if event == "-BACKUP_STATUS-":
             window["-BACKUP_STATUS-"].update(value=values[event], append=True)
             window["-BACKUP_STATUS-"].update("\n")
 
+        if event in ("-BACKUP_PROGRESS-", "-RESTORE_PROGRESS-"):
+            window[event].update(values[event])
+
         if event == "-BACKUP_COMPLETE-":
             ### CHANGE ### Hide loader on completion
             window["-BACKUP_LOADER-"].update(visible=False)
@@ -211,11 +264,34 @@ def main():
             encrypted_file = values["-RESTORE_FILE-"].strip()
             dest_folder = values["-RESTORE_DEST-"].strip()
             password = values["-RESTORE_PASS-"]
+            patterns = [p.strip() for p in values["-RESTORE_PATTERNS-"].split(';') if p.strip()] or None
             if not all([encrypted_file, dest_folder, password]):
                 sg.popup_error("All fields (Backup File, Restore Folder, Password) are required.")
             else:
-                threading.Thread(target=run_restore_threaded, args=(window, encrypted_file, dest_folder, password), daemon=True).start()
+                threading.Thread(target=run_restore_threaded, args=(window, encrypted_file, dest_folder, password, patterns), daemon=True).start()
+
+        if event == "-LIST_BACKUP-":
+            encrypted_file = values["-RESTORE_FILE-"].strip()
+            password = values["-RESTORE_PASS-"]
+            if not all([encrypted_file, password]):
+                sg.popup_error("Backup File and Password are required to list its contents.")
+            else:
+                threading.Thread(target=list_archive_threaded, args=(window, encrypted_file, password), daemon=True).start()
                 
+        if event == "-VERIFY_BACKUP-":
+            encrypted_file = values["-RESTORE_FILE-"].strip()
+            password = values["-RESTORE_PASS-"]
+            if not all([encrypted_file, password]):
+                sg.popup_error("Backup File and Password are required to verify it.")
+            else:
+                threading.Thread(target=verify_archive_threaded, args=(window, encrypted_file, password), daemon=True).start()
+
+        if event == "-VERIFY_COMPLETE-":
+            window["-RESTORE_LOADER-"].update(visible=False)
+            window["-RESTORE_STATUS-"].update(value=values[event], append=True)
+            window["-RESTORE_STATUS-"].update("\n")
+            window["-VERIFY_BACKUP-"].update(disabled=False)
+
         if event == "-RESTORE_STATUS-":
             window["-RESTORE_STATUS-"].update(value=values[event], append=True)
             window["-RESTORE_STATUS-"].update("\n")
@@ -230,8 +306,14 @@ def main():
         if event == "-ADD_JOB-":
             editing_job_index = None
             window["-JOB_EDITOR-"].update(visible=True)
-            for key in ["-JOB_NAME-", "-JOB_SRC-", "-JOB_DEST-", "-JOB_PASS-"]:
+            for key in ["-JOB_NAME-", "-JOB_SRC-", "-JOB_DEST-", "-JOB_PASS-", "-JOB_LEVEL-"]:
                 window[key].update("")
+            window["-JOB_CODEC-"].update(DEFAULT_CODEC)
+            window["-JOB_DEST_TYPE-"].update(DESTINATION_LABELS["archive"])
+            window["-JOB_INCREMENTAL-"].update(False)
+            window["-JOB_HASH-"].update(False)
+            window["-JOB_VERIFY-"].update(False)
+            window["-JOB_WATCH-"].update(False)
             window["-JOB_ENABLED-"].update(True)
 
         if event == "-EDIT_JOB-":
@@ -244,13 +326,20 @@ def main():
             
             window["-JOB_NAME-"].update(job.get("name", ""))
             window["-JOB_SRC-"].update(";".join(job.get("sources", [])))
-            window["-JOB_DEST-"].update(job.get("destination", ""))
+            window["-JOB_DEST-"].update(";".join(job_destinations(job)))
             window["-JOB_PASS-"].update(job.get("password", ""))
+            window["-JOB_CODEC-"].update(job.get("codec", DEFAULT_CODEC))
+            window["-JOB_LEVEL-"].update(str(job["level"]) if "level" in job else "")
             window["-JOB_FREQ-"].update(job.get("frequency", "Daily"))
             hour, minute = job.get("time", "10:00").split(":")
             window["-JOB_HOUR-"].update(hour)
             window["-JOB_MIN-"].update(minute)
             window["-JOB_DOW-"].update(job.get("day", "Monday"))
+            window["-JOB_DEST_TYPE-"].update(DESTINATION_LABELS.get(job.get("destination_type", "archive")))
+            window["-JOB_INCREMENTAL-"].update(job.get("incremental", False))
+            window["-JOB_HASH-"].update(job.get("content_hash", False))
+            window["-JOB_VERIFY-"].update(job.get("verify", False))
+            window["-JOB_WATCH-"].update(job.get("watch", False))
             window["-JOB_ENABLED-"].update(job.get("enabled", True))
             
             is_weekly = job.get("frequency") == "Weekly"
@@ -265,9 +354,9 @@ def main():
             if sg.popup_yes_no("Are you sure you want to delete the selected job?") == "Yes":
                 job_to_delete = jobs.pop(values["-JOBTABLE-"][0])
                 scheduler.remove_job(job_to_delete['name'])
-                save_config({"jobs": jobs})
+                save_config({**cfg, "jobs": jobs})
                 window["-JOBTABLE-"].update([
-                    [j.get("name", ""), j.get("frequency", ""), j.get("time", ""), ", ".join(j.get("sources", [])), j.get("destination", "")]
+                    [j.get("name", ""), j.get("frequency", ""), j.get("time", ""), ", ".join(j.get("sources", [])), ", ".join(job_destinations(j))]
                     for j in jobs if j.get("enabled", True)
                 ])
 
@@ -275,20 +364,37 @@ def main():
             job_data = {
                 "name": values["-JOB_NAME-"].strip(),
                 "sources": [s.strip() for s in values["-JOB_SRC-"].split(';') if s.strip()],
-                "destination": values["-JOB_DEST-"].strip(),
+                "destination": [d.strip() for d in values["-JOB_DEST-"].split(';') if d.strip()],
+                "destination_type": DESTINATION_TYPES.get(values["-JOB_DEST_TYPE-"], "archive"),
                 "frequency": values["-JOB_FREQ-"],
                 "time": f"{values['-JOB_HOUR-']}:{values['-JOB_MIN-']}",
                 "day": values["-JOB_DOW-"] if values["-JOB_FREQ-"] == "Weekly" else "*",
                 "password": values["-JOB_PASS-"],
+                "codec": values["-JOB_CODEC-"] or DEFAULT_CODEC,
+                "incremental": values["-JOB_INCREMENTAL-"],
+                "content_hash": values["-JOB_HASH-"],
+                "verify": values["-JOB_VERIFY-"],
+                "watch": values["-JOB_WATCH-"],
                 "enabled": values["-JOB_ENABLED-"]
             }
+            if len(job_data["destination"]) == 1:
+                job_data["destination"] = job_data["destination"][0]  # config.toml keeps a single destination as a string
             if not all([job_data['name'], job_data['sources'], job_data['destination'], job_data['password']]):
                 sg.popup_error("Name, Sources, Destination, and Password are required.")
                 continue
+            level = values["-JOB_LEVEL-"].strip()
+            if level:
+                try:
+                    _, job_data["level"] = resolve_codec(job_data["codec"], level)
+                except ValueError as e:
+                    sg.popup_error(str(e))
+                    continue
 
             if editing_job_index is not None:
                 old_job_name = jobs[editing_job_index]['name']
                 scheduler.remove_job(old_job_name)
+                # Settings the editor has no field for stay as they were in config.toml.
+                job_data = {**{k: v for k, v in jobs[editing_job_index].items() if k in CONFIG_ONLY_KEYS}, **job_data}
                 jobs[editing_job_index] = job_data
             else:
                 if any(j['name'] == job_data['name'] for j in jobs):
@@ -296,17 +402,18 @@ def main():
                     continue
                 jobs.append(job_data)
 
-            save_config({"jobs": jobs})
+            save_config({**cfg, "jobs": jobs})
             
             if job_data['enabled']:
                 cron = BackupScheduler.cron_from_job(job_data)
-                scheduler.add_or_update_job(job_data['name'], cron, create_job_function(job_data))
+                watcher = scheduler.watch(job_data) if job_data["watch"] else None
+                scheduler.add_or_update_job(job_data['name'], cron, create_job_function(job_data, watcher), destination=job_destinations(job_data))
             else:
                 scheduler.remove_job(job_data['name'])
 
             window["-JOB_EDITOR-"].update(visible=False)
             window["-JOBTABLE-"].update([
-                [j.get("name", ""), j.get("frequency", ""), j.get("time", ""), ", ".join(j.get("sources", [])), j.get("destination", "")]
+                [j.get("name", ""), j.get("frequency", ""), j.get("time", ""), ", ".join(j.get("sources", [])), ", ".join(job_destinations(j))]
                 for j in jobs if j.get("enabled", True)
             ])
             editing_job_index = None
@@ -321,6 +428,7 @@ def main():
             window["-JOB_DOW-"].update(visible=is_weekly)
 
     scheduler.stop()
+    forget_keys()
     window.close()
 
 if __name__ == "__main__":
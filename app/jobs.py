@@ -0,0 +1,105 @@
+from __future__ import annotations
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+from .metrics import Progress
+from .throttle import Throttle
+
+if TYPE_CHECKING:
+    from .watcher import Watcher
+
+# Running the jobs stored in config.toml, shared by the GUI, the CLI and the daemon.
+
+
+def get_backup_filename(name: str, timestamped: bool = False) -> str:
+    """Generates a backup filename; incremental chains need the timestamp so runs don't overwrite each other."""
+    dt = datetime.now().strftime("%Y%m%d_%H%M%S")
+    sanitized_name = "".join(c for c in name if c.isalnum() or c in (' ', '_', '-')).rstrip()
+    if timestamped:
+        return f"{sanitized_name}_{dt}.sbk"
+    return f"{sanitized_name}.sbk"
+
+
+def job_destinations(job: Dict[str, Any]) -> List[str]:
+    """A job's destination folders; "destination" is either one folder or a list of them."""
+    destination = job.get("destination") or []
+    return [destination] if isinstance(destination, str) else list(destination)
+
+
+def _volume_size(job: Dict[str, Any]) -> Optional[int]:
+    """Bytes per volume for jobs that split their backups ("volume_size_mb"), else None."""
+    size_mb = job.get("volume_size_mb")
+    return int(size_mb * 1024 * 1024) if size_mb else None
+
+
+def _shards(job: Dict[str, Any]) -> int:
+    """
+    Worker processes for jobs that shard their backups ("shards"), else 1. More than the
+    CPU cores cannot run at once, so the count is capped there.
+    """
+    shards = job.get("shards", 1)
+    if isinstance(shards, bool) or not isinstance(shards, int) or shards < 1:
+        raise ValueError(f"Job '{job.get('name')}': shards must be a whole number of at least 1, not {shards!r}.")
+    cores = os.cpu_count() or 1
+    if shards > cores:
+        logging.warning(f"Job '{job.get('name')}' asks for {shards} shards but there are only {cores} CPU cores; "
+                        f"using {cores}.")
+        return cores
+    return shards
+
+
+def find_job(jobs: List[Dict[str, Any]], name: str) -> Optional[Dict[str, Any]]:
+    return next((j for j in jobs if j.get("name") == name), None)
+
+
+def run_job(job: Dict[str, Any], progress: Optional[Progress] = None, watcher: Optional[Watcher] = None) -> Path:
+    """
+    Runs one configured job and returns the backup (or repository snapshot) it wrote; with
+    several destinations, the copy in the first one.
+    Jobs with "verify" set read each new copy back and check it before reporting success.
+    progress receives the run's metrics for archive destinations. An incremental job's watcher
+    (see watcher.py) tells the run which paths to look at instead of scanning all its sources.
+    Jobs with I/O limits or background priority run under a Throttle (see throttle.py).
+    """
+    throttle = Throttle.from_job(job)
+    if throttle is None:
+        return _run_job(job, progress, watcher, None)
+    return throttle.call(_run_job, job, progress, watcher, throttle)
+
+
+def _run_job(job: Dict[str, Any], progress: Optional[Progress], watcher: Optional[Watcher],
+             throttle: Optional[Throttle]) -> Path:
+    destinations = job_destinations(job)
+    if job.get("destination_type") == "repository":
+        # Each repository deduplicates against its own chunks, so there is no shared stream to tee.
+        from .repository import run_repository_backup
+        paths = [run_repository_backup(job["sources"], destination, job["password"],
+                                       codec=job.get("codec"), level=job.get("level"),
+                                       dictionary=job.get("dictionary", False), throttle=throttle)
+                 for destination in destinations]
+    else:
+        from .backup import DestinationError, run_backup
+        incremental = job.get("incremental", False)
+        output_filename = get_backup_filename(job["name"], timestamped=incremental)
+        seq, changes = watcher.take() if watcher is not None and incremental else (0, None)
+        try:
+            path = run_backup(job["sources"], destinations, job["password"], output_filename,
+                              codec=job.get("codec"), level=job.get("level"),
+                              job_name=job["name"], incremental=incremental, content_hash=job.get("content_hash", False),
+                              progress=progress, changes=changes, volume_size=_volume_size(job),
+                              throttle=throttle, shards=_shards(job))
+        except DestinationError:
+            # The manifest already covers this run, so its changes are backed up.
+            if watcher is not None and incremental:
+                watcher.done(seq)
+            raise
+        if watcher is not None and incremental:
+            watcher.done(seq)
+        paths = [Path(destination) / path.name for destination in destinations]
+    if job.get("verify", False):
+        from .restore import verify_archive
+        for path in paths:
+            verify_archive(str(path), job["password"])
+    return paths[0]
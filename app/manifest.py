@@ -0,0 +1,70 @@
+from __future__ import annotations
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from .crypto import SegmentedWriter, open_reader
+from .utils import MANIFEST_DIR, CHUNK_SIZE
+
+# Per-job manifest for incremental backups, stored encrypted under MANIFEST_DIR:
+# {"job": name, "entries": {arcname: [size, mtime_ns, inode, sha256 or None]},
+#  "archives": [{"file": archive filename, "kind": "full"|"incremental", "time": iso timestamp}, ...]}
+# "archives" is the chain since the last full backup; the last one is the parent of the next run.
+
+MANIFEST_VERSION = 1
+
+
+def manifest_path(job_name: str) -> Path:
+    safe = "".join(c for c in job_name if c.isalnum() or c in ("_", "-"))[:40]
+    digest = hashlib.sha256(job_name.encode("utf-8")).hexdigest()[:12]
+    return MANIFEST_DIR / f"{safe}_{digest}.sbm"
+
+
+def signature(st: os.stat_result) -> List[Any]:
+    """The [size, mtime_ns, inode] an entry is compared by."""
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def empty_manifest(job_name: str) -> Dict[str, Any]:
+    return {"version": MANIFEST_VERSION, "job": job_name, "entries": {}, "archives": []}
+
+
+def load_manifest(job_name: str, password: str) -> Optional[Dict[str, Any]]:
+    """Returns the job's manifest, or None if there is none or it cannot be decrypted."""
+    path = manifest_path(job_name)
+    if not path.exists():
+        return None
+    try:
+        with open(path, "rb") as f:
+            manifest = json.loads(open_reader(f, password).read())
+    except Exception as e:
+        logging.warning(f"Could not read manifest for job '{job_name}', a full backup will be made. Reason: {e}")
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(job_name: str, manifest: Dict[str, Any], password: str) -> None:
+    path = manifest_path(job_name)
+    tmp = path.with_suffix(".tmp")
+    data = json.dumps(manifest, separators=(",", ":")).encode("utf-8")
+    with open(tmp, "wb") as f:
+        writer = SegmentedWriter(f, password)
+        for i in range(0, len(data), CHUNK_SIZE):
+            writer.write(data[i:i + CHUNK_SIZE])
+        writer.close()
+    os.replace(tmp, path)
+
+
+def file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,145 @@
+from __future__ import annotations
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+from .utils import LOG_DIR
+
+# Per-run pipeline metrics. Each stage (scan, read, compress, encrypt, write on backup;
+# read, decrypt, decompress, write on restore) accumulates
+#   seconds     time spent doing the work (summed over pool threads, so it can exceed wall time)
+#   bytes_in    bytes handed to the stage, bytes_out what it produced
+#   stall       seconds the pipeline waited on the stage because its queue was full or empty
+# Runs with a name also append JSON lines to LOG_DIR/metrics/<time>_<kind>_<name>.jsonl:
+# {"event": "progress", ...} at most every REPORT_INTERVAL seconds, then {"event": "summary", ...}.
+
+METRICS_DIR = LOG_DIR / "metrics"
+REPORT_INTERVAL = 1.0
+MAX_METRICS_FILES = 500
+
+Progress = Callable[[Dict[str, Any]], None]
+
+
+class Metrics:
+    def __init__(self, kind: str = "", name: str = "", progress: Optional[Progress] = None, total_bytes: int = 0):
+        self.kind = kind
+        self.name = name
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self._progress = progress
+        self._stages: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._last_report = 0.0
+        self.path: Optional[Path] = None
+        if kind and name:
+            METRICS_DIR.mkdir(exist_ok=True)
+            safe = "".join(c for c in name if c.isalnum() or c in ("_", "-"))[:40]
+            self.path = METRICS_DIR / f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{kind}_{safe}.jsonl"
+            # Room for this run's file too.
+            older = sorted(METRICS_DIR.glob("*.jsonl"))
+            for old in older[:max(0, len(older) - MAX_METRICS_FILES + 1)]:
+                old.unlink(missing_ok=True)
+
+    def add(self, stage: str, seconds: float = 0.0, bytes_in: int = 0, bytes_out: int = 0, stall: float = 0.0) -> None:
+        with self._lock:
+            s = self._stages.get(stage)
+            if s is None:
+                s = self._stages[stage] = {"seconds": 0.0, "bytes_in": 0, "bytes_out": 0, "stall": 0.0}
+            s["seconds"] += seconds
+            s["bytes_in"] += bytes_in
+            s["bytes_out"] += bytes_out
+            s["stall"] += stall
+
+    def timed(self, stage: str, fn: Callable, *args):
+        """Calls fn(*args), adding the time it took to stage; safe to submit to a thread pool."""
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.add(stage, seconds=time.perf_counter() - start)
+
+    def file_done(self, size: int) -> None:
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+        self.report()
+
+    def merge(self, snap: Dict[str, Any]) -> None:
+        """Adds the files, bytes and stage totals of another run's snapshot (e.g. a worker process's)."""
+        with self._lock:
+            self.files += snap["files"]
+            self.bytes += snap["bytes"]
+        for stage, s in snap["stages"].items():
+            self.add(stage, **s)
+        self.report(force=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self._start
+        with self._lock:
+            stages = {name: {k: round(v, 4) if isinstance(v, float) else v for k, v in s.items()}
+                      for name, s in self._stages.items()}
+            files, done = self.files, self.bytes
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total_bytes - done) / rate if self.total_bytes and rate > 0 and done < self.total_bytes else None
+        compress = stages.get("compress") or stages.get("decompress")
+        ratio = None
+        if compress and compress["bytes_in"] and compress["bytes_out"]:
+            # Always stored size / raw size, whichever direction the run went.
+            small, big = sorted((compress["bytes_in"], compress["bytes_out"]))
+            ratio = round(small / big, 4)
+        return {"kind": self.kind, "name": self.name, "elapsed": round(elapsed, 3), "files": files, "bytes": done,
+                "total_bytes": self.total_bytes or None, "files_per_s": round(files / elapsed, 1) if elapsed > 0 else 0.0,
+                "mb_per_s": round(rate / 1e6, 2), "eta": round(eta, 1) if eta is not None else None,
+                "ratio": ratio, "stages": stages}
+
+    def _emit(self, event: str, extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        snap = {"event": event, "time": datetime.now().isoformat(timespec="seconds"), **self.snapshot(), **(extra or {})}
+        if self.path is not None:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(snap) + "\n")
+            except OSError as e:
+                logging.warning(f"Could not write metrics to {self.path}. Reason: {e}")
+                self.path = None
+        if self._progress is not None:
+            self._progress(snap)
+        return snap
+
+    def report(self, force: bool = False) -> None:
+        now = time.perf_counter()
+        if not force and now - self._last_report < REPORT_INTERVAL:
+            return
+        self._last_report = now
+        self._emit("progress")
+
+    def close(self, status: str = "ok", error: Optional[str] = None) -> Dict[str, Any]:
+        """Emits and returns the run's summary."""
+        extra = {"status": status}
+        if error:
+            extra["error"] = error
+        return self._emit("summary", extra)
+
+
+def format_progress(snap: Dict[str, Any]) -> str:
+    """One-line status text for the GUI and the CLI."""
+    text = f"{snap['files']:,} files, {snap['bytes'] / 1e6:,.1f} MB at {snap['mb_per_s']:.1f} MB/s"
+    if snap.get("eta") is not None:
+        minutes, seconds = divmod(int(snap["eta"]), 60)
+        text += f", ETA {minutes}:{seconds:02d}"
+    return text
+
+
+def format_stages(snap: Dict[str, Any]) -> str:
+    """Per-stage breakdown for the end-of-run log line."""
+    parts = []
+    for name, s in snap["stages"].items():
+        part = f"{name} {s['seconds']:.2f}s"
+        if s["stall"]:
+            part += f" (waited {s['stall']:.2f}s)"
+        parts.append(part)
+    return ", ".join(parts)
@@ -0,0 +1,409 @@
+from __future__ import annotations
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional
+from .utils import CHUNK_SIZE
+
+# Double-buffered file I/O. ReadAhead keeps the next chunks of an input file loaded on a reader
+# thread and WriteBehind drains output on a writer thread, so the disks stay busy while the
+# CPU works on the chunk in hand, with bounded queues in between. Read buffers come from a
+# small pool and are filled with readinto; the read size follows the measured read speed,
+# aiming at about READ_TARGET seconds of data per read (bigger reads on fast disks, smaller
+# ones where latency dominates). Both wrappers own their file and close it, like io's buffers.
+# FanOut tees one output stream to several WriteBehind targets (multi-destination backups).
+
+MIN_READ = 256 * 1024
+MAX_READ = 8 * 1024 * 1024
+READ_TARGET = 0.05
+READ_DEPTH = 3
+WRITE_BEHIND_BYTES = 32 * 1024 * 1024
+
+
+class BufferPool:
+    """Reusable bytearrays handed back and forth between a producer and a consumer."""
+
+    def __init__(self):
+        self._free: "queue.SimpleQueue[bytearray]" = queue.SimpleQueue()
+
+    def get(self, size: int) -> bytearray:
+        try:
+            buf = self._free.get_nowait()
+        except queue.Empty:
+            return bytearray(size)
+        # Grow rather than resize in place: a consumer may still hold a view of a recycled buffer.
+        return buf if len(buf) >= size else bytearray(size)
+
+    def put(self, buf: bytearray) -> None:
+        self._free.put(buf)
+
+
+class ReadAhead:
+    """
+    Read-only file object that reads fileobj on a background thread, at most depth chunks ahead.
+    chunks() hands out views into pooled buffers without copying; read() copies out of them.
+    chunk_size is the first read size; with adaptive it then tracks the device's throughput.
+    """
+
+    def __init__(self, fileobj, chunk_size: int = CHUNK_SIZE, depth: int = READ_DEPTH, adaptive: bool = True):
+        self._fin = fileobj
+        self._pool = BufferPool()
+        # (buffer, bytes in it, None) per chunk, then (None, 0, None) at the end or (None, 0, error).
+        self._queue: queue.Queue = queue.Queue(depth)
+        self._size = chunk_size
+        self._adaptive = adaptive
+        self._rate: Optional[float] = None
+        self._stop = threading.Event()
+        self._current: Optional[bytearray] = None
+        self._view = memoryview(b"")
+        self._eof = False
+        self.closed = False
+        self._thread = threading.Thread(target=self._run, name="sbk-read", daemon=True)
+        self._thread.start()
+
+    def readable(self) -> bool:
+        return True
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _adapt(self, n: int, elapsed: float) -> None:
+        rate = n / max(elapsed, 1e-6)
+        self._rate = rate if self._rate is None else 0.7 * self._rate + 0.3 * rate
+        size = MIN_READ
+        while size < MAX_READ and size * 2 <= self._rate * READ_TARGET:
+            size *= 2
+        self._size = size
+
+    def _run(self) -> None:
+        try:
+            while not self._stop.is_set():
+                size = self._size
+                buf = self._pool.get(size)
+                start = time.perf_counter()
+                with memoryview(buf) as view:
+                    n = self._fin.readinto(view[:size]) or 0
+                if self._adaptive and n == size:
+                    self._adapt(n, time.perf_counter() - start)
+                if not n:
+                    self._put((None, 0, None))
+                    return
+                if not self._put((buf, n, None)):
+                    return
+        except BaseException as e:
+            self._put((None, 0, e))
+
+    def _advance(self) -> bool:
+        """Recycles the current chunk and moves to the next one; False at the end of the file."""
+        if self._eof:
+            return False
+        self._view.release()
+        if self._current is not None:
+            self._pool.put(self._current)
+            self._current = None
+        buf, n, error = self._queue.get()
+        if error is not None:
+            self._eof = True
+            raise error
+        if buf is None:
+            self._eof = True
+            self._view = memoryview(b"")
+            return False
+        self._current = buf
+        self._view = memoryview(buf)[:n]
+        return True
+
+    def chunks(self) -> Iterator[memoryview]:
+        """Yields the rest of the file; each view is only valid until the next one is requested."""
+        if self._view:
+            yield self._view
+        while self._advance():
+            yield self._view
+
+    def read(self, size: int = -1) -> bytes:
+        out: List[bytes] = []
+        got = 0
+        while size < 0 or got < size:
+            if not self._view and not self._advance():
+                break
+            take = self._view if size < 0 else self._view[:size - got]
+            out.append(bytes(take))
+            got += len(take)
+            self._view = self._view[len(take):]
+        return b"".join(out)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._stop.set()
+        self._view.release()
+        # Unblock the reader if it is waiting for room in the queue.
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
+        self._fin.close()
+
+    def __enter__(self) -> "ReadAhead":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class WriteBehind:
+    """
+    Write-only file object whose writes reach fileobj on a background thread, at most max_bytes
+    behind the caller. Data handed to write() must not be changed afterwards. An error on the
+    writer thread is raised by the next call. flush() waits for everything written so far; seek,
+    truncate and read wait too, then go straight to the file.
+    With stall_timeout, a call that has to wait raises TimeoutError once the writer thread has
+    made no progress for that long (e.g. a hung network share).
+    """
+
+    def __init__(self, fileobj, max_bytes: int = WRITE_BEHIND_BYTES, stall_timeout: Optional[float] = None):
+        self._f = fileobj
+        self._max = max_bytes
+        self._stall = stall_timeout
+        self._items: Deque[bytes] = deque()
+        self._queued = 0
+        self._progress = 0
+        self._error: Optional[BaseException] = None
+        self._stopping = False
+        self._aborted = False
+        self._cond = threading.Condition()
+        self.closed = False
+        self._thread = threading.Thread(target=self._run, name="sbk-write", daemon=True)
+        self._thread.start()
+
+    def writable(self) -> bool:
+        return True
+
+    def _check(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._items and not self._stopping and not self._aborted:
+                    self._cond.wait()
+                if self._aborted:
+                    break
+                if not self._items:
+                    return
+                data = self._items[0]
+            try:
+                self._f.write(data)
+            except BaseException as e:
+                with self._cond:
+                    self._error = e
+                    self._items.clear()
+                    self._queued = 0
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                if self._aborted:
+                    break
+                self._items.popleft()
+                self._queued -= len(data)
+                self._progress += 1
+                self._cond.notify_all()
+        try:
+            self._f.close()
+        except OSError:
+            pass
+
+    def _wait(self, ready) -> None:
+        """Waits, holding the lock, until ready() is true or the writer fails or stalls."""
+        progress = self._progress
+        deadline = time.monotonic() + self._stall if self._stall else None
+        while not ready() and self._error is None:
+            if deadline is None:
+                self._cond.wait()
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"No write progress for {self._stall:.0f} seconds")
+            self._cond.wait(remaining)
+            if self._progress != progress:
+                progress = self._progress
+                deadline = time.monotonic() + self._stall
+        self._check()
+
+    def write(self, data) -> int:
+        n = len(data)
+        with self._cond:
+            self._check()
+            self._wait(lambda: not self._queued or self._queued + n <= self._max)
+            self._items.append(data)
+            self._queued += n
+            self._cond.notify_all()
+        return n
+
+    def _drain(self) -> None:
+        with self._cond:
+            self._wait(lambda: not self._items)
+
+    def flush(self) -> None:
+        self._drain()
+        self._f.flush()
+
+    def fsync(self) -> None:
+        """Flushes and syncs the file to disk."""
+        self.flush()
+        os.fsync(self._f.fileno())
+
+    def fileno(self) -> int:
+        return self._f.fileno()
+
+    def tell(self) -> int:
+        self._drain()
+        return self._f.tell()
+
+    def seek(self, *args) -> int:
+        self._drain()
+        return self._f.seek(*args)
+
+    def truncate(self, *args) -> int:
+        self._drain()
+        return self._f.truncate(*args)
+
+    def read(self, *args) -> bytes:
+        self._drain()
+        return self._f.read(*args)
+
+    def abort(self) -> None:
+        """
+        Drops whatever is still queued and lets go of the file without waiting for the writer
+        thread, which closes it once a write it is stuck in returns.
+        """
+        self.closed = True
+        with self._cond:
+            self._aborted = True
+            self._items.clear()
+            self._queued = 0
+            self._cond.notify_all()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._drain()  # with stall_timeout, gives up on a hung writer instead of joining it
+        except TimeoutError:
+            self.abort()
+            raise
+        except BaseException:
+            pass  # raised again below, once the file is closed
+        self.closed = True
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._f.close()
+        self._check()
+
+    def __enter__(self) -> "WriteBehind":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class FanOut:
+    """
+    Write-only file object copying one stream to several WriteBehind targets, each with its own
+    thread and queue, so a short hiccup on one does not hold up the others. A target that fails
+    (stall_timeout on its WriteBehind turns a hang into a failure) is dropped and logged, and
+    the rest carry on; only when none is left does the call raise, and so does every call
+    after it. names label the targets in failed, which maps each dropped target to its error.
+    """
+
+    def __init__(self, targets: List[WriteBehind], names: List[str]):
+        self.targets = targets
+        self.names = names
+        self.failed: Dict[str, str] = {}
+        self._live = list(range(len(targets)))
+        self.closed = False
+
+    def writable(self) -> bool:
+        return True
+
+    def live(self) -> List[str]:
+        return [self.names[i] for i in self._live]
+
+    def _dead(self) -> OSError:
+        return OSError(f"Every destination failed: {'; '.join(f'{n}: {r}' for n, r in self.failed.items())}")
+
+    def _each(self, fn) -> Any:
+        if not self._live:
+            raise self._dead()
+        result = None
+        for i in list(self._live):
+            try:
+                result = fn(self.targets[i])
+            except Exception as e:
+                reason = str(e) or type(e).__name__
+                logging.error(f"Writing to {self.names[i]} failed, carrying on without it. Reason: {reason}")
+                self.failed[self.names[i]] = reason
+                self._live.remove(i)
+                self.targets[i].abort()
+                if not self._live:
+                    if len(self.targets) == 1:
+                        raise
+                    raise self._dead() from e
+        return result
+
+    def write(self, data) -> int:
+        self._each(lambda t: t.write(data))
+        return len(data)
+
+    def flush(self) -> None:
+        self._each(lambda t: t.flush())
+
+    def fsync(self) -> None:
+        self._each(lambda t: t.fsync())
+
+    def read(self, *args) -> bytes:
+        # Every target holds the same bytes; reading the first is enough.
+        if not self._live:
+            raise self._dead()
+        return self.targets[self._live[0]].read(*args)
+
+    def seek(self, *args) -> int:
+        return self._each(lambda t: t.seek(*args))
+
+    def truncate(self, *args) -> int:
+        return self._each(lambda t: t.truncate(*args))
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._each(lambda t: t.close())
+
+    def abort(self) -> None:
+        self.closed = True
+        for i in self._live:
+            self.targets[i].abort()
+
+    def __enter__(self) -> "FanOut":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if exc[0] is not None and not self._live:
+            self.closed = True  # the error on its way out already says so
+            return
+        self.close()
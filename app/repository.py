@@ -0,0 +1,589 @@
+from __future__ import annotations
+import hashlib
+import hmac
+import json
+import logging
+import os
+import stat
+import struct
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+import pyzstd
+from .archive import compress_block, decompress_block, resolve_codec, match_patterns
+from .scanner import scan
+from .crypto import SegmentedWriter, open_reader, encrypt_blob, decrypt_blob
+from .shards import process_pool
+from .throttle import Throttle, in_background
+
+# Deduplicating repository, an alternative destination to standalone .sbk files:
+#   <repo>/config.sbk          SBK2-encrypted JSON with the random repository keys and chunker seed
+#   <repo>/chunks/ab/<id>      one file per unique chunk
+#   <repo>/snapshots/<t>.snap  one small file per backup, listing every entry and its chunk ids
+# File contents are split with content-defined chunking (a gear rolling hash), so an edit only
+# changes the chunks around it. The hash shifts one bit a byte, so its low bits depend only on
+# the last few bytes: on several cores, worker processes hash slices of a file in parallel and
+# the chunk boundaries are picked from their hits, the same boundaries as hashing in one pass.
+# Chunk ids are HMAC-SHA256(id_key, chunk), which hides content from anyone without the password. Chunks and snapshots are stored as
+#   nonce(12) | AES-256-GCM(enc_key, method(1) | raw_len(4) | compressed bytes)
+# with the chunk id (or "snapshot") as associated data.
+# Jobs with "dictionary" set (zstd only) compress chunks under DICT_MAX_CHUNK, i.e. small files,
+# which carry too little context on their own, with a zstd dictionary trained on the job's files:
+#   <repo>/dicts/<id>.dict     one stored blob per dictionary version, kept while chunks use it
+#   <repo>/dicts/state         {"current": id, "baseline": ratio, "retrain": bool, "versions": [...]}
+# Those chunks use method archive.METHOD_ZSTD_DICT, which names the dictionary by id.
+
+CONFIG_NAME = "config.sbk"
+SNAPSHOT_SUFFIX = ".snap"
+REPO_VERSION = 1
+BLOB_HEADER = struct.Struct(">BI")
+
+MIN_CHUNK = 512 * 1024
+AVG_CHUNK = 1024 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+# Parallel chunking: bytes a worker hashes at a time, and bytes read ahead of the current chunk.
+SLICE_SIZE = 1024 * 1024
+READ_AHEAD = 2 * READ_SIZE
+# Hashing every byte costs workers about twice what the one-pass cut does (it skips MIN_CHUNK
+# bytes a chunk), so worker processes only pay off from this many cores.
+PARALLEL_MIN_CPUS = 3
+
+DICT_MAX_CHUNK = 64 * 1024
+DICT_SIZE = 112 * 1024
+# New small chunks held back to train a dictionary from, and the fewest that training works with.
+DICT_SAMPLE_BYTES = 8 * 1024 * 1024
+DICT_MIN_SAMPLES = 64
+# A run whose small chunks shrink less than the dictionary's first run did by this much retrains it.
+DICT_DRIFT = 0.15
+DICT_MIN_MEASURE = 1024 * 1024
+
+
+def _gear_hits(gear: Sequence[int], mask_s: int, mask_l: int, data: bytes, skip: int,
+               offset: int) -> Tuple[List[int], List[int]]:
+    """
+    Ends (offset-based) of the bytes after data[:skip] where the gear hash hits mask_l, and
+    those where it also hits mask_s. data[:skip] only warms the hash up.
+    """
+    h = 0
+    hits, strong = [], []
+    for i, b in enumerate(data, offset + 1):
+        h = ((h << 1) & mask_s) + gear[b]
+        if not h & mask_l:
+            hits.append(i)
+            if not h & mask_s:
+                strong.append(i)
+    start = bisect_right(hits, offset + skip)
+    return hits[start:], strong[bisect_right(strong, offset + skip):]
+
+
+def chunk_pool() -> Optional[ProcessPoolExecutor]:
+    """Worker processes for Chunker.chunks, or None where hashing in one pass is faster."""
+    workers = os.cpu_count() or 1
+    return process_pool(workers, background=in_background()) if workers >= PARALLEL_MIN_CPUS else None
+
+
+class Chunker:
+    """FastCDC-style content-defined chunking with a normalized gear hash."""
+
+    def __init__(self, seed: bytes, min_size: int = MIN_CHUNK, avg_size: int = AVG_CHUNK, max_size: int = MAX_CHUNK):
+        self.min_size, self.avg_size, self.max_size = min_size, avg_size, max_size
+        self._gear = [int.from_bytes(hashlib.sha256(seed + bytes([i])).digest()[:4], "big") for i in range(256)]
+        bits = avg_size.bit_length() - 1
+        # Harder cut condition before the average size and easier after it keeps sizes close to avg_size.
+        self._mask_s = (1 << (bits + 2)) - 1
+        self._mask_l = (1 << (bits - 2)) - 1
+        # Bytes after which the hash bits under either mask no longer depend on earlier bytes.
+        self._window = self._mask_s.bit_length()
+        self._gear_s = tuple(g & self._mask_s for g in self._gear)
+
+    def _cut(self, data: bytes, start: int, end: int) -> int:
+        """Returns the length of the next chunk starting at data[start]."""
+        n = end - start
+        if n <= self.min_size:
+            return n
+        gear = self._gear_s
+        keep = self._mask_s
+        h = 0
+        i = start + self.min_size
+        normal = start + min(self.avg_size, n)
+        limit = start + min(self.max_size, n)
+        # Iterating a slice is markedly faster in CPython than indexing byte by byte.
+        # Only the bits under mask_s are ever tested and carries only move up, so the hash
+        # keeps just those bits (the same cuts as a 32-bit hash, with smaller ints).
+        mask = self._mask_s
+        for b in data[i:normal]:
+            h = ((h << 1) & keep) + gear[b]
+            i += 1
+            if not h & mask:
+                return i - start
+        mask = self._mask_l
+        for b in data[i:limit]:
+            h = ((h << 1) & keep) + gear[b]
+            i += 1
+            if not h & mask:
+                return i - start
+        return limit - start
+
+    def chunks(self, fileobj, pool: Optional[Executor] = None) -> Iterator[bytes]:
+        """
+        Splits a file into chunks. With pool (see chunk_pool), worker processes hash the data;
+        the chunks are the same either way.
+        """
+        if pool is not None:
+            yield from self._parallel_chunks(fileobj, pool)
+            return
+        buf = b""
+        pos = 0
+        eof = False
+        while True:
+            if not eof and len(buf) - pos < self.max_size:
+                data = fileobj.read(READ_SIZE)
+                if data:
+                    buf = buf[pos:] + data
+                    pos = 0
+                    continue
+                eof = True
+            if pos >= len(buf):
+                return
+            n = self._cut(buf, pos, len(buf))
+            yield buf[pos:pos + n]
+            pos += n
+
+    def _parallel_chunks(self, fileobj, pool: Executor) -> Iterator[bytes]:
+        # buf holds the file from base on; hits/strong are file offsets just past a hash hit.
+        buf = b""
+        base = pos = 0
+        eof = False
+        pending: deque = deque()
+        hits: List[int] = []
+        strong: List[int] = []
+        hashed = 0
+        while True:
+            if not eof and len(buf) - pos < self.max_size + READ_AHEAD:
+                data = fileobj.read(READ_SIZE)
+                if data:
+                    # Keep a window before the current chunk too, to warm up the next slice's hash.
+                    keep = max(pos - self._window, 0)
+                    buf = buf[keep:] + data
+                    base += keep
+                    pos -= keep
+                    for start in range(len(buf) - len(data), len(buf), SLICE_SIZE):
+                        lo = max(start - self._window, 0)
+                        end = min(start + SLICE_SIZE, len(buf))
+                        pending.append((base + end, pool.submit(_gear_hits, self._gear_s, self._mask_s, self._mask_l,
+                                                                buf[lo:end], start - lo, base + lo)))
+                    continue
+                eof = True
+            if pos >= len(buf):
+                return
+            limit = base + pos + min(self.max_size, len(buf) - pos)
+            while hashed < limit:
+                hashed, future = pending.popleft()
+                more, more_strong = future.result()
+                hits += more
+                strong += more_strong
+            n = self._pick(buf, pos, len(buf), base, hits, strong)
+            yield buf[pos:pos + n]
+            pos += n
+            del hits[:bisect_right(hits, base + pos)]
+            del strong[:bisect_right(strong, base + pos)]
+
+    def _pick(self, data: bytes, start: int, end: int, base: int, hits: List[int], strong: List[int]) -> int:
+        """
+        Same as _cut, from the hits of the parallel hash. The hash restarts after min_size, so
+        the first window after that is hashed here.
+        """
+        n = end - start
+        if n <= self.min_size:
+            return n
+        normal = start + min(self.avg_size, n)
+        limit = start + min(self.max_size, n)
+        first = start + self.min_size
+        warm = min(first + self._window, limit)
+        gear = self._gear_s
+        h = 0
+        for i in range(first, warm):
+            h = ((h << 1) & self._mask_s) + gear[data[i]]
+            if not h & (self._mask_s if i < normal else self._mask_l):
+                return i + 1 - start
+        # Past the window the parallel hash is exact: the first strong hit before normal, else any hit after it.
+        i = bisect_right(strong, base + warm)
+        if i < len(strong) and strong[i] <= base + normal:
+            return strong[i] - base - start
+        i = bisect_left(hits, base + max(normal, warm) + 1)
+        if i < len(hits) and hits[i] <= base + limit:
+            return hits[i] - base - start
+        return limit - start
+
+
+class Repository:
+    def __init__(self, root: Path, config: Dict[str, Any]):
+        self.root = root
+        self._id_key = bytes.fromhex(config["id_key"])
+        self._enc_key = bytes.fromhex(config["enc_key"])
+        self.chunker = Chunker(bytes.fromhex(config["chunker_seed"]))
+        self._dicts: Dict[int, pyzstd.ZstdDict] = {}
+
+    @classmethod
+    def open(cls, root: Path, password: str, create: bool = False) -> "Repository":
+        cfg_path = root / CONFIG_NAME
+        if not cfg_path.exists():
+            if not create:
+                raise FileNotFoundError(f"{root} is not a SecureBackup repository")
+            return cls._init(root, password)
+        with open(cfg_path, "rb") as f:
+            try:
+                config = json.loads(open_reader(f, password).read())
+            except Exception:
+                raise ValueError("Wrong password or corrupted repository config") from None
+        if config.get("version") != REPO_VERSION:
+            raise ValueError(f"Unsupported repository version {config.get('version')}")
+        return cls(root, config)
+
+    @classmethod
+    def _init(cls, root: Path, password: str) -> "Repository":
+        (root / "chunks").mkdir(parents=True, exist_ok=True)
+        (root / "snapshots").mkdir(exist_ok=True)
+        config = {
+            "version": REPO_VERSION,
+            "id_key": os.urandom(32).hex(),
+            "enc_key": os.urandom(32).hex(),
+            "chunker_seed": os.urandom(16).hex(),
+        }
+        tmp = root / (CONFIG_NAME + ".tmp")
+        with open(tmp, "wb") as f:
+            writer = SegmentedWriter(f, password)
+            writer.write(json.dumps(config).encode("utf-8"))
+            writer.close()
+        os.replace(tmp, root / CONFIG_NAME)
+        logging.info(f"Initialized new repository at {root}")
+        return cls(root, config)
+
+    def _seal(self, data: bytes, aad: bytes, codec: Optional[str], level: int,
+              zstd_dict: Optional[pyzstd.ZstdDict] = None) -> bytes:
+        method, stored = compress_block(codec, level, data, zstd_dict)
+        return encrypt_blob(self._enc_key, BLOB_HEADER.pack(method, len(data)) + stored, aad)
+
+    def _unseal(self, blob: bytes, aad: bytes) -> bytes:
+        plain = decrypt_blob(self._enc_key, blob, aad)
+        method, raw_len = BLOB_HEADER.unpack_from(plain)
+        return decompress_block(method, plain[BLOB_HEADER.size:], raw_len, self.dictionary)
+
+    @staticmethod
+    def _write_atomic(path: Path, data: bytes) -> None:
+        # A crash must never leave a partial object that later runs would trust as present.
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def chunk_id(self, data: bytes) -> str:
+        return hmac.new(self._id_key, data, hashlib.sha256).hexdigest()
+
+    def chunk_path(self, chunk_id: str) -> Path:
+        return self.root / "chunks" / chunk_id[:2] / chunk_id
+
+    def put_chunk(self, data: bytes, codec: str, level: int,
+                  zstd_dict: Optional[pyzstd.ZstdDict] = None) -> Tuple[str, int]:
+        """Stores a chunk unless it is already present. Returns (id, bytes written)."""
+        chunk_id = self.chunk_id(data)
+        path = self.chunk_path(chunk_id)
+        if path.exists():
+            return chunk_id, 0
+        path.parent.mkdir(exist_ok=True)
+        blob = self._seal(data, chunk_id.encode("ascii"), codec, level, zstd_dict)
+        self._write_atomic(path, blob)
+        return chunk_id, len(blob)
+
+    def _dict_path(self, dict_id: int) -> Path:
+        return self.root / "dicts" / f"{dict_id:08x}.dict"
+
+    def dictionary(self, dict_id: int) -> pyzstd.ZstdDict:
+        """One of the repository's trained dictionaries, by id."""
+        zstd_dict = self._dicts.get(dict_id)
+        if zstd_dict is None:
+            path = self._dict_path(dict_id)
+            if not path.exists():
+                raise ValueError(f"Compression dictionary {dict_id:08x} is missing from the repository")
+            zstd_dict = pyzstd.ZstdDict(self._unseal(path.read_bytes(), path.name.encode("ascii")))
+            self._dicts[dict_id] = zstd_dict
+        return zstd_dict
+
+    def add_dictionary(self, zstd_dict: pyzstd.ZstdDict) -> None:
+        path = self._dict_path(zstd_dict.dict_id)
+        path.parent.mkdir(exist_ok=True)
+        if not path.exists():
+            self._write_atomic(path, self._seal(zstd_dict.dict_content, path.name.encode("ascii"), None, 0))
+        self._dicts[zstd_dict.dict_id] = zstd_dict
+
+    def dictionary_state(self) -> Dict[str, Any]:
+        path = self.root / "dicts" / "state"
+        if not path.exists():
+            return {"current": None, "baseline": None, "retrain": False, "versions": []}
+        return json.loads(self._unseal(path.read_bytes(), b"dictionaries"))
+
+    def save_dictionary_state(self, state: Dict[str, Any]) -> None:
+        path = self.root / "dicts" / "state"
+        path.parent.mkdir(exist_ok=True)
+        self._write_atomic(path, self._seal(json.dumps(state).encode("utf-8"), b"dictionaries", "zstd", 3))
+
+    def get_chunk(self, chunk_id: str) -> bytes:
+        return self._unseal(self.chunk_path(chunk_id).read_bytes(), chunk_id.encode("ascii"))
+
+    def write_snapshot(self, snapshot: Dict[str, Any]) -> Path:
+        name = datetime.now().strftime("%Y%m%d_%H%M%S") + "_" + os.urandom(3).hex() + SNAPSHOT_SUFFIX
+        path = self.root / "snapshots" / name
+        data = json.dumps(snapshot, separators=(",", ":")).encode("utf-8")
+        self._write_atomic(path, self._seal(data, b"snapshot", "zstd", 3))
+        return path
+
+    def read_snapshot(self, path: Path) -> Dict[str, Any]:
+        return json.loads(self._unseal(Path(path).read_bytes(), b"snapshot"))
+
+    def snapshots(self) -> List[Path]:
+        return sorted((self.root / "snapshots").glob("*" + SNAPSHOT_SUFFIX))
+
+    def latest_files(self) -> Dict[str, Dict[str, Any]]:
+        """File entries of the most recent snapshot by name, used to skip re-chunking unchanged files."""
+        snapshots = self.snapshots()
+        if not snapshots:
+            return {}
+        try:
+            snapshot = self.read_snapshot(snapshots[-1])
+        except Exception as e:
+            logging.warning(f"Could not read snapshot {snapshots[-1].name}, every file will be re-chunked. Reason: {e}")
+            return {}
+        return {e["name"]: e for e in snapshot["entries"] if e["type"] == "file"}
+
+
+class _SmallChunks:
+    """
+    Stores a run's small chunks with the repository's current dictionary. When there is none
+    yet, or the last run found it drifted, the first DICT_SAMPLE_BYTES of new small chunks are
+    held back, a new dictionary version is trained on them and they are written with it.
+    close() writes whatever is still held and compares the run's ratio with the one the
+    dictionary had on its first run, flagging a retrain when it has drifted too far.
+    """
+
+    def __init__(self, repo: Repository, level: int):
+        self._repo = repo
+        self._level = level
+        self._state = repo.dictionary_state()
+        current = self._state["current"]
+        self._dict = repo.dictionary(current) if current is not None else None
+        self._training = self._dict is None or self._state["retrain"]
+        self._held: Dict[str, bytes] = {}
+        self._held_bytes = 0
+        self._raw = self._stored = 0
+
+    def put(self, data: bytes) -> Tuple[str, int]:
+        if self._training:
+            chunk_id = self._repo.chunk_id(data)
+            if chunk_id in self._held or self._repo.chunk_path(chunk_id).exists():
+                return chunk_id, 0
+            self._held[chunk_id] = data
+            self._held_bytes += len(data)
+            return chunk_id, self._train() if self._held_bytes >= DICT_SAMPLE_BYTES else 0
+        chunk_id, n = self._repo.put_chunk(data, "zstd", self._level, self._dict)
+        if n:
+            self._raw += len(data)
+            self._stored += n
+        return chunk_id, n
+
+    def _train(self) -> int:
+        samples = list(self._held.values())
+        zstd_dict = None
+        if len(samples) >= DICT_MIN_SAMPLES:
+            try:
+                zstd_dict = pyzstd.train_dict(samples, DICT_SIZE)
+            except pyzstd.ZstdError as e:
+                logging.warning(f"Could not train a compression dictionary, keeping the current one. Reason: {e}")
+        if zstd_dict is not None:
+            self._repo.add_dictionary(zstd_dict)
+            versions = self._state["versions"] + [{"id": zstd_dict.dict_id, "created": datetime.now().isoformat(timespec="seconds"),
+                                                   "samples": len(samples), "bytes": self._held_bytes}]
+            self._state = {"current": zstd_dict.dict_id, "baseline": None, "retrain": False, "versions": versions}
+            self._dict = zstd_dict
+            logging.info(f"Trained compression dictionary version {len(versions)} on {len(samples)} small files.")
+        self._training = False
+        # The samples are left out of the ratio: the dictionary was fitted to them.
+        written = sum(self._repo.put_chunk(data, "zstd", self._level, self._dict)[1] for data in samples)
+        self._held.clear()
+        self._held_bytes = 0
+        return written
+
+    def close(self) -> int:
+        """Writes the chunks still held back and saves the dictionary state. Returns the bytes written."""
+        written = self._train() if self._held else 0
+        if self._dict is not None and self._raw >= DICT_MIN_MEASURE:
+            ratio = self._stored / self._raw
+            baseline = self._state["baseline"]
+            if baseline is None:
+                self._state["baseline"] = ratio
+            elif ratio > baseline * (1 + DICT_DRIFT):
+                logging.info(f"Small files compressed to {ratio:.0%} of their size against {baseline:.0%} with a new "
+                             f"dictionary, training a new one on the next run.")
+                self._state["retrain"] = True
+        self._repo.save_dictionary_state(self._state)
+        return written
+
+
+def run_repository_backup(sources: List[str], repository_folder: str, password: str,
+                          codec: Optional[str] = None, level: Optional[int] = None, dictionary: bool = False,
+                          throttle: Optional[Throttle] = None) -> Path:
+    """
+    Backs up the sources into a deduplicating repository (created on first use).
+    Only chunks the repository has not seen before are compressed, encrypted and written.
+    With dictionary=True (zstd only), small files are compressed with a dictionary trained on them.
+    throttle (see throttle.py) caps the files read a second and the bytes read and written.
+    """
+    codec, level = resolve_codec(codec, level)
+    repo = Repository.open(Path(repository_folder), password, create=True)
+    if dictionary and codec != "zstd":
+        logging.warning(f"Compression dictionaries need the zstd codec, not {codec}; compressing without one.")
+    small = _SmallChunks(repo, level) if dictionary and codec == "zstd" else None
+    previous = repo.latest_files()
+    entries = []
+    total = written = reused = 0
+    pool = chunk_pool()
+    try:
+        for path, arcname, st in scan(sources):
+            entry = {"name": arcname, "mode": stat.S_IMODE(st.st_mode), "mtime": st.st_mtime}
+            try:
+                if stat.S_ISDIR(st.st_mode):
+                    entry["type"] = "dir"
+                elif stat.S_ISLNK(st.st_mode):
+                    entry["type"] = "symlink"
+                    entry["target"] = os.readlink(path)
+                elif stat.S_ISREG(st.st_mode):
+                    entry["type"] = "file"
+                    entry["size"] = 0
+                    entry["ino"] = st.st_ino
+                    entry["chunks"] = []
+                    old = previous.get(arcname)
+                    if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime and old.get("ino") == st.st_ino:
+                        # Unchanged since the last snapshot: reuse its chunk list without reading the file.
+                        entry["size"], entry["chunks"] = old["size"], old["chunks"]
+                        reused += 1
+                        entries.append(entry)
+                        total += entry["size"]
+                        continue
+                    if throttle:
+                        throttle.file()
+                    with (throttle.open(path) if throttle else open(path, "rb")) as f:
+                        # A file that is a single chunk is never hashed; it needs no round trip to the workers.
+                        for chunk in repo.chunker.chunks(f, pool if st.st_size > MIN_CHUNK else None):
+                            if small is not None and len(chunk) < DICT_MAX_CHUNK:
+                                chunk_id, n = small.put(chunk)
+                            else:
+                                chunk_id, n = repo.put_chunk(chunk, codec, level)
+                            entry["chunks"].append(chunk_id)
+                            entry["size"] += len(chunk)
+                            written += n
+                            if throttle:
+                                throttle.wrote(n)
+                    total += entry["size"]
+                else:
+                    logging.warning(f"Unsupported file type, skipping {path}")
+                    continue
+            except OSError as e:
+                logging.warning(f"Could not add {path} to repository, skipping. Reason: {e}")
+                continue
+            entries.append(entry)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if small is not None:
+        written += small.close()
+    snapshot = {"time": datetime.now().isoformat(timespec="seconds"), "sources": sources, "entries": entries}
+    snap_path = repo.write_snapshot(snapshot)
+    logging.info(f"Snapshot {snap_path.name}: {total} bytes of data, {reused} unchanged files, "
+                 f"{written} bytes of new chunks written.")
+    return snap_path
+
+
+def list_snapshot(snapshot_path: str, password: str) -> List[Dict[str, Any]]:
+    snap = Path(snapshot_path)
+    repo = Repository.open(snap.parent.parent, password)
+    return [{"size": 0, **e} for e in repo.read_snapshot(snap)["entries"]]
+
+
+def verify_snapshot(snapshot_path: str, password: str) -> Dict[str, Any]:
+    """
+    Checks that every chunk a snapshot refers to is present, authenticates, decompresses and
+    still hashes to its id, without writing anything. Chunks are checked on all cores.
+    Raises ValueError listing the damaged files; returns entry, byte and chunk counts.
+    """
+    snap = Path(snapshot_path)
+    repo = Repository.open(snap.parent.parent, password)
+    entries = repo.read_snapshot(snap)["entries"]
+    chunk_ids = sorted({c for e in entries if e["type"] == "file" for c in e["chunks"]})
+
+    def check(chunk_id: str) -> Optional[int]:
+        try:
+            data = repo.get_chunk(chunk_id)
+        except Exception as e:
+            logging.error(f"Chunk {chunk_id} is unreadable. Reason: {e or type(e).__name__}")
+            return None
+        if not hmac.compare_digest(repo.chunk_id(data), chunk_id):
+            logging.error(f"Chunk {chunk_id} does not match its id.")
+            return None
+        return len(data)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="sbk-verify") as pool:
+        sizes = dict(zip(chunk_ids, pool.map(check, chunk_ids)))
+    damaged = [e["name"] for e in entries if e["type"] == "file"
+               and (any(sizes[c] is None for c in e["chunks"]) or sum(sizes[c] for c in e["chunks"]) != e["size"])]
+    if damaged:
+        raise ValueError(f"{len(damaged)} damaged files in {snap.name}: {', '.join(damaged[:5])}"
+                         + (", ..." if len(damaged) > 5 else ""))
+    return {"entries": len(entries), "bytes": sum(e.get("size", 0) for e in entries), "chunks": len(chunk_ids)}
+
+
+def restore_snapshot(snapshot_path: str, output_folder: str, password: str, patterns: Optional[List[str]] = None) -> None:
+    """
+    Restores a repository snapshot (optionally only entries matching patterns);
+    the repository is the parent of the snapshots folder.
+    """
+    snap = Path(snapshot_path)
+    repo = Repository.open(snap.parent.parent, password)
+    snapshot = repo.read_snapshot(snap)
+    out_dir = Path(output_folder)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    root = out_dir.resolve()
+    dirs = []
+    for entry in snapshot["entries"]:
+        if not match_patterns(entry["name"], patterns):
+            continue
+        target = (out_dir / entry["name"]).resolve()
+        if root not in target.parents:
+            logging.warning(f"Skipping unsafe path {entry['name']!r}")
+            continue
+        kind = entry["type"]
+        if kind == "dir":
+            target.mkdir(parents=True, exist_ok=True)
+            dirs.append((target, entry))
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if kind == "symlink":
+            link = entry["target"]
+            if os.path.isabs(link) or root not in (target.parent / link).resolve().parents:
+                logging.warning(f"Skipping symlink {entry['name']!r} pointing outside the restore folder")
+                continue
+            if target.is_symlink() or target.exists():
+                target.unlink()
+            os.symlink(link, target)
+            continue
+        with open(target, "wb") as f:
+            for chunk_id in entry["chunks"]:
+                f.write(repo.get_chunk(chunk_id))
+        os.chmod(target, entry["mode"] & 0o777)
+        os.utime(target, (entry["mtime"], entry["mtime"]))
+    # Directory times last, deepest first, since creating their contents changed them.
+    for target, entry in reversed(dirs):
+        os.chmod(target, entry["mode"] & 0o777)
+        os.utime(target, (entry["mtime"], entry["mtime"]))
@@ -1,33 +1,581 @@
 from __future__ import annotations
 from pathlib import Path
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import logging
+import os
+import shutil
 import tarfile
-import lz4.frame as lz4
-from .crypto import decrypt_file
-from .utils import TEMP_DIR
-import io
+import time
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+from cryptography.exceptions import InvalidTag
+from .crypto import open_reader, SegmentedRandomAccess, SEGMENTED_MAGIC
+from .archive import open_payload, parse_index, read_index, RawStream, entry_type, match_patterns, META_NAME
+from .repository import SNAPSHOT_SUFFIX, restore_snapshot, list_snapshot, verify_snapshot
+from .metrics import Metrics, Progress, format_stages
+from .pipeline import ReadAhead
+from .shards import process_pool, read_shard_map
+from .volumes import VolumeError, VolumeSet, open_archive, volume_paths
+from .utils import CHUNK_SIZE, read_exact
+from .throttle import PriorityPools
 
-def run_restore(encrypted_path: str, output_folder: str, password: str) -> None:
+# File writes are syscall-bound rather than CPU-bound, so the pool is wider than the core count.
+RESTORE_WRITERS = min(32, 4 * (os.cpu_count() or 1))
+# Bodies up to this size are handed to the writer pool; larger ones stream on the decoding thread.
+PARALLEL_MAX_FILE = 4 * 1024 * 1024
+# Decoded bodies waiting for a writer, at most.
+RESTORE_INFLIGHT_BYTES = 64 * 1024 * 1024
+# tarfile's stream mode re-slices its whole read buffer on every header read, so a buffer much
+# bigger than this makes archives of many small files decode slowly; large bodies are read in
+# CHUNK_SIZE pieces regardless.
+TAR_BUFSIZE = 64 * 1024
+# What a damaged or missing volume of a split backup raises when it is read.
+_DAMAGE = (InvalidTag, VolumeError)
+
+_pools = PriorityPools(RESTORE_WRITERS, "sbk-restore")
+
+def _pool() -> ThreadPoolExecutor:
+    return _pools.get()
+
+def _extract_kwargs() -> dict:
+    # Reject absolute paths, '..' components and unsafe links where tarfile supports it.
+    return {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+def _write_file(target: Path, data: bytes) -> None:
+    if target.is_symlink():
+        # Replace a link left by an earlier archive instead of writing through it.
+        target.unlink()
+    with open(target, "wb") as f:
+        f.write(data)
+
+def _set_attrs(target: Path, member: tarfile.TarInfo) -> None:
+    try:
+        if member.mode is not None:
+            os.chmod(target, member.mode)
+        os.utime(target, (member.mtime, member.mtime))
+    except OSError as e:
+        logging.warning(f"Could not set permissions or times on {target}. Reason: {e}")
+
+class _ParallelExtractor:
+    """
+    Extracts tar members decoded on the calling thread, with the file writes spread over a thread pool.
+    Directories are created as their headers arrive, before any of their contents is queued, and
+    modes/times are applied in one batch at close(), directories last so writing into them cannot
+    undo their times. Links and special files are left to tarfile once the pending writes are done.
+    """
+
+    def __init__(self, out_dir: Path, metrics: Optional[Metrics] = None):
+        self.out_dir = out_dir
+        self._metrics = metrics or Metrics()
+        self._root = out_dir.resolve()
+        self._made: Set[Path] = {self._root}
+        self._window: Deque[Tuple[Path, Future, int]] = deque()
+        self._pending: Dict[Path, Future] = {}
+        self._inflight = 0
+        self._files: List[Tuple[Path, tarfile.TarInfo]] = []
+        self._dirs: List[Tuple[Path, tarfile.TarInfo]] = []
+
+    def _filter(self, member: tarfile.TarInfo) -> Optional[tarfile.TarInfo]:
+        if hasattr(tarfile, "data_filter"):
+            try:
+                return tarfile.data_filter(member, str(self._root))
+            except tarfile.FilterError as e:
+                logging.warning(f"Skipping unsafe entry {member.name!r}. Reason: {e}")
+                return None
+        if self._root not in (self._root / member.name).resolve().parents:
+            logging.warning(f"Skipping unsafe entry {member.name!r}")
+            return None
+        return member
+
+    def _mkdirs(self, path: Path) -> None:
+        if path not in self._made:
+            path.mkdir(parents=True, exist_ok=True)
+            self._made.add(path)
+
+    def _retire(self) -> None:
+        target, future, size = self._window.popleft()
+        if self._pending.get(target) is future:
+            del self._pending[target]
+        self._inflight -= size
+        start = time.perf_counter()
+        future.result()
+        self._metrics.add("write", stall=time.perf_counter() - start)
+
+    def drain(self) -> None:
+        while self._window:
+            self._retire()
+
+    def extract(self, tar: tarfile.TarFile, member: tarfile.TarInfo) -> None:
+        member = self._filter(member)
+        if member is None:
+            return
+        target = self._root / member.name
+        if member.isdir():
+            self._mkdirs(target)
+            self._dirs.append((target, member))
+            self._metrics.file_done(0)
+            return
+        self._mkdirs(target.parent)
+        if target in self._pending:
+            # The same name twice in one archive: the later one must win.
+            self._pending[target].result()
+        if member.isreg() and member.size <= PARALLEL_MAX_FILE:
+            data = tar.extractfile(member).read()
+            future = _pool().submit(self._metrics.timed, "write", _write_file, target, data)
+            self._metrics.add("write", bytes_in=len(data))
+            self._window.append((target, future, len(data)))
+            self._pending[target] = future
+            self._inflight += len(data)
+            while self._inflight > RESTORE_INFLIGHT_BYTES:
+                self._retire()
+        elif member.isreg():
+            if target.is_symlink():
+                target.unlink()
+            with open(target, "wb") as f:
+                source = tar.extractfile(member)
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    start = time.perf_counter()
+                    f.write(chunk)
+                    self._metrics.add("write", seconds=time.perf_counter() - start, bytes_in=len(chunk))
+        else:
+            # A hard link needs its target on disk, and a symlink must exist before later
+            # members are checked against it.
+            self.drain()
+            tar.extract(member, path=self.out_dir, **_extract_kwargs())
+            self._metrics.file_done(0)
+            return
+        self._files.append((target, member))
+        self._metrics.file_done(member.size)
+
+    def close(self) -> None:
+        self.drain()
+        for _ in _pool().map(lambda item: _set_attrs(*item), self._files):
+            pass
+        # Deepest first, as tarfile does.
+        for target, member in sorted(self._dirs, key=lambda d: d[0], reverse=True):
+            _set_attrs(target, member)
+
+def read_archive_meta(encrypted_path: Path, password: str) -> Optional[Dict[str, Any]]:
+    """
+    Returns the incremental-chain metadata of a backup, or None for a standalone backup.
+    Only the first block of the archive is decrypted and decompressed.
+    """
+    shards = read_shard_map(encrypted_path, password)
+    if shards is not None:
+        return read_archive_meta(shards[0], password)
+    with open_archive(encrypted_path, password) as f_in:
+        decompressed = open_payload(open_reader(f_in, password))
+        with tarfile.open(fileobj=decompressed, mode="r|", bufsize=TAR_BUFSIZE) as tar:
+            member = tar.next()
+            if member is None or member.name != META_NAME:
+                return None
+            return json.loads(tar.extractfile(member).read())
+
+def _open_index(f_in, password: str) -> Tuple[Optional[SegmentedRandomAccess], Optional[Dict[str, Any]]]:
+    """
+    Returns (container, index) for random access, or (None, None) for archives without an index.
+    A split backup's index comes from the copy in its map, so no volume has to be read for it.
+    """
+    magic = read_exact(f_in, 4)
+    f_in.seek(0)
+    if magic != SEGMENTED_MAGIC:
+        return None, None
+    container = SegmentedRandomAccess(f_in, password)
+    if isinstance(f_in, VolumeSet) and f_in.index_block is not None:
+        index = parse_index(f_in.index_block)
+    else:
+        index = read_index(container)
+    return (container, index) if index is not None else (None, None)
+
+def _read_ahead(f_in):
+    """Sequential reader for a whole backup; a split one reads several volumes at once."""
+    return f_in.stream() if isinstance(f_in, VolumeSet) else ReadAhead(f_in)
+
+def _past_damage(f_in, password: str, error: BaseException) -> Tuple[RawStream, List[Dict[str, Any]]]:
+    """
+    After damaged data stopped the stream of a split backup, opens it for random access
+    instead: returns the raw tar stream and the index records, so the entries outside the
+    damaged volumes can still be read one by one. Raises error again for a single-file
+    backup, or when the index itself is unreadable.
+    """
+    if not isinstance(f_in, VolumeSet):
+        raise error
+    logging.error(f"{f_in.path.name}: {str(error) or 'damaged data'}; carrying on with the entries outside the damaged volumes.")
+    try:
+        container, index = _open_index(f_in, password)
+    except _DAMAGE:
+        index = None
+    if index is None:
+        raise error
+    return RawStream(container, index["blocks"]), index["files"]
+
+def list_archive(encrypted_path: str, password: str) -> List[Dict[str, Any]]:
+    """
+    Lists the entries of one backup (name, type, size, mtime, ...).
+    Reads only the encrypted index at the end of the archive; older archives without one are streamed.
+    """
+    if Path(encrypted_path).suffix == SNAPSHOT_SUFFIX:
+        return list_snapshot(encrypted_path, password)
+    shards = read_shard_map(encrypted_path, password)
+    if shards is not None:
+        return [record for shard in shards for record in list_archive(str(shard), password)]
+    with open_archive(encrypted_path, password) as f_in:
+        _, index = _open_index(f_in, password)
+        if index is not None:
+            return index["files"]
+        files = []
+        decompressed = open_payload(open_reader(f_in, password))
+        with tarfile.open(fileobj=decompressed, mode="r|", bufsize=TAR_BUFSIZE) as tar:
+            for member in tar:
+                if member.name != META_NAME:
+                    files.append({"name": member.name, "type": entry_type(member), "size": member.size,
+                                  "mtime": member.mtime, "mode": member.mode})
+        return files
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def _hash_stream(data, metrics: Metrics) -> str:
+    h = hashlib.sha256()
+    start = time.perf_counter()
+    for chunk in iter(lambda: data.read(CHUNK_SIZE), b""):
+        h.update(chunk)
+    metrics.add("hash", seconds=time.perf_counter() - start)
+    return h.hexdigest()
+
+def _verify_one(enc: Path, password: str, metrics: Metrics) -> List[str]:
+    """
+    Streams one archive through decrypt -> decompress -> tar, hashing every file body against
+    the sha256 in the index; nothing is written. Returns the problems found. A failed
+    authentication tag raises InvalidTag straight away, since nothing after it can be trusted;
+    in a split backup the entries outside the damaged volumes are then checked one by one.
+    """
+    shards = read_shard_map(enc, password)
+    if shards is not None:
+        return _verify_shards(shards, password, metrics)
+    problems: List[str] = []
+    # Small bodies are hashed on the pool (hashlib releases the GIL), big ones as they stream.
+    pending: Deque[Tuple[str, Optional[str], int, Future]] = deque()
+    inflight = 0
+    done = 0
+
+    def check(name: str, want: Optional[str], digest: str) -> None:
+        if want and digest != want:
+            problems.append(f"{name}: checksum mismatch")
+
+    with open_archive(enc, password) as f_in:
+        _, index = _open_index(f_in, password)
+        expected = {r["name"]: r for r in index["files"]} if index is not None else None
+        f_in.seek(0)
+        try:
+            with _read_ahead(f_in) as source:
+                reader = open_reader(source, password, metrics)
+                decompressed = open_payload(reader, metrics)
+                with tarfile.open(fileobj=decompressed, mode="r|", bufsize=TAR_BUFSIZE) as tar:
+                    for member in tar:
+                        if member.name == META_NAME:
+                            continue
+                        record = None
+                        if expected is not None:
+                            record = expected.pop(member.name, None)
+                            if record is None:
+                                problems.append(f"{member.name}: not in the index")
+                            elif record["size"] != member.size or record["type"] != entry_type(member):
+                                problems.append(f"{member.name}: does not match the index")
+                        want = record.get("sha256") if record else None
+                        if member.isreg():
+                            data = tar.extractfile(member)
+                            if member.size <= PARALLEL_MAX_FILE:
+                                content = data.read()
+                                pending.append((member.name, want, len(content), _pool().submit(metrics.timed, "hash", _sha256, content)))
+                                inflight += len(content)
+                                while inflight > RESTORE_INFLIGHT_BYTES:
+                                    name, want_, size, future = pending.popleft()
+                                    check(name, want_, future.result())
+                                    inflight -= size
+                            else:
+                                check(member.name, want, _hash_stream(data, metrics))
+                        metrics.file_done(member.size if member.isreg() else 0)
+                        done += 1
+                # Decrypt the rest (the index) too, so the final segment's tag is checked.
+                while reader.read(CHUNK_SIZE):
+                    pass
+        except _DAMAGE as e:
+            raw, records = _past_damage(f_in, password, e)
+            for record in records[done:]:
+                expected.pop(record["name"], None)
+                try:
+                    raw.seek(record["offset"])
+                    with tarfile.open(fileobj=raw, mode="r|") as tar:
+                        member = tar.next()
+                        if member.isreg():
+                            check(member.name, record.get("sha256"), _hash_stream(tar.extractfile(member), metrics))
+                    metrics.file_done(member.size if member.isreg() else 0)
+                except _DAMAGE:
+                    problems.append(f"{record['name']}: in a damaged volume")
+            problems.extend(f_in.damaged.values())
+        for name, want, _, future in pending:
+            check(name, want, future.result())
+    if expected:
+        problems.extend(f"{name}: missing from the archive" for name in sorted(expected))
+    return problems
+
+def _verify_shard(path: str, password: str) -> Tuple[List[str], Dict[str, Any]]:
+    """_verify_one in a worker process; also returns the shard's metrics."""
+    metrics = Metrics()
+    return _verify_one(Path(path), password, metrics), metrics.snapshot()
+
+def _verify_shards(shards: List[Path], password: str, metrics: Metrics) -> List[str]:
+    """Verifies the file shards of a sharded backup in worker processes and the metadata shard here."""
+    problems = []
+    with process_pool(max(1, len(shards) - 1)) as pool:
+        futures = {pool.submit(_verify_shard, str(shard), password): shard for shard in shards[1:]}
+        problems.extend(f"{shards[0].name}: {p}" for p in _verify_one(shards[0], password, metrics))
+        for future in as_completed(futures):
+            found, snapshot = future.result()
+            metrics.merge(snapshot)
+            problems.extend(f"{futures[future].name}: {p}" for p in found)
+    return problems
+
+def verify_archive(encrypted_path: str, password: str, chain: bool = False,
+                   progress: Optional[Progress] = None) -> Dict[str, Any]:
+    """
+    Checks that a backup restores correctly without writing anything: every segment is
+    authenticated, every block decompressed, every tar header walked and every file body
+    hashed against the checksum recorded in the archive index. Decryption, decompression and
+    hashing run on their thread pools, so this is bounded by read speed rather than one core.
+    chain=True checks the whole incremental chain the backup needs. A .snap is checked chunk
+    by chunk in its repository.
+    Raises InvalidTag on tampered data, ValueError listing the damaged files, and returns
+    entry and byte counts otherwise.
+    """
     enc = Path(encrypted_path)
+    if enc.suffix == SNAPSHOT_SUFFIX:
+        return verify_snapshot(encrypted_path, password)
+    archives = resolve_chain(enc, password) if chain else [enc]
+    metrics = Metrics("verify", enc.stem, progress, _planned_bytes(archives, password, None))
+    problems = []
+    try:
+        for archive in archives:
+            problems.extend(f"{archive.name}: {p}" for p in _verify_one(archive, password, metrics))
+    except BaseException as e:
+        metrics.close("failed", str(e) or type(e).__name__)
+        raise
+    if problems:
+        metrics.close("failed", f"{len(problems)} problems")
+        for problem in problems:
+            logging.error(problem)
+        raise ValueError(f"{len(problems)} problems found: {'; '.join(problems[:5])}" + ("; ..." if len(problems) > 5 else ""))
+    summary = metrics.close()
+    logging.info(f"Verified {enc.name}{f' and {len(archives) - 1} earlier archives' if len(archives) > 1 else ''}: "
+                 f"{summary['files']:,} entries, {summary['bytes']:,} bytes in {summary['elapsed']:.1f}s "
+                 f"({summary['mb_per_s']:.1f} MB/s).")
+    return {"entries": summary["files"], "bytes": summary["bytes"], "archives": len(archives)}
+
+def _chain_meta(path: Path, password: str) -> Optional[Dict[str, Any]]:
+    """
+    read_archive_meta for resolve_chain. When damage in a split backup hides the metadata, the
+    chain stops at that backup: it is still replayed, just without the ones before it.
+    """
+    try:
+        return read_archive_meta(path, password)
+    except _DAMAGE as e:
+        if not volume_paths(path):
+            raise
+        logging.error(f"{path.name}: its chain metadata is in a damaged volume ({e}); "
+                      f"restoring from it without the backups before it.")
+        return None
+
+def resolve_chain(encrypted_path: Path, password: str) -> List[Path]:
+    """Returns the archives to replay, oldest (the full backup) first, ending with encrypted_path."""
+    chain = [encrypted_path]
+    meta = _chain_meta(encrypted_path, password)
+    while meta and meta.get("kind") == "incremental":
+        parent = chain[0].parent / meta["parent"]
+        if not parent.exists():
+            raise FileNotFoundError(f"Backup chain is broken: {parent.name} (needed by {chain[0].name}) is missing.")
+        chain.insert(0, parent)
+        meta = _chain_meta(parent, password)
+    return chain
+
+def _apply_deletions(out_dir: Path, deleted: List[str]) -> None:
+    root = out_dir.resolve()
+    for arcname in deleted:
+        target = (out_dir / arcname).resolve()
+        if root not in target.parents:
+            logging.warning(f"Ignoring unsafe deletion entry {arcname!r}")
+            continue
+        if target.is_dir() and not target.is_symlink():
+            shutil.rmtree(target, ignore_errors=True)
+        elif target.exists() or target.is_symlink():
+            target.unlink()
+
+def _extract_record(raw: RawStream, record: Dict[str, Any], offsets: Dict[str, int], extractor: _ParallelExtractor,
+                    patterns: Optional[List[str]]) -> None:
+    """Extracts the entry of one index record, seeking straight to its blocks."""
+    raw.seek(record["offset"])
+    with tarfile.open(fileobj=raw, mode="r|") as tar:
+        member = tar.next()
+        if member.islnk() and not match_patterns(member.linkname, patterns) and member.linkname in offsets:
+            # The link's target is not being restored, so restore its data under the link's name.
+            raw.seek(offsets[member.linkname])
+            with tarfile.open(fileobj=raw, mode="r|") as target_tar:
+                target = target_tar.next()
+                target.name = member.name
+                extractor.extract(target_tar, target)
+            return
+        extractor.extract(tar, member)
+
+def _extract_records(raw: RawStream, records: List[Dict[str, Any]], offsets: Dict[str, int],
+                     extractor: _ParallelExtractor, patterns: Optional[List[str]], lost: Optional[List[str]]) -> None:
+    """
+    Extracts the records matching patterns. With lost (split backups), entries in damaged
+    volumes are listed there and skipped; otherwise damage raises.
+    """
+    for record in records:
+        if not match_patterns(record["name"], patterns):
+            continue
+        try:
+            _extract_record(raw, record, offsets, extractor, patterns)
+        except _DAMAGE:
+            if lost is None:
+                raise
+            lost.append(record["name"])
+
+def _restore_selected(f_in, out_dir: Path, password: str, patterns: List[str], lost: List[str],
+                      metrics: Optional[Metrics] = None) -> bool:
+    """
+    Extracts only the entries matching patterns by seeking straight to their blocks.
+    Returns False if the archive has no index and has to be streamed instead.
+    """
+    container, index = _open_index(f_in, password)
+    if index is None:
+        return False
+    offsets = {record["name"]: record["offset"] for record in index["files"]}
+    extractor = _ParallelExtractor(out_dir, metrics)
+    _extract_records(RawStream(container, index["blocks"]), index["files"], offsets, extractor, patterns,
+                     lost if isinstance(f_in, VolumeSet) else None)
+    extractor.close()
+    return True
+
+def _planned_bytes(archives: List[Path], password: str, patterns: Optional[List[str]]) -> int:
+    """Bytes of file data a restore will write, from the archive indexes; 0 if any archive has none."""
+    total = 0
+    for archive in [shard for archive in archives for shard in read_shard_map(archive, password) or [archive]]:
+        try:
+            with open_archive(archive, password) as f_in:
+                _, index = _open_index(f_in, password)
+        except _DAMAGE:
+            return 0  # the run itself reports the damage
+        if index is None:
+            return 0
+        total += sum(r["size"] for r in index["files"] if r["type"] == "file" and match_patterns(r["name"], patterns))
+    return total
+
+def _restore_one(enc: Path, out_dir: Path, password: str, patterns: Optional[List[str]] = None,
+                 metrics: Optional[Metrics] = None, lost: Optional[List[str]] = None) -> None:
+    """Restores one archive; entries a damaged volume of a split backup took out go to lost."""
+    shards = read_shard_map(enc, password)
+    if shards is not None:
+        _restore_shards(shards, out_dir, password, patterns, metrics, lost)
+        return
+    meta = None
+    lost = [] if lost is None else lost
+    with open_archive(enc, password) as f_in:
+        if patterns and _restore_selected(f_in, out_dir, password, patterns, lost, metrics):
+            try:
+                meta = read_archive_meta(enc, password)
+            except _DAMAGE:
+                if not isinstance(f_in, VolumeSet):
+                    raise
+        else:
+            f_in.seek(0)
+            extractor = _ParallelExtractor(out_dir, metrics)
+            done = 0
+            try:
+                # The archive is read ahead on its own thread while earlier segments are decoded.
+                with _read_ahead(f_in) as source:
+                    reader = open_reader(source, password, metrics)
+                    decompressed = open_payload(reader, metrics)
+                    with tarfile.open(fileobj=decompressed, mode="r|", bufsize=TAR_BUFSIZE) as tar:
+                        for member in tar:
+                            if member.name == META_NAME:
+                                meta = json.loads(tar.extractfile(member).read())
+                                continue
+                            if match_patterns(member.name, patterns):
+                                extractor.extract(tar, member)
+                            done += 1
+            except _DAMAGE as e:
+                raw, records = _past_damage(f_in, password, e)
+                offsets = {record["name"]: record["offset"] for record in records}
+                _extract_records(raw, records[done:], offsets, extractor, patterns, lost)
+            extractor.close()
+    if meta and meta.get("deleted"):
+        _apply_deletions(out_dir, [d for d in meta["deleted"] if match_patterns(d, patterns)])
+
+def _restore_shard(path: str, out_dir: str, password: str, patterns: Optional[List[str]]) -> Dict[str, Any]:
+    """_restore_one in a worker process; returns the shard's metrics."""
+    metrics = Metrics()
+    _restore_one(Path(path), Path(out_dir), password, patterns, metrics)
+    return metrics.snapshot()
+
+def _restore_shards(shards: List[Path], out_dir: Path, password: str, patterns: Optional[List[str]],
+                    metrics: Optional[Metrics], lost: Optional[List[str]]) -> None:
+    """
+    Restores the file shards of a sharded backup in worker processes, then the metadata shard,
+    so that folder modes and times, links and deletions come after the files.
+    """
+    metrics = metrics or Metrics()
+    with process_pool(max(1, len(shards) - 1)) as pool:
+        futures = [pool.submit(_restore_shard, str(shard), str(out_dir), password, patterns) for shard in shards[1:]]
+        for future in as_completed(futures):
+            metrics.merge(future.result())
+    _restore_one(shards[0], out_dir, password, patterns, metrics, lost)
+
+def run_restore(encrypted_path: str, output_folder: str, password: str, chain: bool = True,
+                patterns: Optional[List[str]] = None, progress: Optional[Progress] = None) -> None:
+    """
+    Streams an .sbk backup back to disk: decrypt -> decompress -> tar, with constant memory.
+    The decompressor is chosen from the archive header; file bodies are written by a pool of threads.
+    For an incremental backup the full backup and every incremental up to it are replayed in order
+    (they must sit in the same folder), rebuilding that point in time; chain=False restores only
+    the files stored in this one archive. A repository snapshot (.snap) is restored from its repository.
+    patterns (exact paths, folder prefixes or globs such as "docs/*.txt") restores only matching
+    entries, reading just the blocks that hold them.
+    A split backup (see volumes.py) reads several volumes at once; if one is missing or damaged,
+    everything outside it is still restored and ValueError then lists the entries lost.
+    The shards of a sharded backup (see shards.py) are decoded by worker processes at once.
+    progress is called about once a second with the run's metrics (see metrics.py) and once at the end.
+    """
+    enc = Path(encrypted_path)
+    if enc.suffix == SNAPSHOT_SUFFIX:
+        restore_snapshot(encrypted_path, output_folder, password, patterns)
+        return
     out_dir = Path(output_folder)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    tmp_compressed = TEMP_DIR / (enc.stem + ".tar.lz4")
+    archives = resolve_chain(enc, password) if chain else [enc]
+    metrics = Metrics("restore", enc.stem, progress, _planned_bytes(archives, password, patterns))
+    lost: List[str] = []
     try:
-        decrypt_file(enc, tmp_compressed, password)
-        
-        with open(tmp_compressed, 'rb') as f_in:
-            compressed_data = f_in.read()
-            decompressed_data = lz4.decompress(compressed_data)
-        
-        stream = io.BytesIO(decompressed_data)
-        stream.seek(0)
-        
-        with tarfile.open(fileobj=stream, mode="r") as tar:
-            tar.extractall(path=out_dir)
-
-    finally:
-        if tmp_compressed.exists():
-            try:
-                tmp_compressed.unlink()
-            except Exception:
-                pass
\ No newline at end of file
+        for archive in archives:
+            if len(archives) > 1:
+                logging.info(f"Restoring {archive.name}...")
+            _restore_one(archive, out_dir, password, patterns, metrics, lost)
+    except BaseException as e:
+        metrics.close("failed", str(e) or type(e).__name__)
+        raise
+    if lost:
+        metrics.close("failed", f"{len(lost)} entries lost")
+        for name in lost:
+            logging.error(f"{name}: in a damaged volume, not restored")
+        raise ValueError(f"{len(lost)} entries in damaged volumes could not be restored: {'; '.join(lost[:5])}"
+                         + ("; ..." if len(lost) > 5 else ""))
+    summary = metrics.close()
+    logging.info(f"Restored {summary['files']:,} files, {summary['bytes']:,} bytes in {summary['elapsed']:.1f}s "
+                 f"({summary['mb_per_s']:.1f} MB/s). Stages: {format_stages(summary)}")
@@ -0,0 +1,199 @@
+from __future__ import annotations
+import logging
+import os
+import stat
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from .throttle import PriorityPools
+
+# Parallel source scanner. Directory listings and lstat calls run on a thread pool ahead of
+# the consumer, while entries are still yielded depth-first in sorted order (the order
+# tarfile.add used), so archives stay deterministic. prefetch() adds a bounded read-ahead of
+# small file contents on the same pool, hiding open/read latency on many-small-file trees.
+
+SCAN_WORKERS = min(32, 4 * (os.cpu_count() or 1))
+MAX_PENDING_DIRS = 1024
+PREFETCH_BYTES = 64 * 1024 * 1024
+PREFETCH_MAX_FILE = 1024 * 1024
+PREFETCH_MAX_ENTRIES = 4096
+PROGRESS_EVERY = 1000
+# Listings total_size keeps on the pool at once, so it never crowds out the scan proper.
+COUNT_INFLIGHT = 4
+
+
+class ScanEntry(NamedTuple):
+    path: Path
+    arcname: str
+    stat: os.stat_result
+
+
+class ScanStats:
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def add(self, entry: ScanEntry) -> None:
+        if stat.S_ISDIR(entry.stat.st_mode):
+            self.dirs += 1
+        else:
+            self.files += 1
+            if stat.S_ISREG(entry.stat.st_mode):
+                self.bytes += entry.stat.st_size
+
+    def as_dict(self) -> Dict[str, int]:
+        return {"files": self.files, "dirs": self.dirs, "bytes": self.bytes, "errors": self.errors}
+
+    def __str__(self) -> str:
+        return f"{self.files} files, {self.dirs} folders, {self.bytes:,} bytes, {self.errors} errors"
+
+
+_pools = PriorityPools(SCAN_WORKERS, "sbk-scan")
+
+
+def _pool() -> ThreadPoolExecutor:
+    # Metadata calls block on the disk, not the CPU, so this pool is wider than the core count.
+    return _pools.get()
+
+
+def _list_dir(path: Path, arcname: str) -> Tuple[List[ScanEntry], List[str]]:
+    """Lists and lstats one directory. Returns (sorted entries, error messages)."""
+    try:
+        with os.scandir(path) as it:
+            dirents = sorted(it, key=lambda d: d.name)
+    except OSError as e:
+        return [], [f"Could not list {path}, skipping its contents. Reason: {e}"]
+    entries, errors = [], []
+    for d in dirents:
+        try:
+            entries.append(ScanEntry(Path(d.path), f"{arcname}/{d.name}", d.stat(follow_symlinks=False)))
+        except OSError as e:
+            errors.append(f"Could not add {d.path} to archive, skipping. Reason: {e}")
+    return entries, errors
+
+
+def _scan_tree(root: ScanEntry, stats: ScanStats, progress: Optional[Callable[[ScanStats], None]]) -> Iterator[ScanEntry]:
+    pool = _pool()
+    pending: Dict[str, Future] = {}
+    stack = [iter([root])]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+        stats.add(entry)
+        if progress and (stats.files + stats.dirs) % PROGRESS_EVERY == 0:
+            progress(stats)
+        yield entry
+        if not stat.S_ISDIR(entry.stat.st_mode):
+            continue
+        future = pending.pop(entry.arcname, None) or pool.submit(_list_dir, entry.path, entry.arcname)
+        children, errors = future.result()
+        for message in errors:
+            logging.warning(message)
+        stats.errors += len(errors)
+        # List the subdirectories ahead of time; they are visited shortly, in order.
+        for child in children:
+            if len(pending) >= MAX_PENDING_DIRS:
+                break
+            if stat.S_ISDIR(child.stat.st_mode):
+                pending[child.arcname] = pool.submit(_list_dir, child.path, child.arcname)
+        stack.append(iter(children))
+
+
+def scan_tree(path: Path, arcname: str, stats: Optional[ScanStats] = None,
+              progress: Optional[Callable[[ScanStats], None]] = None) -> Iterator[ScanEntry]:
+    """Yields path, stored as arcname, and everything under it, like scan() does for a source."""
+    stats = stats if stats is not None else ScanStats()
+    try:
+        st = path.lstat()
+    except OSError as e:
+        logging.warning(f"Could not add {path} to archive, skipping. Reason: {e}")
+        stats.errors += 1
+        return
+    yield from _scan_tree(ScanEntry(path, arcname, st), stats, progress)
+
+
+def scan(sources: List[str], stats: Optional[ScanStats] = None,
+         progress: Optional[Callable[[ScanStats], None]] = None) -> Iterator[ScanEntry]:
+    """Yields every entry under the sources, depth-first in sorted order, with its lstat result."""
+    stats = stats if stats is not None else ScanStats()
+    for src in sources:
+        p = Path(src)
+        yield from scan_tree(p, p.name, stats, progress)
+    if progress:
+        progress(stats)
+
+
+def total_size(sources: List[str], stop: Optional[threading.Event] = None) -> Optional[int]:
+    """
+    Bytes of regular files under the sources, as scan() finds them but in no particular order and
+    without its warnings. Returns None if stop is set before the count is done.
+    """
+    pool = _pool()
+    total = 0
+    dirs: List[Path] = []
+    for src in sources:
+        try:
+            st = os.lstat(src)
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            dirs.append(Path(src))
+        elif stat.S_ISREG(st.st_mode):
+            total += st.st_size
+    running: set = set()
+    while dirs or running:
+        if stop is not None and stop.is_set():
+            return None
+        while dirs and len(running) < COUNT_INFLIGHT:
+            running.add(pool.submit(_list_dir, dirs.pop(), ""))
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            for child in future.result()[0]:
+                if stat.S_ISDIR(child.stat.st_mode):
+                    dirs.append(child.path)
+                elif stat.S_ISREG(child.stat.st_mode):
+                    total += child.stat.st_size
+    return total
+
+
+def _read_file(path: Path, open_file: Callable) -> bytes:
+    with open_file(path, "rb") as f:
+        return f.read()
+
+
+def prefetch(entries: Iterable[ScanEntry], budget: int = PREFETCH_BYTES,
+             max_file: int = PREFETCH_MAX_FILE, open_file: Callable = open
+             ) -> Iterator[Tuple[ScanEntry, Optional[Future]]]:
+    """
+    Pairs each entry with a future for its contents when it is a small regular file.
+    At most budget bytes are read ahead of the consumer; order is preserved.
+    Files are opened with open_file (e.g. a throttle's, see throttle.py).
+    """
+    pool = _pool()
+    window: Deque[Tuple[ScanEntry, Optional[Future]]] = deque()
+    inflight = 0
+    it = iter(entries)
+    exhausted = False
+    while True:
+        while not exhausted and inflight < budget and len(window) < PREFETCH_MAX_ENTRIES:
+            entry = next(it, None)
+            if entry is None:
+                exhausted = True
+                break
+            future = None
+            if stat.S_ISREG(entry.stat.st_mode) and 0 < entry.stat.st_size <= max_file:
+                future = pool.submit(_read_file, entry.path, open_file)
+                inflight += entry.stat.st_size
+            window.append((entry, future))
+        if not window:
+            return
+        entry, future = window.popleft()
+        yield entry, future
+        if future is not None:
+            inflight -= entry.stat.st_size
@@ -1,49 +1,247 @@
 from __future__ import annotations
+import itertools
+import logging
+import os
+import threading
+import time
+from pathlib import Path
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-from typing import Callable, Dict
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from .archive import BLOCK_SIZE
+from .crypto import SEGMENT_SIZE
+from .scanner import PREFETCH_BYTES
+from .watcher import WATCH_DELAY, Watcher
 
 ### CHANGE ###
 # Use tzlocal to make the scheduler timezone-aware
 from tzlocal import get_localzone
 
+MAX_CONCURRENT_JOBS = 2
+JOBS_PER_DEVICE = 1
+# What one streaming backup holds at most: blocks and segments in flight plus the scanner's read-ahead.
+RUN_MEMORY = 2 * (os.cpu_count() or 1) * 2 * (BLOCK_SIZE + SEGMENT_SIZE) + PREFETCH_BYTES
+
+
+def _total_memory() -> int:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):  # no sysconf on Windows
+        return 4 * 1024**3
+
+
+def _device(path: str) -> int:
+    """The device a destination lives on (of its nearest existing parent if it does not exist yet)."""
+    p = Path(path).absolute()
+    while not p.exists() and p != p.parent:
+        p = p.parent
+    try:
+        return os.stat(p).st_dev
+    except OSError:
+        return -1
+
+
+def _devices(destination: Union[str, List[str]]) -> Tuple[int, ...]:
+    """Distinct devices of one destination or several (a run fanning out occupies all of them)."""
+    paths = [destination] if isinstance(destination, str) else destination
+    return tuple(sorted({d for d in map(_device, filter(None, paths)) if d != -1}))
+
+
+class _Run:
+    def __init__(self, job_id: str, fn: Callable[[], Any], devices: Tuple[int, ...], deadline: float, memory: int, seq: int):
+        self.job_id = job_id
+        self.fn = fn
+        self.devices = devices
+        self.deadline = deadline
+        self.memory = memory
+        self.seq = seq
+
+
+class JobExecutor:
+    """
+    Runs queued job runs with a global concurrency limit, a limit per destination device and a
+    memory budget, so jobs due at the same time do not all start at once and fight over the
+    same disks. Waiting runs start earliest deadline first, then longest expected run first
+    (runs never seen before count as longest), which keeps the batch's total wall time short.
+    A run that cannot start yet does not block runs for other devices behind it.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_JOBS, per_device: int = JOBS_PER_DEVICE,
+                 memory_budget: Optional[int] = None):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.per_device = max(1, int(per_device))
+        self.memory_budget = int(memory_budget) if memory_budget else _total_memory() // 2
+        self._cond = threading.Condition()
+        self._queue: List[_Run] = []
+        self._running: Dict[str, _Run] = {}
+        self._device_load: Dict[int, int] = {}
+        self._memory_in_use = 0
+        self._durations: Dict[str, float] = {}
+        self._seq = itertools.count()
+        self._stopped = False
+        self._dispatcher: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._dispatcher is None:
+            self._stopped = False
+            self._dispatcher = threading.Thread(target=self._dispatch, name="sbk-executor", daemon=True)
+            self._dispatcher.start()
+
+    def stop(self) -> None:
+        """Drops waiting runs; runs already started finish on their own."""
+        with self._cond:
+            self._stopped = True
+            self._queue.clear()
+            self._cond.notify_all()
+        self._dispatcher = None
+
+    def submit(self, job_id: str, fn: Callable[[], Any], destination: Union[str, List[str]] = "",
+               deadline: Optional[float] = None, memory: int = RUN_MEMORY) -> bool:
+        """
+        Queues a run of fn writing to destination (a folder or a list of them).
+        Returns False if the job is already waiting or running.
+        """
+        with self._cond:
+            if job_id in self._running or any(r.job_id == job_id for r in self._queue):
+                logging.info(f"Job '{job_id}' is still queued or running, skipping this run.")
+                return False
+            run = _Run(job_id, fn, _devices(destination),
+                       deadline if deadline is not None else float("inf"), memory, next(self._seq))
+            self._queue.append(run)
+            self._cond.notify_all()
+        return True
+
+    def pending(self) -> List[str]:
+        with self._cond:
+            return [r.job_id for r in sorted(self._queue, key=self._order)]
+
+    def running(self) -> List[str]:
+        with self._cond:
+            return list(self._running)
+
+    def _order(self, run: _Run) -> Tuple[float, float, int]:
+        return run.deadline, -self._durations.get(run.job_id, float("inf")), run.seq
+
+    def _fits(self, run: _Run) -> bool:
+        if len(self._running) >= self.max_concurrent:
+            return False
+        if any(self._device_load.get(device, 0) >= self.per_device for device in run.devices):
+            return False
+        # A run bigger than the whole budget still gets to go alone.
+        return not self._running or self._memory_in_use + run.memory <= self.memory_budget
+
+    def _dispatch(self) -> None:
+        with self._cond:
+            while not self._stopped:
+                run = next((r for r in sorted(self._queue, key=self._order) if self._fits(r)), None)
+                if run is None:
+                    self._cond.wait()
+                    continue
+                self._queue.remove(run)
+                self._running[run.job_id] = run
+                for device in run.devices:
+                    self._device_load[device] = self._device_load.get(device, 0) + 1
+                self._memory_in_use += run.memory
+                threading.Thread(target=self._run, args=(run,), name=f"sbk-job-{run.job_id}", daemon=True).start()
+
+    def _run(self, run: _Run) -> None:
+        started = time.monotonic()
+        try:
+            run.fn()
+        except Exception as e:
+            logging.error(f"Job '{run.job_id}' failed. Reason: {e}")
+        finally:
+            with self._cond:
+                self._durations[run.job_id] = time.monotonic() - started
+                del self._running[run.job_id]
+                for device in run.devices:
+                    self._device_load[device] -= 1
+                self._memory_in_use -= run.memory
+                self._cond.notify_all()
+
+
 class BackupScheduler:
-    def __init__(self):
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_JOBS, per_device: int = JOBS_PER_DEVICE,
+                 memory_budget: Optional[int] = None):
         ### CHANGE ###
         # Initialize scheduler with local timezone and store multiple jobs
         self._sched = BackgroundScheduler(timezone=str(get_localzone()))
         self._jobs: Dict[str, any] = {}
+        # APScheduler only enqueues; the executor decides when each run actually starts.
+        self.executor = JobExecutor(max_concurrent, per_device, memory_budget)
+        self._watchers: Dict[str, Watcher] = {}
 
     def start(self):
         if not self._sched.running:
             self._sched.start()
+        self.executor.start()
 
     def stop(self):
         if self._sched.running:
             self._sched.shutdown(wait=False)
+        self.executor.stop()
+        for watcher in self._watchers.values():
+            watcher.stop()
+        self._watchers.clear()
+
+    def watch(self, job: Dict[str, Any]) -> Optional[Watcher]:
+        """
+        Starts tracking changes under an incremental job's sources (see watcher.py). Unless its
+        "watch_delay" is 0, the job also runs that many seconds after changes settle.
+        """
+        self.unwatch(job["name"])
+        if not job.get("incremental") or job.get("destination_type") == "repository":
+            logging.warning(f"Watching for changes only helps incremental archive jobs; job '{job['name']}' scans as usual.")
+            return None
+        watcher = Watcher(job, lambda: self.run_now(job["name"]), job.get("watch_delay", WATCH_DELAY))
+        watcher.start()
+        self._watchers[job["name"]] = watcher
+        return watcher
+
+    def unwatch(self, job_id: str) -> None:
+        watcher = self._watchers.pop(job_id, None)
+        if watcher is not None:
+            watcher.stop()
+
+    def run_now(self, job_id: str) -> bool:
+        """Queues a run of a scheduled job now. Returns False if it is not scheduled or already queued."""
+        job = self._sched.get_job(job_id)
+        return job is not None and self._enqueue(*job.args)
 
     ### CHANGE ###
     # New method to add/update a specific job by ID (we'll use the job name)
-    def add_or_update_job(self, job_id: str, cron_expr: str, fn: Callable, *args, **kwargs):
-        self.remove_job(job_id) # Remove existing job if it exists
+    def add_or_update_job(self, job_id: str, cron_expr: str, fn: Callable, *args,
+                          destination: Union[str, List[str]] = "", **kwargs):
+        self._unschedule(job_id) # Remove existing job if it exists, keeping its watcher
         trigger = CronTrigger.from_crontab(cron_expr)
-        job = self._sched.add_job(fn, trigger, args=args, kwargs=kwargs, id=job_id, coalesce=True, max_instances=1)
+        job = self._sched.add_job(self._enqueue, trigger, args=(job_id, fn, args, kwargs, destination),
+                                  id=job_id, coalesce=True, max_instances=1)
         self._jobs[job_id] = job
 
+    def _enqueue(self, job_id: str, fn: Callable, args: tuple, kwargs: dict, destination: Union[str, List[str]]) -> bool:
+        # A run should be done before the job fires again, so its next fire time is the deadline.
+        job = self._sched.get_job(job_id)
+        deadline = job.next_run_time.timestamp() if job is not None and job.next_run_time else None
+        return self.executor.submit(job_id, lambda: fn(*args, **kwargs), destination, deadline)
+
     ### CHANGE ###
     # New method to remove a job by ID
     def remove_job(self, job_id: str):
+        self._unschedule(job_id)
+        self.unwatch(job_id)
+
+    def _unschedule(self, job_id: str) -> None:
         if job_id in self._jobs:
             self._sched.remove_job(job_id)
             del self._jobs[job_id]
-            
+
     ### CHANGE ###
     # Moved cron generation logic here to keep it self-contained
     @staticmethod
     def cron_from_job(job: dict) -> str:
         hour, minute = job.get("time", "10:00").split(":")
         freq = job.get("frequency", "Daily")
-        
+
         if freq == "Daily":
             return f"{minute} {hour} * * *"
         elif freq == "Weekly":
@@ -51,4 +249,4 @@ class BackupScheduler:
             days = {"Sunday":"0", "Monday":"1", "Tuesday":"2", "Wednesday":"3", "Thursday":"4", "Friday":"5", "Saturday":"6"}
             return f"{minute} {hour} * * {days.get(dow, '1')}"
         # Add other frequencies like Monthly if needed
-        return f"{minute} {hour} * * *"
\ No newline at end of file
+        return f"{minute} {hour} * * *"
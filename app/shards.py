@@ -0,0 +1,127 @@
+from __future__ import annotations
+import glob
+import heapq
+import io
+import json
+import multiprocessing
+import stat
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+from .crypto import KdfParams, SegmentedWriter, container_key, encrypt_blob, decrypt_blob, set_kdf_params
+from .scanner import ScanEntry
+from .throttle import enter_background
+from .utils import read_exact
+
+# Sharded backups. tarfile is pure Python, so on trees of millions of small files building the
+# headers pins one core however fast the codecs are. With shards, run_backup splits the scanned
+# entries and writes each part as an archive of its own (tar, blocks, SBK2, index as usual) in
+# its own worker process, next to a small shard map under the backup's own name:
+#   <name>.sbk       magic(4)=SBSM | SBK2 container header | encrypt_blob(map key, JSON)
+#   <name>.sbk.s00   the metadata shard: chain metadata, folders, symlinks and special files
+#   <name>.sbk.s01   regular files, the shards balanced by size (hard links kept together)
+# The map's JSON is {"version", "shards": [{"name", "header"}]} and its header is the associated
+# data; the map key comes from the header's archive key (crypto.container_key). A shard's
+# "header" is its own SBK2 header (hex), whose random salts every one of its segments is
+# authenticated against, so a shard from another backup, even under the same name, or one moved
+# into another's place is refused when the map is read. Each shard keeps its
+# entries in scan order. Restore and verify decode the file shards in worker processes at the
+# same time, then the metadata shard, so folder times and deletions are applied last.
+
+MAP_MAGIC = b"SBSM"
+MAP_VERSION = 2
+MAP_KEY_INFO = b"SecureBackup shard map"
+# Per-file cost of archiving (headers, syscalls) in bytes of file data, when balancing shards.
+FILE_WEIGHT = 64 * 1024
+
+
+def shard_name(name: str, number: int) -> str:
+    return f"{name}.s{number:02d}"
+
+
+def shard_paths(path: Union[str, Path]) -> List[Path]:
+    """The shard files next to a backup, in order; none for an unsharded backup."""
+    path = Path(path)
+    found = []
+    for candidate in path.parent.glob(glob.escape(path.name) + ".s[0-9][0-9]*"):
+        number = candidate.name[len(path.name) + 2:]
+        if number.isdigit():
+            found.append((int(number), candidate))
+    return [p for _, p in sorted(found)]
+
+
+def partition(entries: List[ScanEntry], shards: int) -> List[List[ScanEntry]]:
+    """
+    Splits entries into the metadata shard and up to shards file shards of about the same
+    weight (size plus FILE_WEIGHT a file), largest first. Empty file shards are left out.
+    """
+    meta: List[int] = []
+    groups: Dict[Any, List[int]] = {}
+    for i, entry in enumerate(entries):
+        st = entry.stat
+        if not stat.S_ISREG(st.st_mode):
+            meta.append(i)
+            continue
+        # Hard links share one shard, so the later names are stored as links to the first.
+        key = (st.st_ino, st.st_dev) if st.st_ino and st.st_nlink > 1 else i
+        groups.setdefault(key, []).append(i)
+    weight = lambda members: entries[members[0]].stat.st_size + FILE_WEIGHT * len(members)
+    loads = [(0, n) for n in range(shards)]
+    parts: List[List[int]] = [[] for _ in range(shards)]
+    for members in sorted(groups.values(), key=weight, reverse=True):
+        load, n = heapq.heappop(loads)
+        parts[n].extend(members)
+        heapq.heappush(loads, (load + weight(members), n))
+    return [[entries[i] for i in meta]] + [[entries[i] for i in sorted(part)] for part in parts if part]
+
+
+def write_shard_map(fileobj, password: str, shards: List[Tuple[str, bytes]]) -> None:
+    """Writes the map of the shards, in order, given as (file name, SBK2 header) pairs."""
+    buf = io.BytesIO()
+    SegmentedWriter(buf, password)  # only for a fresh header, with its own archive salt
+    header = buf.getvalue()
+    _, map_key = container_key(io.BytesIO(header), password, MAP_KEY_INFO)
+    listed = [{"name": name, "header": shard_header.hex()} for name, shard_header in shards]
+    blob = json.dumps({"version": MAP_VERSION, "shards": listed}).encode("utf-8")
+    fileobj.write(MAP_MAGIC + header + encrypt_blob(map_key, blob, MAP_MAGIC + header))
+
+
+def read_shard_map(path: Union[str, Path], password: str) -> Optional[List[Path]]:
+    """
+    The shard files of a sharded backup, metadata shard first, or None for any other backup.
+    Raises ValueError if a shard file is not the one the map was written with.
+    """
+    path = Path(path)
+    with open(path, "rb") as f:
+        if read_exact(f, len(MAP_MAGIC)) != MAP_MAGIC:
+            return None
+        header, map_key = container_key(f, password, MAP_KEY_INFO)
+        blob = f.read()
+    shard_map = json.loads(decrypt_blob(map_key, blob, MAP_MAGIC + header))
+    if shard_map.get("version") != MAP_VERSION:
+        raise ValueError("Unsupported shard map version")
+    shards = []
+    for shard in shard_map["shards"]:
+        shard_path = path.parent / shard["name"]
+        expected = bytes.fromhex(shard["header"])
+        with open(shard_path, "rb") as f:
+            if read_exact(f, len(expected)) != expected:
+                raise ValueError(f"{shard_path.name} does not belong to this backup (replaced or from another backup)")
+        shards.append(shard_path)
+    return shards
+
+
+def _init_worker(kdf: KdfParams, background: bool) -> None:
+    set_kdf_params(*kdf)
+    if background:
+        enter_background()
+
+
+def process_pool(workers: int, kdf: Optional[KdfParams] = None, background: bool = False) -> ProcessPoolExecutor:
+    """
+    Worker processes for one sharded run (or a repository run's chunking). They are spawned rather
+    than forked (the parent has pool threads running) and take the run's scrypt cost and
+    background priority with them.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker, initargs=(kdf or KdfParams(), background))
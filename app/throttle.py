@@ -0,0 +1,249 @@
+from __future__ import annotations
+import ctypes
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+# Limits for jobs that share a host with live services. A Throttle caps a run's read and write
+# bandwidth and the files it opens per second with token buckets, shared by every thread of
+# the run; files it opens (or wraps) take their tokens as they read and write. Background
+# runs also lower their CPU and IO priority (Linux: nice and the idle IO class) and drop the
+# pages they read or wrote from the page cache when a file is closed (posix_fadvise
+# DONTNEED), so a backup does not push a live workload's data out of memory. Their work goes to
+# background thread pools of its own (PriorityPools), so it never shares pool threads with
+# normal-priority runs.
+# Job settings: read_limit_mb and write_limit_mb (MB/s), file_limit (files/s) and background.
+
+BACKGROUND_NICE = 19
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "i386": 289, "i686": 289, "armv7l": 314, "ppc64le": 273, "s390x": 282}
+
+_thread = threading.local()
+
+
+class TokenBucket:
+    """Lets rate units a second through on average, in bursts of up to burst units (a second's worth by default)."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, n: float) -> float:
+        """Takes n units, sleeping until the bucket has covered them; returns the seconds slept."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Going into debt lets a take bigger than the burst through; later takes wait it off.
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def _drop_cache(f) -> None:
+    try:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    except (AttributeError, OSError, ValueError):
+        pass
+
+
+class _ThrottledFile:
+    """File object taking tokens from a Throttle for everything read or written through it."""
+
+    def __init__(self, fileobj, throttle: "Throttle"):
+        self._f = fileobj
+        self._throttle = throttle
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._f.read(size)
+        self._throttle.read(len(data))
+        return data
+
+    def readinto(self, buf) -> int:
+        n = self._f.readinto(buf) or 0
+        self._throttle.read(n)
+        return n
+
+    def write(self, data) -> int:
+        self._throttle.wrote(len(data))
+        return self._f.write(data)
+
+    def close(self) -> None:
+        if self._throttle.background and not self._f.closed:
+            self._f.flush()
+            _drop_cache(self._f)  # clean pages only: written data goes once it has been synced
+        self._f.close()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._f, name)
+
+    def __enter__(self) -> "_ThrottledFile":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def lower_priority() -> None:
+    """
+    Lowers the calling thread's CPU priority to BACKGROUND_NICE and its IO priority to the idle
+    class (Linux only). Threads it starts afterwards inherit both; neither can be raised back
+    without privileges.
+    """
+    if not sys.platform.startswith("linux"):
+        logging.warning("Background priority is only supported on Linux; running at normal priority.")
+        return
+    tid = threading.get_native_id()
+    try:
+        # On Linux, PRIO_PROCESS with a thread id applies to that thread alone.
+        if os.getpriority(os.PRIO_PROCESS, tid) < BACKGROUND_NICE:
+            os.setpriority(os.PRIO_PROCESS, tid, BACKGROUND_NICE)
+    except OSError as e:
+        logging.warning(f"Could not lower the CPU priority. Reason: {e}")
+    number = _IOPRIO_SET.get(platform.machine())
+    if number is None:
+        logging.warning(f"Could not lower the IO priority: unknown system call number on {platform.machine()}.")
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(number, _IOPRIO_WHO_PROCESS, tid, _IOPRIO_CLASS_IDLE << _IOPRIO_CLASS_SHIFT) != 0:
+        logging.warning(f"Could not lower the IO priority. Reason: {os.strerror(ctypes.get_errno())}")
+
+
+def in_background() -> bool:
+    """True on threads at background priority: a background run's own thread and its pool threads."""
+    return getattr(_thread, "background", False)
+
+
+def enter_background() -> None:
+    """Lowers the calling thread to background priority and marks it, so it uses the background pools."""
+    lower_priority()
+    _thread.background = True
+
+
+def _background_worker() -> None:
+    _thread.background = True
+    if sys.platform.startswith("linux"):
+        lower_priority()
+
+
+class PriorityPools:
+    """
+    A lazily created thread pool for each priority. Pool threads take the priority of the
+    thread that starts them, and a lowered priority cannot be raised again, so get() hands
+    background threads a pool of their own, whose threads lower themselves as they start,
+    and every other thread the normal pool, which background threads never touch.
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str):
+        self._max_workers = max_workers
+        self._prefix = thread_name_prefix
+        self._pools: Dict[bool, ThreadPoolExecutor] = {}
+        self._lock = threading.Lock()
+
+    def get(self) -> ThreadPoolExecutor:
+        background = in_background()
+        pool = self._pools.get(background)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(background)
+                if pool is None:
+                    if background:
+                        pool = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix=self._prefix + "-bg",
+                                                  initializer=_background_worker)
+                    else:
+                        pool = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix=self._prefix)
+                    self._pools[background] = pool
+        return pool
+
+
+class Throttle:
+    """
+    A run's limits: read_bps and write_bps in bytes a second, files_per_s in files opened a
+    second (None for no limit), and background priority. waited adds up the seconds the
+    limits held the run back.
+    """
+
+    def __init__(self, read_bps: Optional[float] = None, write_bps: Optional[float] = None,
+                 files_per_s: Optional[float] = None, background: bool = False):
+        self._read = TokenBucket(read_bps) if read_bps else None
+        self._write = TokenBucket(write_bps) if write_bps else None
+        self._files = TokenBucket(files_per_s) if files_per_s else None
+        self.background = background
+        self.waited = 0.0
+        # Reader, writer and pool threads of one run all report their waits here.
+        self._waited_lock = threading.Lock()
+
+    @classmethod
+    def from_job(cls, job: Dict[str, Any]) -> Optional["Throttle"]:
+        """The job's limits, or None if it has none."""
+        mb = 1024 * 1024
+        read, write, files = job.get("read_limit_mb"), job.get("write_limit_mb"), job.get("file_limit")
+        background = bool(job.get("background", False))
+        if not (read or write or files or background):
+            return None
+        return cls(read and read * mb, write and write * mb, files, background)
+
+    def limits(self, share: int = 1) -> Dict[str, Any]:
+        """Arguments for a Throttle with a 1/share part of these limits, e.g. for a worker process."""
+        part = lambda bucket: bucket.rate / share if bucket is not None else None
+        return {"read_bps": part(self._read), "write_bps": part(self._write), "files_per_s": part(self._files),
+                "background": self.background}
+
+    def _held(self, seconds: float) -> None:
+        if seconds:
+            with self._waited_lock:
+                self.waited += seconds
+
+    def read(self, n: int) -> None:
+        if self._read is not None and n:
+            self._held(self._read.take(n))
+
+    def wrote(self, n: int) -> None:
+        if self._write is not None and n:
+            self._held(self._write.take(n))
+
+    def file(self) -> None:
+        if self._files is not None:
+            self._held(self._files.take(1))
+
+    def wrap(self, fileobj) -> _ThrottledFile:
+        return _ThrottledFile(fileobj, self)
+
+    def open(self, path, mode: str = "rb") -> _ThrottledFile:
+        return _ThrottledFile(open(path, mode), self)
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Calls fn. A background run goes on a thread of its own at lowered priority, which ends
+        with it: the priority cannot be raised again, so it must not outlive the run. Its pool
+        work goes to the background pools (see PriorityPools).
+        """
+        if not self.background:
+            return fn(*args, **kwargs)
+        result: Dict[str, Any] = {}
+
+        def run() -> None:
+            enter_background()
+            try:
+                result["value"] = fn(*args, **kwargs)
+            except BaseException as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=run, name="sbk-background", daemon=True)
+        thread.start()
+        thread.join()
+        if "error" in result:
+            raise result["error"]
+        return result["value"]
@@ -23,9 +23,35 @@ TEMP_DIR = APPDATA_DIR / "temp"
 TEMP_DIR.mkdir(exist_ok=True)
 
 
+MANIFEST_DIR = APPDATA_DIR / "manifests" # encrypted per-job file manifests for incremental backups
+MANIFEST_DIR.mkdir(exist_ok=True)
+
+
+CHECKPOINT_DIR = APPDATA_DIR / "checkpoints" # resume journals of interrupted backups
+CHECKPOINT_DIR.mkdir(exist_ok=True)
+
+
+CATALOG_PATH = APPDATA_DIR / "catalog.db" # SQLite catalog of every backup and the files in it
+
+
+WATCH_DIR = APPDATA_DIR / "watch" # changed-path sets of jobs in watch mode
+WATCH_DIR.mkdir(exist_ok=True)
+
+
 ### CHANGE ###
 # Removed DEFAULT_BACKUP_NAME to prevent overwriting issues.
 # Filenames are now generated dynamically in the GUI.
 
 
-CHUNK_SIZE = 1024 * 1024 # 1MB streaming
\ No newline at end of file
+CHUNK_SIZE = 1024 * 1024 # 1MB streaming
+
+
+def read_exact(fileobj, size: int) -> bytes:
+    """Reads up to size bytes, looping over short reads; returns fewer only at EOF."""
+    buf = fileobj.read(size)
+    while buf and len(buf) < size:
+        more = fileobj.read(size - len(buf))
+        if not more:
+            break
+        buf += more
+    return buf
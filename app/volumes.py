@@ -0,0 +1,437 @@
+from __future__ import annotations
+import base64
+import bisect
+import glob
+import hashlib
+import hmac
+import io
+import json
+import os
+import struct
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Union
+from .crypto import container_key, encrypt_blob, decrypt_blob, SEGMENTED_HEADER, TAG_LEN
+from .pipeline import FanOut, ReadAhead
+from .utils import read_exact
+from .throttle import PriorityPools
+
+# Split backups. With a volume size, run_backup cuts the SBK2 container into numbered volumes
+# of at most that size, each holding whole segments, and writes a volume map under the
+# backup's own name in their place:
+#   <name>.sbk       magic(4)=SBVM | SBK2 container header | encrypt_blob(map key, JSON)
+#   <name>.sbk.001   magic(4)=SBV1 | set id(16) | number(4) | first segment(8) | mac(16) | segments
+# The map's JSON is {"version", "set", "volumes": [{"name", "first", "size"}], "index"}, size
+# being the segment bytes in that volume and index a base64 copy of the archive index block
+# (archive.parse_index), which stays readable when the last volume is lost. The map header is
+# its associated data. The mac is
+# HMAC-SHA256 (truncated) over the rest of the volume header. The map and volume keys come
+# from the container's archive key (crypto.container_key), so only the password opens either.
+# Every segment is still authenticated on its own, so a missing or damaged volume only takes
+# out the segments it holds: restore and verify carry on past it from the archive index.
+# VolumeSet reads the map and presents its volumes as the one container again.
+
+MAP_MAGIC = b"SBVM"
+VOLUME_MAGIC = b"SBV1"
+VOLUME_HEADER = struct.Struct(">4s16sIQ")
+MAC_LEN = 16
+MAP_VERSION = 1
+MAP_KEY_INFO = b"SecureBackup volume map"
+VOLUME_KEY_INFO = b"SecureBackup volume"
+# Full volumes still draining and syncing on their own threads while the next one is written.
+WRITE_VOLUMES = 4
+# Volumes a sequential read keeps open and reading ahead at once, each on its own thread.
+READ_VOLUMES = 4
+
+_pools = PriorityPools(WRITE_VOLUMES, "sbk-volume")
+
+
+def _pool() -> ThreadPoolExecutor:
+    return _pools.get()
+
+
+def _mac(key: bytes, header: bytes) -> bytes:
+    return hmac.new(key, header, hashlib.sha256).digest()[:MAC_LEN]
+
+
+class VolumeError(ValueError):
+    """A volume of a split backup is missing, damaged or belongs to another backup."""
+
+    def __init__(self, number: int, reason: str):
+        super().__init__(f"Volume {number} {reason}")
+        self.number = number
+
+
+def volume_name(name: str, number: int) -> str:
+    return f"{name}.{number:03d}"
+
+
+def volume_paths(path: Union[str, Path]) -> List[Path]:
+    """The volume files next to a backup, in order; none for a single-file backup."""
+    path = Path(path)
+    found = []
+    for candidate in path.parent.glob(glob.escape(path.name) + ".[0-9][0-9][0-9]*"):
+        number = candidate.name[len(path.name) + 1:]
+        if number.isdigit():
+            found.append((int(number), candidate))
+    return [p for _, p in sorted(found)]
+
+
+class VolumeWriter:
+    """
+    Write-only file object splitting the SBK2 container written to it (header first, as
+    SegmentedWriter does) into volumes of at most volume_size bytes, each opened with
+    open_target(folders, filename) in every destination folder still live. A full volume is
+    drained, synced and closed on the pool while the next one is being written, so several
+    volumes are in flight at once. close() writes the map last. failed and live() work as
+    for FanOut; files lists the names written, volumes first.
+    """
+
+    def __init__(self, dest_dirs: List[Path], name: str, password: str, volume_size: int,
+                 open_target: Callable[[List[Path], str], FanOut]):
+        self._dirs = dest_dirs
+        self._name = name
+        self._password = password
+        self._volume_size = volume_size
+        self._open = open_target
+        self._set_id = os.urandom(16)
+        self._header: Optional[bytes] = None
+        self._current: Optional[FanOut] = None
+        self._room = 0
+        self._volumes: List[Dict[str, Any]] = []
+        self._closing: Deque[Tuple[FanOut, Future]] = deque()
+        self._index: Optional[bytes] = None
+        self.failed: Dict[str, str] = {}
+        self.files: List[str] = []
+        self.closed = False
+
+    def writable(self) -> bool:
+        return True
+
+    def live(self) -> List[str]:
+        return [str(d) for d in self._dirs if str(d) not in self.failed]
+
+    def _start(self, header: bytes) -> None:
+        self._header = header
+        self._ct_len = SEGMENTED_HEADER.unpack_from(header)[-1] + TAG_LEN
+        segments = (self._volume_size - VOLUME_HEADER.size - MAC_LEN) // self._ct_len
+        self._capacity = max(1, segments) * self._ct_len
+        _, self._volume_key = container_key(io.BytesIO(header), self._password, VOLUME_KEY_INFO)
+        _, self._map_key = container_key(io.BytesIO(header), self._password, MAP_KEY_INFO)
+
+    def _open_file(self, name: str) -> FanOut:
+        self.files.append(name)
+        fout = self._open([d for d in self._dirs if str(d) not in self.failed], name)
+        self.failed.update(fout.failed)
+        return fout
+
+    def _next_volume(self) -> None:
+        if self._current is not None:
+            self._retire()
+        number = len(self._volumes) + 1
+        first = sum(v["size"] for v in self._volumes) // self._ct_len
+        name = volume_name(self._name, number)
+        self._current = self._open_file(name)
+        header = VOLUME_HEADER.pack(VOLUME_MAGIC, self._set_id, number, first)
+        self._current.write(header + _mac(self._volume_key, header))
+        self._volumes.append({"name": name, "first": first, "size": 0})
+        self._room = self._capacity
+
+    def _retire(self) -> None:
+        fout, self._current = self._current, None
+        self._closing.append((fout, _pool().submit(_finish, fout)))
+        while len(self._closing) > WRITE_VOLUMES:
+            self._wait_one()
+
+    def _wait_one(self) -> None:
+        fout, future = self._closing.popleft()
+        try:
+            future.result()
+        finally:
+            self.failed.update(fout.failed)
+
+    def write(self, data) -> int:
+        if self._header is None:
+            self._start(bytes(data))
+            return len(data)
+        pos = 0
+        while pos < len(data):
+            if not self._room:
+                self._next_volume()
+            piece = data if pos == 0 and len(data) <= self._room else bytes(memoryview(data)[pos:pos + self._room])
+            self._current.write(piece)
+            self._volumes[-1]["size"] += len(piece)
+            self._room -= len(piece)
+            pos += len(piece)
+        return len(data)
+
+    def keep_index(self, block: bytes) -> None:
+        """Keeps a copy of the archive's index block for the map."""
+        self._index = block
+
+    def flush(self) -> None:
+        if self._current is not None:
+            self._current.flush()
+
+    def fsync(self) -> None:
+        """Syncs the volume being written and waits for the ones still closing."""
+        if self._current is not None:
+            self._current.fsync()
+        while self._closing:
+            self._wait_one()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._current is not None:
+                self._retire()
+            while self._closing:
+                self._wait_one()
+            volume_map = {"version": MAP_VERSION, "set": self._set_id.hex(), "volumes": self._volumes}
+            if self._index is not None:
+                volume_map["index"] = base64.b64encode(self._index).decode("ascii")
+            blob = json.dumps(volume_map).encode("utf-8")
+            head = MAP_MAGIC + self._header
+            fout = self._open_file(self._name)
+            try:
+                fout.write(head + encrypt_blob(self._map_key, blob, head))
+                fout.fsync()
+            finally:
+                fout.close()
+                self.failed.update(fout.failed)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self) -> None:
+        self.closed = True
+        if self._current is not None:
+            self._current.abort()
+        for fout, _ in self._closing:
+            fout.abort()
+
+    def __enter__(self) -> "VolumeWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        # A failed backup gets no map; its volumes are only partial files.
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def _finish(fout: FanOut) -> None:
+    fout.fsync()
+    fout.close()
+
+
+class VolumeSet:
+    """
+    Read-only, seekable file object presenting a split backup as its SBK2 container again,
+    from the volume map at path; the volumes are looked for next to it. A volume is opened and
+    checked when first needed, and VolumeError (remembered in damaged) names one that is
+    missing, cut short or from another backup. stream() is the fast way to read it all.
+    index_block is the map's copy of the archive index block, if it has one.
+    """
+
+    def __init__(self, path: Union[str, Path], password: str, fileobj=None):
+        self.path = Path(path)
+        f = fileobj or open(self.path, "rb")
+        try:
+            f.seek(0)
+            if read_exact(f, len(MAP_MAGIC)) != MAP_MAGIC:
+                raise ValueError("Not a SecureBackup volume map")
+            self._header, map_key = container_key(f, password, MAP_KEY_INFO)
+            blob = f.read()
+        finally:
+            f.close()
+        volume_map = json.loads(decrypt_blob(map_key, blob, MAP_MAGIC + self._header))
+        if volume_map.get("version") != MAP_VERSION:
+            raise ValueError("Unsupported volume map version")
+        _, self._volume_key = container_key(io.BytesIO(self._header), password, VOLUME_KEY_INFO)
+        self._set_id = bytes.fromhex(volume_map["set"])
+        self.volumes: List[Dict[str, Any]] = volume_map["volumes"]
+        self.index_block = base64.b64decode(volume_map["index"]) if volume_map.get("index") else None
+        # Offset of each volume's first segment in the container.
+        self._starts = []
+        pos = len(self._header)
+        for volume in self.volumes:
+            self._starts.append(pos)
+            pos += volume["size"]
+        self.size = pos
+        self.damaged: Dict[int, str] = {}
+        self._files: Dict[int, Any] = {}
+        self._pos = 0
+        self.closed = False
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def open_volume(self, index: int):
+        """Opens volume index (0-based) and checks its header; the file is left at its first segment."""
+        volume = self.volumes[index]
+        number = index + 1
+        try:
+            f = open(self.path.parent / volume["name"], "rb")
+        except OSError as e:
+            error = VolumeError(number, f"cannot be opened: {e.strerror or e}")
+            self.damaged[number] = str(error)
+            raise error from e
+        try:
+            head = read_exact(f, VOLUME_HEADER.size + MAC_LEN)
+            if len(head) != VOLUME_HEADER.size + MAC_LEN or not hmac.compare_digest(
+                    head[VOLUME_HEADER.size:], _mac(self._volume_key, head[:VOLUME_HEADER.size])):
+                raise VolumeError(number, "has a damaged header or belongs to another backup")
+            _, set_id, stored_number, first = VOLUME_HEADER.unpack_from(head)
+            if set_id != self._set_id or stored_number != number or first != volume["first"]:
+                raise VolumeError(number, "belongs to another backup")
+            if os.fstat(f.fileno()).st_size != len(head) + volume["size"]:
+                raise VolumeError(number, "is truncated or has the wrong size")
+        except VolumeError as e:
+            f.close()
+            self.damaged[number] = str(e)
+            raise
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    def _file(self, index: int):
+        if index not in self._files:
+            self._files[index] = self.open_volume(index)
+        return self._files[index]
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            size = self.size - self._pos
+        out = []
+        while size > 0 and self._pos < self.size:
+            if self._pos < len(self._header):
+                piece = self._header[self._pos:self._pos + size]
+            else:
+                index = bisect.bisect_right(self._starts, self._pos) - 1
+                offset = self._pos - self._starts[index]
+                f = self._file(index)
+                f.seek(VOLUME_HEADER.size + MAC_LEN + offset)
+                piece = f.read(min(size, self.volumes[index]["size"] - offset))
+                if not piece:
+                    raise VolumeError(index + 1, "is truncated or has the wrong size")
+            out.append(piece)
+            self._pos += len(piece)
+            size -= len(piece)
+        return b"".join(out)
+
+    def readinto(self, buf) -> int:
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._pos, os.SEEK_END: self.size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def stream(self) -> "_VolumeStream":
+        """Reads the container front to back with several volumes read ahead at once."""
+        return _VolumeStream(self)
+
+    def close(self) -> None:
+        self.closed = True
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def __enter__(self) -> "VolumeSet":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class _VolumeStream:
+    """
+    Read-only file object over a VolumeSet from the start, keeping the next READ_VOLUMES
+    volumes open behind ReadAheads, so volumes on different disks (or a NAS that serves
+    several streams faster than one) are read at the same time. A volume that cannot be
+    opened raises its VolumeError when the read reaches it, not before.
+    """
+
+    def __init__(self, volumes: VolumeSet):
+        self._set = volumes
+        self._pending = volumes._header
+        self._next = 0
+        self._open: Deque[Tuple[Optional[ReadAhead], Optional[VolumeError]]] = deque()
+        self.closed = False
+        self._fill()
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self) -> None:
+        while len(self._open) < READ_VOLUMES and self._next < len(self._set.volumes):
+            try:
+                self._open.append((ReadAhead(self._set.open_volume(self._next)), None))
+            except VolumeError as e:
+                self._open.append((None, e))
+            self._next += 1
+
+    def read(self, size: int = -1) -> bytes:
+        out: List[bytes] = []
+        got = 0
+        while size < 0 or got < size:
+            if self._pending:
+                take = self._pending if size < 0 else self._pending[:size - got]
+                self._pending = self._pending[len(take):]
+            elif self._open:
+                ahead, error = self._open[0]
+                if error is not None:
+                    raise error
+                take = ahead.read(-1 if size < 0 else size - got)
+                if not take:
+                    ahead.close()
+                    self._open.popleft()
+                    self._fill()
+                    continue
+            else:
+                break
+            out.append(take)
+            got += len(take)
+        return b"".join(out)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        for ahead, _ in self._open:
+            if ahead is not None:
+                ahead.close()
+        self._open.clear()
+
+    def __enter__(self) -> "_VolumeStream":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def open_archive(path: Union[str, Path], password: str):
+    """Opens a backup for reading: the .sbk file itself, or a VolumeSet if it is a volume map."""
+    f = open(path, "rb")
+    try:
+        if read_exact(f, len(MAP_MAGIC)) == MAP_MAGIC:
+            return VolumeSet(path, password, f)
+        f.seek(0)
+    except BaseException:
+        f.close()
+        raise
+    return f
@@ -0,0 +1,355 @@
+from __future__ import annotations
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import logging
+import os
+import select
+import stat
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+from .manifest import load_manifest, signature
+from .utils import WATCH_DIR
+
+# Change tracking for jobs with "watch" set (Linux only). A Watcher holds an inotify watch on
+# every folder under a job's sources and keeps the arcnames that may have changed, so the
+# next incremental run looks at those alone instead of walking the whole tree
+# (backup._plan_changes). Setting up the watches walks the tree once per start, and that walk
+# is compared with the job's manifest to catch what changed while nothing was watching.
+# The set is kept under WATCH_DIR as JSON:
+#   {"version", "sources", "seq", "rescan", "paths": {arcname: seq}, "trees": {arcname: seq}}
+# A path is one entry (looked up together with everything under it if it is gone); a tree is
+# a folder that appeared and is walked whole. Each change gets the next seq, so a run only
+# clears what it saw. An event queue overflow, or running out of watches, sets rescan: the
+# next run walks everything. Like the catalog, the file holds names only and is not encrypted.
+
+WATCH_VERSION = 1
+WATCH_DELAY = 60.0
+SAVE_INTERVAL = 2.0
+READ_SIZE = 64 * 1024
+
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_DONT_FOLLOW = 0x02000000
+_IN_EXCL_UNLINK = 0x04000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+         | _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_DONT_FOLLOW | _IN_EXCL_UNLINK)
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+_libc_handle: Optional[ctypes.CDLL] = None
+
+
+def _libc() -> Optional[ctypes.CDLL]:
+    global _libc_handle
+    if _libc_handle is None and sys.platform.startswith("linux"):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch  # present since glibc 2.9
+            _libc_handle = libc
+        except (OSError, AttributeError):
+            return None
+    return _libc_handle
+
+
+def supported() -> bool:
+    return _libc() is not None
+
+
+class Changes(NamedTuple):
+    """What may have changed since the last run: single entries and whole folders, by arcname."""
+    paths: Set[str]
+    trees: Set[str]
+
+
+def watch_path(job_name: str) -> Path:
+    safe = "".join(c for c in job_name if c.isalnum() or c in ("_", "-"))[:40]
+    digest = hashlib.sha256(job_name.encode("utf-8")).hexdigest()[:12]
+    return WATCH_DIR / f"{safe}_{digest}.json"
+
+
+class Watcher:
+    """
+    Tracks changes under one job's sources on a background thread. take() hands a run what
+    changed (None when the run has to walk everything) and done() clears it once backed up.
+    With on_change, that is called once changes have settled for delay seconds; if it returns
+    False (e.g. a run is still going) it is called again after another delay.
+    """
+
+    def __init__(self, job: Dict[str, Any], on_change: Optional[Callable[[], bool]] = None, delay: float = WATCH_DELAY):
+        self.job_name = job["name"]
+        self.sources = list(job["sources"])
+        self.path = watch_path(self.job_name)
+        self._password = job["password"]
+        self._on_change = on_change
+        self._delay = delay
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._rescan = 0  # seq of the last overflow, 0 for none
+        self._paths: Dict[str, int] = {}
+        self._trees: Dict[str, int] = {}
+        self._unsaved = False
+        self._last_change: Optional[float] = None
+        self._ready = False
+        self._complete = True
+        self._wds: Dict[int, Tuple[Path, str]] = {}
+        self._roots: Set[int] = set()
+        self._fd = -1
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read the changes recorded for job '{self.job_name}', its next run scans everything. Reason: {e}")
+            self._overflow()
+            return
+        if state.get("version") != WATCH_VERSION or state.get("sources") != self.sources:
+            self._overflow()
+            return
+        self._seq = state["seq"]
+        self._rescan = state["rescan"]
+        self._paths = state["paths"]
+        self._trees = state["trees"]
+
+    def save(self) -> None:
+        with self._lock:
+            state = {"version": WATCH_VERSION, "sources": self.sources, "seq": self._seq, "rescan": self._rescan,
+                     "paths": dict(self._paths), "trees": dict(self._trees)}
+            self._unsaved = False
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+    def start(self) -> None:
+        if not supported():
+            logging.warning(f"Watching for changes needs Linux inotify; job '{self.job_name}' scans its sources on every run.")
+            return
+        fd = _libc().inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            e = ctypes.get_errno()
+            logging.warning(f"Could not watch job '{self.job_name}' for changes, it scans its sources on every run. Reason: {os.strerror(e)}")
+            return
+        self._fd = fd
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"sbk-watch-{self.job_name}", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+        self._save_quietly()
+
+    def take(self) -> Tuple[int, Optional[Changes]]:
+        """(seq to pass to done(), the changes so far or None if the run must walk everything)."""
+        with self._lock:
+            if not self._ready or not self._complete or self._rescan:
+                return self._seq, None
+            return self._seq, Changes(set(self._paths), set(self._trees))
+
+    def done(self, seq: int) -> None:
+        """Forgets the changes a run that called take() has backed up."""
+        with self._lock:
+            self._paths = {a: s for a, s in self._paths.items() if s > seq}
+            self._trees = {a: s for a, s in self._trees.items() if s > seq}
+            if self._rescan <= seq:
+                self._rescan = 0
+            self._unsaved = True
+        self._save_quietly()
+
+    def _save_quietly(self) -> None:
+        try:
+            self.save()
+        except OSError as e:
+            logging.warning(f"Could not save the changes recorded for job '{self.job_name}'. Reason: {e}")
+
+    def _mark(self, arcname: str, tree: bool = False) -> None:
+        with self._lock:
+            self._seq += 1
+            (self._trees if tree else self._paths)[arcname] = self._seq
+            self._unsaved = True
+            self._last_change = time.monotonic()
+
+    def _overflow(self) -> None:
+        with self._lock:
+            self._seq += 1
+            self._rescan = self._seq
+            self._unsaved = True
+            self._last_change = time.monotonic()
+
+    def _watch(self, path: Path, arcname: str) -> bool:
+        """Adds a watch; False once the system is out of watches."""
+        wd = _libc().inotify_add_watch(self._fd, os.fsencode(path), _MASK)
+        if wd >= 0:
+            self._wds[wd] = (path, arcname)
+            return True
+        e = ctypes.get_errno()
+        if e == errno.ENOSPC:
+            logging.warning(f"Out of inotify watches while watching job '{self.job_name}', it scans its sources on every "
+                            f"run until restarted (raise fs.inotify.max_user_watches to watch it).")
+            self._complete = False
+            self._overflow()
+            return False
+        return True  # gone already or unreadable: the scan of the next run reports it
+
+    def _add_tree(self, path: Path, arcname: str, known: Optional[Dict[str, List[Any]]] = None,
+                  seen: Optional[Set[str]] = None) -> bool:
+        """
+        Watches path and every folder under it. With known (manifest entries), also marks what
+        differs from them and collects every arcname found in seen. Each folder is watched
+        before it is listed, so nothing that changes in between is missed.
+        """
+        stack = [(path, arcname)]
+        while stack and not self._stop.is_set():
+            p, a = stack.pop()
+            try:
+                st = os.lstat(p)
+            except OSError:
+                continue
+            if known is not None:
+                seen.add(a)
+                old = known.get(a)
+                if old is None or old[:3] != signature(st):
+                    self._mark(a)
+            if not stat.S_ISDIR(st.st_mode):
+                if p == path and not self._watch(p, a):
+                    return False
+                continue
+            if not self._watch(p, a):
+                return False
+            try:
+                with os.scandir(p) as it:
+                    children = [(Path(d.path), f"{a}/{d.name}", d.is_dir(follow_symlinks=False)) for d in it]
+            except OSError:
+                continue
+            for child, child_arc, is_dir in children:
+                if known is not None or is_dir:
+                    stack.append((child, child_arc))
+        return True
+
+    def _setup(self) -> None:
+        manifest = load_manifest(self.job_name, self._password)
+        known = manifest["entries"] if manifest else {}
+        seen: Set[str] = set()
+        roots = set()
+        for src in self.sources:
+            p = Path(src)
+            if not os.path.lexists(p):
+                continue  # an unavailable source keeps its entries, as in a full scan
+            roots.add(p.name)
+            before = set(self._wds)
+            if not self._add_tree(p, p.name, known, seen):
+                return
+            self._roots.update(wd for wd, (path, _) in self._wds.items() if wd not in before and path == p)
+        for arcname in known:
+            if arcname not in seen and arcname.split("/", 1)[0] in roots:
+                self._mark(arcname)  # deleted while nothing was watching
+        with self._lock:
+            self._ready = True
+        logging.info(f"Watching {len(self._wds):,} folders of job '{self.job_name}' for changes.")
+
+    def _run(self) -> None:
+        try:
+            self._setup()
+            poller = select.poll()
+            poller.register(self._fd, select.POLLIN)
+            last_save = time.monotonic()
+            while not self._stop.is_set():
+                if poller.poll(1000):
+                    try:
+                        self._handle(os.read(self._fd, READ_SIZE))
+                    except BlockingIOError:
+                        pass
+                now = time.monotonic()
+                if self._unsaved and now - last_save >= SAVE_INTERVAL:
+                    self._save_quietly()
+                    last_save = now
+                self._settle(now)
+        except Exception as e:
+            logging.error(f"Stopped watching job '{self.job_name}', it scans its sources on every run. Reason: {e}")
+            with self._lock:
+                self._complete = False
+
+    def _settle(self, now: float) -> None:
+        if self._on_change is None or not self._delay or self._last_change is None:
+            return
+        if now - self._last_change < self._delay:
+            return
+        with self._lock:
+            pending = bool(self._paths or self._trees or self._rescan)
+            self._last_change = None
+        if pending and self._on_change() is False:
+            with self._lock:
+                if self._last_change is None:
+                    self._last_change = now
+
+    def _handle(self, data: bytes) -> None:
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0"))
+            offset += _EVENT.size + length
+            if mask & _IN_Q_OVERFLOW:
+                logging.warning(f"Too many changes at once under job '{self.job_name}', its next run scans everything.")
+                self._overflow()
+                continue
+            if mask & _IN_IGNORED:
+                self._wds.pop(wd, None)
+                continue
+            watched = self._wds.get(wd)
+            if watched is None:
+                continue
+            path, arcname = watched
+            if not name:
+                if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF) and wd in self._roots:
+                    logging.warning(f"Source {path} of job '{self.job_name}' was moved or deleted, its runs scan everything until restarted.")
+                    with self._lock:
+                        self._complete = False
+                self._mark(arcname)
+                continue
+            child, child_arc = path / name, f"{arcname}/{name}"
+            if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                self._add_tree(child, child_arc)
+                self._mark(child_arc, tree=True)
+            else:
+                if mask & _IN_ISDIR and mask & _IN_MOVED_FROM:
+                    self._unwatch(child_arc)
+                self._mark(child_arc)
+            if mask & (_IN_CREATE | _IN_DELETE | _IN_MOVED_FROM | _IN_MOVED_TO):
+                self._mark(arcname)  # the folder's own mtime changed too
+
+    def _unwatch(self, arcname: str) -> None:
+        """Drops the watches of a folder moved away; if it reappears under the sources it is watched anew."""
+        inside = arcname + "/"
+        for wd, (_, a) in list(self._wds.items()):
+            if a == arcname or a.startswith(inside):
+                _libc().inotify_rm_watch(self._fd, wd)
+                del self._wds[wd]
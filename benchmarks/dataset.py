@@ -0,0 +1,97 @@
+from __future__ import annotations
+import json
+import random
+import shutil
+from pathlib import Path
+from typing import Any, Dict
+
+# Deterministic synthetic dataset for the benchmarks. The same profile and seed always produce
+# byte-identical files, so runs on different commits measure the same input:
+#   tiny/    many small text files in nested folders (metadata- and syscall-bound)
+#   text/    medium-sized compressible text
+#   media/   incompressible random data with media extensions (exercises the stored-block path)
+#   huge/    a few large files, half text-like and half random
+
+PROFILES: Dict[str, Dict[str, int]] = {
+    # name: tiny files, text files, text file size, media files, media file size, huge files, huge file size
+    "small": {"tiny": 2000, "text": 20, "text_size": 256 * 1024, "media": 10, "media_size": 1024 * 1024,
+              "huge": 2, "huge_size": 16 * 1024 * 1024},
+    "medium": {"tiny": 20000, "text": 200, "text_size": 512 * 1024, "media": 50, "media_size": 4 * 1024 * 1024,
+               "huge": 4, "huge_size": 128 * 1024 * 1024},
+    "large": {"tiny": 200000, "text": 1000, "text_size": 1024 * 1024, "media": 200, "media_size": 8 * 1024 * 1024,
+              "huge": 8, "huge_size": 512 * 1024 * 1024},
+}
+MARKER = ".dataset.json"
+WRITE_SIZE = 1024 * 1024
+
+_WORDS = ("backup restore archive segment block stream cipher nonce header index manifest "
+          "snapshot chunk repository scheduler volume throughput latency buffer queue thread "
+          "the of and to in is that for it with as on be at by this from or have an").split()
+
+
+def _text(rng: random.Random, size: int) -> bytes:
+    out = []
+    n = 0
+    while n < size:
+        line = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(4, 16))) + "\n"
+        out.append(line)
+        n += len(line)
+    return "".join(out).encode("ascii")[:size]
+
+
+def _write(path: Path, rng: random.Random, size: int, compressible: bool) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            n = min(WRITE_SIZE, remaining)
+            f.write(_text(rng, n) if compressible else rng.randbytes(n))
+            remaining -= n
+
+
+def generate(root: Path, profile: str = "small", seed: int = 1) -> Dict[str, Any]:
+    """
+    Creates the dataset under root (reusing it if an identical one is already there).
+    Returns its description: profile, seed, file count and total bytes.
+    """
+    spec = PROFILES[profile]
+    description = {"profile": profile, "seed": seed, **spec}
+    marker = root / MARKER
+    if marker.exists():
+        existing = json.loads(marker.read_text())
+        if {k: existing.get(k) for k in description} == description:
+            return existing
+        shutil.rmtree(root)
+    root.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    files = total = 0
+    for i in range(spec["tiny"]):
+        size = rng.randint(0, 4096)
+        _write(root / "tiny" / f"d{i // 500:03d}" / f"s{(i // 50) % 10}" / f"f{i:06d}.txt", rng, size, True)
+        files, total = files + 1, total + size
+    for i in range(spec["text"]):
+        _write(root / "text" / f"doc{i:04d}.txt", rng, spec["text_size"], True)
+        files, total = files + 1, total + spec["text_size"]
+    for i in range(spec["media"]):
+        _write(root / "media" / f"img{i:04d}{('.jpg', '.mp4', '.zip')[i % 3]}", rng, spec["media_size"], False)
+        files, total = files + 1, total + spec["media_size"]
+    for i in range(spec["huge"]):
+        _write(root / "huge" / f"big{i}.bin", rng, spec["huge_size"], compressible=(i % 2 == 0))
+        files, total = files + 1, total + spec["huge_size"]
+    description.update(files=files, bytes=total)
+    marker.write_text(json.dumps(description))
+    return description
+
+
+def largest_file(root: Path) -> Path:
+    return max((p for p in (root / "huge").iterdir()), key=lambda p: (p.stat().st_size, p.name))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate the benchmark dataset.")
+    parser.add_argument("root", type=Path)
+    parser.add_argument("--profile", choices=list(PROFILES), default="small")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    print(json.dumps(generate(args.root, args.profile, args.seed)))
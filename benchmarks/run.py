@@ -0,0 +1,420 @@
+from __future__ import annotations
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue as queue_module
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .dataset import PROFILES, generate, largest_file
+
+# Benchmark harness: python -m benchmarks.run [--profile small] [--baseline old.json]
+# Every measured run happens in a fresh process, so the peak RSS, the key cache and the thread
+# pools all start cold, and the numbers don't depend on which case ran before. Setup work (the
+# archive a restore reads, the ciphertext decrypt_file reads) is done once in this process and
+# is not timed. APPDATA points into the work folder, so the user's config, keycheck and logs are
+# never touched. Results are written as JSON; given a baseline, cases whose wall time, peak RSS
+# or peak disk usage grew by more than the threshold are flagged and the exit code is 1.
+
+PASSWORD = "benchmark password"
+DISK_SAMPLE_INTERVAL = 0.1
+# Differences below these are noise, whatever the relative change.
+NOISE_FLOOR = {"wall": 0.05, "peak_rss": 8 * 1024 * 1024, "disk_peak": 1024 * 1024}
+COMPARED = ("wall", "peak_rss", "disk_peak")
+
+
+def peak_rss() -> Optional[int]:
+    """Peak resident set size of this process in bytes, or None where it can't be read."""
+    # On Linux ru_maxrss survives fork and exec, so a child would report the harness's own peak;
+    # VmHWM belongs to the current address space only.
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return _windows_peak_rss()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _windows_peak_rss() -> Optional[int]:
+    try:
+        import ctypes
+        from ctypes import wintypes
+    except ImportError:
+        return None
+
+    class Counters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+    counters = Counters()
+    counters.cb = ctypes.sizeof(counters)
+    try:
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+    except (AttributeError, OSError):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+def _tree_size(paths: List[Path]) -> int:
+    total = 0
+    stack = [p for p in paths if p.exists()]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            stack.append(e.path)
+                        elif e.is_file(follow_symlinks=False):
+                            total += e.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    return total
+
+
+class _DiskSampler:
+    """Tracks the peak number of bytes under some folders while a case runs."""
+
+    def __init__(self, paths: List[Path]):
+        self.paths = paths
+        self.start = _tree_size(paths)
+        self.peak = self.start
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            self.peak = max(self.peak, _tree_size(self.paths))
+            # Walking a big restore tree is not free; sample less often rather than slow the case down.
+            if self._stop.wait(max(DISK_SAMPLE_INTERVAL, 4 * (time.perf_counter() - started))):
+                return
+
+    def stop(self) -> int:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _tree_size(self.paths))
+        return self.peak - self.start
+
+
+# --- cases ---------------------------------------------------------------------------------
+# A case is (setup, run). setup(ctx) runs once in this process and returns a dict that is passed
+# to every run(ctx, state) in the child processes; run returns the number of bytes it processed
+# (None for cases where throughput is meaningless) and any extra results.
+
+Ctx = Dict[str, Any]
+Case = Tuple[Optional[Callable[[Ctx], Dict[str, Any]]], Callable[[Ctx, Dict[str, Any]], Tuple[Optional[int], Dict[str, Any]]]]
+
+
+def _backup(codec: str) -> Case:
+    def run(ctx: Ctx, state: Dict[str, Any]) -> Tuple[Optional[int], Dict[str, Any]]:
+        from app.backup import run_backup
+        last: Dict[str, Any] = {}
+        path = run_backup([ctx["data"]], ctx["out"], PASSWORD, "bench.sbk", codec=codec, progress=last.update)
+        return ctx["dataset"]["bytes"], {"archive_bytes": path.stat().st_size, "stages": last.get("stages")}
+    return None, run
+
+
+def _restore_setup(ctx: Ctx) -> Dict[str, Any]:
+    from app.backup import run_backup
+    path = run_backup([ctx["data"]], ctx["setup"], PASSWORD, "restore.sbk")
+    return {"archive": str(path)}
+
+
+def _restore_run(ctx: Ctx, state: Dict[str, Any]) -> Tuple[Optional[int], Dict[str, Any]]:
+    from app.restore import run_restore
+    last: Dict[str, Any] = {}
+    run_restore(state["archive"], ctx["out"], PASSWORD, progress=last.update)
+    return ctx["dataset"]["bytes"], {"stages": last.get("stages")}
+
+
+def _encrypt_run(ctx: Ctx, state: Dict[str, Any]) -> Tuple[Optional[int], Dict[str, Any]]:
+    from app.crypto import encrypt_file
+    source = largest_file(Path(ctx["data"]))
+    encrypt_file(source, Path(ctx["out"]) / "file.enc", PASSWORD)
+    return source.stat().st_size, {}
+
+
+def _decrypt_setup(ctx: Ctx) -> Dict[str, Any]:
+    from app.crypto import encrypt_file
+    source = largest_file(Path(ctx["data"]))
+    target = Path(ctx["setup"]) / "file.enc"
+    encrypt_file(source, target, PASSWORD)
+    return {"ciphertext": str(target), "size": source.stat().st_size}
+
+
+def _decrypt_run(ctx: Ctx, state: Dict[str, Any]) -> Tuple[Optional[int], Dict[str, Any]]:
+    from app.crypto import decrypt_file
+    decrypt_file(Path(state["ciphertext"]), Path(ctx["out"]) / "file.dec", PASSWORD)
+    return state["size"], {}
+
+
+def _chunk_run(ctx: Ctx, state: Dict[str, Any]) -> Tuple[Optional[int], Dict[str, Any]]:
+    from app.repository import Chunker, chunk_pool
+    source = largest_file(Path(ctx["data"]))
+    pool = chunk_pool()
+    try:
+        with open(source, "rb") as f:
+            count = sum(1 for _ in Chunker(b"\x01" * 16).chunks(f, pool))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return source.stat().st_size, {"chunks": count, "parallel": pool is not None}
+
+
+class _SlowDevice:
+    """A file behind a device that moves rate bytes per second, e.g. a NAS or a cold disk."""
+
+    def __init__(self, f, rate: float):
+        self._f = f
+        self._rate = rate
+
+    def readinto(self, buf) -> int:
+        n = self._f.readinto(buf)
+        time.sleep(n / self._rate)
+        return n
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._f.read(size)
+        time.sleep(len(data) / self._rate)
+        return data
+
+    def write(self, data) -> int:
+        time.sleep(len(data) / self._rate)
+        return self._f.write(data)
+
+    def flush(self) -> None:
+        self._f.flush()
+
+    def close(self) -> None:
+        self._f.close()
+
+    def __enter__(self) -> "_SlowDevice":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _hash_rate() -> float:
+    """sha256 throughput of this machine in bytes per second."""
+    import hashlib
+    data = b"\x01" * (4 * 1024 * 1024)
+    started = time.perf_counter()
+    hashlib.sha256(data).digest()
+    return len(data) / max(time.perf_counter() - started, 1e-6)
+
+
+def _pipeline_run(ctx: Ctx, state: Dict[str, Any]) -> Tuple[Optional[int], Dict[str, Any]]:
+    import hashlib
+    from app.pipeline import ReadAhead, WriteBehind
+    from app.utils import CHUNK_SIZE
+    source = largest_file(Path(ctx["data"]))
+    target = Path(ctx["out"]) / "copy"
+    # Hashing a chunk takes about as long as reading or writing one, so overlapping the three
+    # can at best bring the copy down to a third of the plain loop's time.
+    rate = _hash_rate()
+
+    started = time.perf_counter()
+    digest = hashlib.sha256()
+    with _SlowDevice(open(source, "rb"), rate) as fin, _SlowDevice(open(target, "wb"), rate) as fout:
+        for chunk in iter(lambda: fin.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            fout.write(chunk)
+    plain = time.perf_counter() - started
+
+    started = time.perf_counter()
+    piped = hashlib.sha256()
+    with ReadAhead(_SlowDevice(open(source, "rb"), rate), adaptive=False) as fin, \
+            WriteBehind(_SlowDevice(open(target, "wb"), rate)) as fout:
+        for view in fin.chunks():
+            piped.update(view)
+            fout.write(bytes(view))
+    pipelined = time.perf_counter() - started
+    if piped.digest() != digest.digest():
+        raise RuntimeError("The pipelined copy differs from the plain one")
+    return 2 * source.stat().st_size, {"device_mb_per_s": round(rate / 1e6, 1), "plain_s": round(plain, 4),
+                                       "pipelined_s": round(pipelined, 4), "speedup": round(plain / pipelined, 2)}
+
+
+def _derive_key_run(ctx: Ctx, state: Dict[str, Any]) -> Tuple[Optional[int], Dict[str, Any]]:
+    from app.crypto import KdfParams, derive_key, master_key
+    salt = b"\x01" * 16
+    rounds = 5
+    started = time.perf_counter()
+    for _ in range(rounds):
+        derive_key(PASSWORD, salt)
+    cold = (time.perf_counter() - started) / rounds
+    master_key(PASSWORD, salt, KdfParams())
+    started = time.perf_counter()
+    master_key(PASSWORD, salt, KdfParams())
+    cached = time.perf_counter() - started
+    return None, {"scrypt_ms": round(cold * 1000, 3), "cached_master_key_ms": round(cached * 1000, 4)}
+
+
+def _cases(codecs: List[str]) -> Dict[str, Case]:
+    cases: Dict[str, Case] = {f"backup[{c}]": _backup(c) for c in codecs}
+    cases.update({
+        "restore": (_restore_setup, _restore_run),
+        "encrypt_file": (None, _encrypt_run),
+        "decrypt_file": (_decrypt_setup, _decrypt_run),
+        "chunk": (None, _chunk_run),
+        "pipeline": (None, _pipeline_run),
+        "derive_key": (None, _derive_key_run),
+    })
+    return cases
+
+
+def _child(name: str, codecs: List[str], ctx: Ctx, state: Dict[str, Any], results) -> None:
+    from app.utils import TEMP_DIR
+    _, run = _cases(codecs)[name]
+    sampler = _DiskSampler([Path(ctx["out"]), TEMP_DIR])
+    started = time.perf_counter()
+    processed, extra = run(ctx, state)
+    wall = time.perf_counter() - started
+    results.put({"wall": wall, "bytes": processed, "peak_rss": peak_rss(), "disk_peak": sampler.stop(), **extra})
+
+
+def _measure(name: str, codecs: List[str], ctx: Ctx, state: Dict[str, Any], repeat: int) -> Dict[str, Any]:
+    mp = multiprocessing.get_context("spawn")
+    runs = []
+    for _ in range(repeat):
+        shutil.rmtree(ctx["out"], ignore_errors=True)
+        os.makedirs(ctx["out"])
+        queue = mp.Queue()
+        proc = mp.Process(target=_child, args=(name, codecs, ctx, state, queue))
+        proc.start()
+        result = None
+        while result is None and (proc.is_alive() or not queue.empty()):
+            try:
+                result = queue.get(timeout=0.5)
+            except queue_module.Empty:
+                pass
+        proc.join()
+        if result is None:
+            raise RuntimeError(f"Benchmark '{name}' failed (exit code {proc.exitcode})")
+        runs.append(result)
+    shutil.rmtree(ctx["out"], ignore_errors=True)
+    walls = [r["wall"] for r in runs]
+    summary = {k: v for k, v in runs[-1].items() if k not in ("wall", "peak_rss", "disk_peak")}
+    wall = statistics.median(walls)
+    summary.update(wall=round(wall, 4), wall_min=round(min(walls), 4), wall_max=round(max(walls), 4),
+                   peak_rss=max((r["peak_rss"] or 0 for r in runs), default=0) or None,
+                   disk_peak=max(r["disk_peak"] for r in runs),
+                   mb_per_s=round(summary["bytes"] / wall / 1e6, 2) if summary.get("bytes") and wall > 0 else None)
+    return summary
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Returns a line for every metric that got worse than the baseline by more than threshold."""
+    regressions = []
+    for name, new in results["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if not old:
+            continue
+        for key in COMPARED:
+            if not old.get(key) or new.get(key) is None:
+                continue
+            if new[key] - old[key] > NOISE_FLOOR[key] and new[key] > old[key] * (1 + threshold):
+                regressions.append(f"{name}: {key} {old[key]:,} -> {new[key]:,} (+{(new[key] / old[key] - 1) * 100:.0f}%)")
+    return regressions
+
+
+def _table(results: Dict[str, Any]) -> str:
+    lines = [f"{'case':18} {'wall s':>9} {'MB/s':>9} {'peak RSS MB':>12} {'disk MB':>9}"]
+    for name, r in results["results"].items():
+        mbps = f"{r['mb_per_s']:.1f}" if r.get("mb_per_s") is not None else "-"
+        rss = f"{r['peak_rss'] / 1e6:.1f}" if r.get("peak_rss") else "-"
+        lines.append(f"{name:18} {r['wall']:>9.3f} {mbps:>9} {rss:>12} {r['disk_peak'] / 1e6:>9.1f}")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="SecureBackup throughput benchmarks.")
+    parser.add_argument("--profile", choices=list(PROFILES), default="small", help="dataset size")
+    parser.add_argument("--seed", type=int, default=1, help="dataset seed")
+    parser.add_argument("--work", type=Path, default=Path(tempfile.gettempdir()) / "securebackup-bench",
+                        help="scratch folder; the dataset is kept here between runs")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case; the median wall time is reported")
+    parser.add_argument("--codec", action="append", help="codecs to benchmark backups with (repeatable)")
+    parser.add_argument("--only", action="append", help="run only these cases (repeatable)")
+    parser.add_argument("--output", type=Path, help="where to write the results JSON")
+    parser.add_argument("--baseline", type=Path, help="results JSON of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative slowdown flagged as a regression")
+    args = parser.parse_args(argv)
+
+    work = args.work.resolve()
+    os.environ["APPDATA"] = str(work / "appdata")
+    from app.archive import CODECS, DEFAULT_CODEC
+    codecs = args.codec or [DEFAULT_CODEC]
+    unknown = [c for c in codecs if c not in CODECS]
+    if unknown:
+        parser.error(f"unknown codecs: {', '.join(unknown)}")
+    cases = _cases(codecs)
+    selected = args.only or list(cases)
+    if any(n not in cases for n in selected):
+        parser.error(f"cases are: {', '.join(cases)}")
+
+    data = work / f"data-{args.profile}-{args.seed}"
+    print(f"Preparing the '{args.profile}' dataset in {data}...", file=sys.stderr)
+    dataset = generate(data, args.profile, args.seed)
+    results: Dict[str, Any] = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "cpus": os.cpu_count()},
+        "dataset": dataset, "repeat": args.repeat, "results": {},
+    }
+    for name in selected:
+        setup, _ = cases[name]
+        setup_dir = work / "setup"
+        shutil.rmtree(setup_dir, ignore_errors=True)
+        setup_dir.mkdir(parents=True)
+        ctx = {"data": str(data), "out": str(work / "out"), "setup": str(setup_dir), "dataset": dataset}
+        print(f"Running {name}...", file=sys.stderr)
+        state = setup(ctx) if setup else {}
+        results["results"][name] = _measure(name, codecs, ctx, state, args.repeat)
+        shutil.rmtree(setup_dir, ignore_errors=True)
+
+    output = args.output or Path(f"bench_{args.profile}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    output.write_text(json.dumps(results, indent=2))
+    print(_table(results))
+    print(f"Results written to {output}")
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline.get("dataset") != dataset:
+            print("Warning: the baseline was measured on a different dataset.", file=sys.stderr)
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline} (threshold {args.threshold:.0%}).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,21 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# app.utils creates its folders under APPDATA at import time; keep the tests out of the real one.
+os.environ["APPDATA"] = tempfile.mkdtemp(prefix="securebackup-tests-")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pytest  # noqa: E402
+from app.crypto import set_kdf_params  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+
+
+@pytest.fixture(autouse=True)
+def cheap_kdf():
+    # The lowest scrypt cost set_kdf_params allows; headers record it, so reading is unaffected.
+    set_kdf_params(10)
+    yield
+    set_kdf_params()
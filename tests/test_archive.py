@@ -0,0 +1,24 @@
+import pytest
+
+from app.archive import resolve_codec
+from app.backup import run_backup
+from app.restore import run_restore
+from conftest import PASSWORD
+
+
+@pytest.mark.parametrize("codec, level", [("zstd", 300), ("zstd", -200), ("lz4-hc", 0), ("lz4-fast", 128), ("zstd", "fast")])
+def test_out_of_range_levels_fail_up_front(tmp_path, codec, level):
+    with pytest.raises(ValueError, match="[Cc]ompression level"):
+        resolve_codec(codec, level)
+    with pytest.raises(ValueError, match="[Cc]ompression level"):
+        run_backup([str(tmp_path)], str(tmp_path / "out"), PASSWORD, "x.sbk", codec=codec, level=level)
+    assert not (tmp_path / "out" / "x.sbk").exists()
+
+
+def test_negative_zstd_levels_round_trip(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "a.txt").write_text("hello " * 10000)
+    path = run_backup([str(src)], str(tmp_path / "out"), PASSWORD, "neg.sbk", codec="zstd", level=-5)
+    run_restore(str(path), str(tmp_path / "restored"), PASSWORD)
+    assert (tmp_path / "restored" / "src" / "a.txt").read_text() == "hello " * 10000
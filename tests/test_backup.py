@@ -0,0 +1,119 @@
+import builtins
+import errno
+import os
+from pathlib import Path
+
+import pytest
+
+import app.backup
+from app.backup import run_backup
+from app.restore import list_archive, run_restore, verify_archive
+from conftest import PASSWORD
+
+
+def _restored(root: Path) -> dict:
+    return {p.relative_to(root).as_posix(): p.read_bytes() for p in root.rglob("*") if p.is_file()}
+
+
+class _FailingFile:
+    """Reads fail with EIO once fail_after bytes have been returned."""
+
+    def __init__(self, f, fail_after: int):
+        self._f = f
+        self._left = fail_after
+
+    def read(self, size: int = -1) -> bytes:
+        if self._left <= 0:
+            raise OSError(errno.EIO, "Input/output error")
+        data = self._f.read(min(size, self._left) if size >= 0 else self._left)
+        self._left -= len(data)
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._f.close()
+
+
+def test_read_error_mid_file_keeps_later_files(tmp_path, monkeypatch):
+    src = tmp_path / "src"
+    src.mkdir()
+    files = {"a.txt": b"first" * 100, "m.bin": os.urandom(3 * 1024 * 1024), "z.txt": b"last" * 100}
+    for name, data in files.items():
+        (src / name).write_bytes(data)
+    broken = (src / "m.bin").resolve()
+
+    def open_file(path, mode="r", *args, **kwargs):
+        f = builtins.open(path, mode, *args, **kwargs)
+        return _FailingFile(f, 1024 * 1024 + 5) if Path(path).resolve() == broken else f
+
+    monkeypatch.setattr(app.backup, "open", open_file, raising=False)
+    path = run_backup([str(src)], str(tmp_path / "out"), PASSWORD, "b.sbk", job_name="eio", incremental=True)
+    monkeypatch.undo()
+
+    verify_archive(str(path), PASSWORD)
+    run_restore(str(path), str(tmp_path / "restored"), PASSWORD)
+    restored = _restored(tmp_path / "restored" / "src")
+    assert restored["a.txt"] == files["a.txt"] and restored["z.txt"] == files["z.txt"]
+    assert restored["m.bin"] == files["m.bin"][:1024 * 1024 + 5] + b"\0" * (2 * 1024 * 1024 - 5)
+
+    # Left out of the manifest, so the next run archives it again.
+    again = run_backup([str(src)], str(tmp_path / "out"), PASSWORD, "c.sbk", job_name="eio", incremental=True)
+    assert [r["name"] for r in list_archive(str(again), PASSWORD) if r["name"].endswith(".bin")] == ["src/m.bin"]
+
+
+def test_unopenable_file_is_skipped(tmp_path, monkeypatch):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "a.txt").write_bytes(b"kept")
+    (src / "b.bin").write_bytes(os.urandom(2 * 1024 * 1024))
+
+    def open_file(path, *args, **kwargs):
+        if Path(path).name == "b.bin":
+            raise PermissionError(errno.EACCES, "Permission denied", str(path))
+        return builtins.open(path, *args, **kwargs)
+
+    monkeypatch.setattr(app.backup, "open", open_file, raising=False)
+    path = run_backup([str(src)], str(tmp_path / "out"), PASSWORD, "b.sbk")
+    monkeypatch.undo()
+
+    verify_archive(str(path), PASSWORD)
+    run_restore(str(path), str(tmp_path / "restored"), PASSWORD)
+    assert _restored(tmp_path / "restored" / "src") == {"a.txt": b"kept"}
+
+
+class _FullDisk:
+    """A destination file whose writes fail like a full disk."""
+
+    def __init__(self, f):
+        self._f = f
+
+    def write(self, data) -> int:
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+def test_full_destination_fails_the_run(tmp_path, monkeypatch, caplog):
+    src = tmp_path / "src"
+    src.mkdir()
+    for i in range(20):
+        (src / f"f{i:02d}.bin").write_bytes(os.urandom(256 * 1024))
+
+    def open_file(path, mode="r", *args, **kwargs):
+        f = builtins.open(path, mode, *args, **kwargs)
+        return _FullDisk(f) if str(path).endswith(".part") else f
+
+    monkeypatch.setattr(app.backup, "open", open_file, raising=False)
+    with pytest.raises(OSError) as e:
+        run_backup([str(src)], str(tmp_path / "out"), PASSWORD, "b.sbk")
+    monkeypatch.undo()
+    assert e.value.errno == errno.ENOSPC
+    # A destination error ends the run; it is not passed off as files that could not be read.
+    assert "skipping" not in caplog.text
+    assert list((tmp_path / "out").iterdir()) == []
@@ -0,0 +1,117 @@
+import os
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from app.backup import run_backup
+from app.catalog import backups, prune_candidates, search
+from conftest import PASSWORD
+
+
+def _backup_twice(tmp_path: Path, job: str, runs: int = 3) -> list:
+    src = tmp_path / "src"
+    src.mkdir()
+    dests = [str(tmp_path / "a"), str(tmp_path / "b")]
+    for i in range(runs):
+        (src / "notes.txt").write_bytes(os.urandom(1000 + i))
+        run_backup([str(src)], dests, PASSWORD, f"{job}_2026010{i}_120000.sbk", job_name=job)
+    return dests
+
+
+def test_copies_are_one_backup(tmp_path):
+    _backup_twice(tmp_path, "twice")
+    found = backups("twice")
+    assert len(found) == 3
+    assert all(len(b["copies"]) == 2 for b in found)
+    # Three versions of the file, not one per destination.
+    assert len([r for r in search(job="twice") if r["path"].endswith("notes.txt")]) == 3
+
+
+def test_prune_keeps_backups_not_files(tmp_path):
+    _backup_twice(tmp_path, "keep")
+    candidates = prune_candidates("keep", 2)
+    assert len(candidates) == 1
+    assert sorted(Path(p).parent.name for p in candidates[0]["copies"]) == ["a", "b"]
+
+
+def test_same_name_and_size_is_not_the_same_backup(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "notes.txt").write_bytes(b"x" * 1000)
+    first = run_backup([str(src)], str(tmp_path / "a"), PASSWORD, "Same.sbk", job_name="Same")
+    second = run_backup([str(src)], str(tmp_path / "b"), PASSWORD, "Same.sbk", job_name="Same")
+    assert first.stat().st_size == second.stat().st_size
+    assert [len(b["copies"]) for b in backups("Same")] == [1, 1]
+    # Writing over a backup replaces its entry.
+    run_backup([str(src)], str(tmp_path / "a"), PASSWORD, "Same.sbk", job_name="Same")
+    assert sorted(Path(b["path"]).parent.name for b in backups("Same")) == ["a", "b"]
+
+
+def _version_1_catalog(db: Path, rows: list) -> None:
+    conn = sqlite3.connect(str(db))
+    conn.executescript("""
+        CREATE TABLE archives (id INTEGER PRIMARY KEY, job TEXT NOT NULL, path TEXT NOT NULL UNIQUE,
+            kind TEXT NOT NULL, parent TEXT, created TEXT NOT NULL, archive_size INTEGER NOT NULL,
+            files INTEGER NOT NULL, bytes INTEGER NOT NULL);
+        CREATE TABLE files (archive_id INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+            path TEXT NOT NULL, type TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL, sha256 TEXT);
+        PRAGMA user_version = 1;
+    """)
+    for i, (path, created) in enumerate(rows, 1):
+        conn.execute("INSERT INTO archives VALUES (?, 'j', ?, 'full', NULL, ?, 10, 1, 5)", (i, str(path), created))
+        conn.execute("INSERT INTO files VALUES (?, 'x', 'file', 5, NULL, NULL)", (i,))
+    conn.commit()
+    conn.close()
+
+
+def test_version_1_catalog_folds_copies(tmp_path):
+    first, other = os.urandom(64), os.urandom(64)
+    for folder, head in (("a", first), ("b", first), ("c", other)):
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "j_1.sbk").write_bytes(head + b"body")
+    db = tmp_path / "catalog.db"
+    _version_1_catalog(db, [(tmp_path / "a" / "j_1.sbk", "2026-01-01T12:00:00"),
+                            (tmp_path / "b" / "j_1.sbk", "2026-01-01T12:00:00"),
+                            (tmp_path / "c" / "j_1.sbk", "2026-01-01T13:00:00"),
+                            ("/gone/j_2.sbk", "2026-01-02T12:00:00")])
+    found = backups("j", db_path=db)
+    # Same name and size in c, but another backup; the missing file cannot be matched at all.
+    assert [[Path(c).parent.name for c in b["copies"]] for b in found] == [["gone"], ["c"], ["a", "b"]]
+    assert len(search("x", db_path=db)) == 3
+
+
+def test_version_2_catalog_forgets_mixed_up_copies(tmp_path):
+    for folder in ("a", "b", "c", "d"):
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "j.sbk").write_bytes(os.urandom(64))
+    (tmp_path / "d" / "j.sbk").write_bytes((tmp_path / "c" / "j.sbk").read_bytes())
+    db = tmp_path / "catalog.db"
+    conn = sqlite3.connect(str(db))
+    conn.executescript("""
+        CREATE TABLE archives (id INTEGER PRIMARY KEY, job TEXT NOT NULL, path TEXT NOT NULL UNIQUE,
+            kind TEXT NOT NULL, parent TEXT, created TEXT NOT NULL, archive_size INTEGER NOT NULL,
+            files INTEGER NOT NULL, bytes INTEGER NOT NULL);
+        CREATE TABLE copies (archive_id INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+            path TEXT NOT NULL UNIQUE, name TEXT NOT NULL);
+        CREATE TABLE files (archive_id INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+            path TEXT NOT NULL, type TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL, sha256 TEXT);
+        CREATE INDEX copies_name ON copies(name);
+        PRAGMA user_version = 2;
+    """)
+    conn.execute("INSERT INTO archives VALUES (1, 'j', ?, 'full', NULL, '2026-01-01T12:00:00', 64, 0, 0)",
+                 (str(tmp_path / "a" / "j.sbk"),))
+    conn.execute("INSERT INTO archives VALUES (2, 'j', ?, 'full', NULL, '2026-01-02T12:00:00', 64, 0, 0)",
+                 (str(tmp_path / "c" / "j.sbk"),))
+    conn.executemany("INSERT INTO copies VALUES (?, ?, 'j.sbk')",
+                     [(1, str(tmp_path / "a" / "j.sbk")), (1, str(tmp_path / "b" / "j.sbk")),
+                      (2, str(tmp_path / "c" / "j.sbk")), (2, str(tmp_path / "d" / "j.sbk"))])
+    conn.commit()
+    conn.close()
+    # a and b were two backups taken for one; c and d really are copies of one.
+    assert [[Path(c).parent.name for c in b["copies"]] for b in backups("j", db_path=db)] == [["c", "d"]]
+
+
+def test_prune_needs_one_backup_kept():
+    with pytest.raises(ValueError):
+        prune_candidates("any", 0)
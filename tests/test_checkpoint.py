@@ -0,0 +1,120 @@
+import logging
+import os
+from pathlib import Path
+
+import pytest
+
+import app.backup
+from app.backup import run_backup
+from app.checkpoint import FRAME_LEN, Journal, checkpoint_path, partial_name
+from app.restore import list_archive, run_restore, verify_archive
+from conftest import PASSWORD
+
+
+class _Interrupted(Exception):
+    pass
+
+
+def _tree(src: Path, count: int = 24) -> None:
+    for i in range(count):
+        (src / f"f{i:02d}.bin").write_bytes(os.urandom(160 * 1024 + i))
+
+
+def _files(root: Path) -> dict:
+    return {p.relative_to(root).as_posix(): p.read_bytes() for p in root.rglob("*") if p.is_file()}
+
+
+def _interrupt_at(monkeypatch, name: str) -> None:
+    """Checkpoints after every entry and stops the run when it reaches name."""
+    add_entry = app.backup._add_entry
+
+    def add(tar, compressed, entry, *args, **kwargs):
+        if entry.arcname.endswith("/" + name):
+            raise _Interrupted(name)
+        return add_entry(tar, compressed, entry, *args, **kwargs)
+
+    monkeypatch.setattr(app.backup, "CHECKPOINT_INTERVAL", 0.0)
+    monkeypatch.setattr(app.backup, "_add_entry", add)
+
+
+def _interrupted(monkeypatch, job: str, *args, **kwargs) -> None:
+    with monkeypatch.context() as m:
+        _interrupt_at(m, "f10.bin")
+        with pytest.raises(_Interrupted):
+            run_backup(*args, job_name=job, **kwargs)
+    assert checkpoint_path(job).exists()
+
+
+def test_resumed_backup_restores(tmp_path, monkeypatch, caplog):
+    src, dests = tmp_path / "src", [str(tmp_path / "a"), str(tmp_path / "b")]
+    src.mkdir()
+    _tree(src)
+    _interrupted(monkeypatch, "resume", [str(src)], dests, PASSWORD, "r.sbk")
+    for dest in dests:
+        assert [p.name for p in Path(dest).iterdir()] == ["r.sbk.part"]
+    # Not archived yet when the run stopped, so the resumed run takes the new contents.
+    (src / "f20.bin").write_bytes(b"changed in between")
+
+    with caplog.at_level(logging.INFO):
+        run_backup([str(src)], dests, PASSWORD, "r.sbk", job_name="resume")
+    assert "Resuming the interrupted backup r.sbk after 11 archived entries" in caplog.text
+    assert not checkpoint_path("resume").exists()
+    for dest in dests:
+        path = Path(dest) / "r.sbk"
+        verify_archive(str(path), PASSWORD)
+        run_restore(str(path), str(tmp_path / "restored" / Path(dest).name), PASSWORD)
+        assert _files(tmp_path / "restored" / Path(dest).name / "src") == _files(src)
+
+
+def test_resumed_incremental_catches_up(tmp_path, monkeypatch, caplog):
+    src, out = tmp_path / "src", tmp_path / "out"
+    src.mkdir()
+    _tree(src)
+    run_backup([str(src)], str(out), PASSWORD, "i_1.sbk", job_name="inc", incremental=True)
+    _tree(src)
+    _interrupted(monkeypatch, "inc", [str(src)], str(out), PASSWORD, "i_2.sbk", incremental=True)
+    # f02 is in the partial archive already and changes again; f15 is not yet, and goes away.
+    (src / "f02.bin").write_bytes(b"changed after its checkpoint")
+    (src / "f15.bin").unlink()
+
+    with caplog.at_level(logging.INFO):
+        resumed = run_backup([str(src)], str(out), PASSWORD, "i_2.sbk", job_name="inc", incremental=True)
+    assert "Resuming" in caplog.text
+    assert "src/f15.bin" not in [r["name"] for r in list_archive(str(resumed), PASSWORD)]
+    # The resumed archive holds f02 as it was and does not record f15 as deleted; the next run does both.
+    last = run_backup([str(src)], str(out), PASSWORD, "i_3.sbk", job_name="inc", incremental=True)
+    assert [r["name"] for r in list_archive(str(last), PASSWORD) if r["type"] == "file"] == ["src/f02.bin"]
+    verify_archive(str(last), PASSWORD, chain=True)
+    run_restore(str(last), str(tmp_path / "restored"), PASSWORD)
+    assert _files(tmp_path / "restored" / "src") == _files(src)
+
+
+def test_data_past_the_checkpoint_starts_over(tmp_path, monkeypatch, caplog):
+    src, out = tmp_path / "src", tmp_path / "out"
+    src.mkdir()
+    _tree(src)
+    _interrupted(monkeypatch, "over", [str(src)], str(out), PASSWORD, "o.sbk")
+    with open(out / "o.sbk.part", "ab") as f:
+        f.write(b"\0" * 100)
+
+    with caplog.at_level(logging.INFO):
+        path = run_backup([str(src)], str(out), PASSWORD, "o.sbk", job_name="over")
+    assert "it stopped between checkpoints" in caplog.text
+    run_restore(str(path), str(tmp_path / "restored"), PASSWORD)
+    assert _files(tmp_path / "restored" / "src") == _files(src)
+
+
+def test_journal_ignores_a_torn_frame(tmp_path):
+    path = tmp_path / "j.sbc"
+    journal = Journal.create(path, "j.sbk.part", os.urandom(32), {"output": "j.sbk"})
+    journal.append({"segments": 1})
+    with open(path, "ab") as f:
+        f.write(FRAME_LEN.pack(1000) + b"cut short")
+    assert partial_name(path) == "j.sbk.part"
+    assert journal.load() == ({"output": "j.sbk"}, [{"segments": 1}])
+
+
+def test_journal_names_only_a_file_in_the_destination(tmp_path):
+    path = tmp_path / "j.sbc"
+    Journal.create(path, "../elsewhere.part", os.urandom(32), {})
+    assert partial_name(path) is None
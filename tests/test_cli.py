@@ -0,0 +1,11 @@
+import pytest
+
+from app.cli import main
+
+
+@pytest.mark.parametrize("keep", ["0", "-1", "two"])
+def test_prune_rejects_keep_below_one(keep, capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        main(["prune", "somejob", "--keep", keep])
+    assert exit_info.value.code == 2
+    assert "--keep" in capsys.readouterr().err
@@ -0,0 +1,93 @@
+import io
+import os
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from app import crypto
+from app.crypto import SEGMENTED_HEADER, TAG_LEN, SegmentedWriter, open_reader
+from conftest import PASSWORD
+
+SEGMENT = 1024
+# kdf 2 headers are followed by the archive salt.
+HEADER_LEN = SEGMENTED_HEADER.size + crypto.ARCHIVE_SALT_LEN
+
+
+def _seal(data: bytes) -> bytes:
+    buf = io.BytesIO()
+    writer = SegmentedWriter(buf, PASSWORD, segment_size=SEGMENT)
+    writer.write(data)
+    writer.close()
+    return buf.getvalue()
+
+
+def _open(blob: bytes) -> bytes:
+    return open_reader(io.BytesIO(blob), PASSWORD).read()
+
+
+def _segments(blob: bytes) -> list:
+    body = blob[HEADER_LEN:]
+    return [body[i:i + SEGMENT + TAG_LEN] for i in range(0, len(body), SEGMENT + TAG_LEN)]
+
+
+@pytest.mark.parametrize("size", [0, 1, SEGMENT, 5 * SEGMENT + 7])
+def test_round_trip(size):
+    data = os.urandom(size)
+    assert _open(_seal(data)) == data
+
+
+def test_flipped_tag_fails():
+    blob = bytearray(_seal(os.urandom(4 * SEGMENT)))
+    blob[HEADER_LEN + 2 * (SEGMENT + TAG_LEN) - 1] ^= 0x01  # last tag byte of the second segment
+    with pytest.raises(InvalidTag):
+        _open(bytes(blob))
+
+
+@pytest.mark.parametrize("cut", [SEGMENT + TAG_LEN, 1])
+def test_truncation_fails(cut):
+    # Dropping whole trailing segments leaves a final segment without the last flag.
+    blob = _seal(os.urandom(4 * SEGMENT + 10))
+    with pytest.raises(InvalidTag):
+        _open(blob[:-cut])
+
+
+def test_reordered_segments_fail():
+    blob = _seal(os.urandom(4 * SEGMENT + 10))
+    parts = _segments(blob)
+    parts[1], parts[2] = parts[2], parts[1]
+    with pytest.raises(InvalidTag):
+        _open(blob[:HEADER_LEN] + b"".join(parts))
+
+
+@pytest.mark.parametrize("field, value", [(2, 40), (2, 5), (3, 0), (3, 200), (4, 0), (4, 64), (7, 0), (7, 2**31)])
+def test_out_of_range_headers_are_rejected(field, value):
+    blob = _seal(b"data")
+    fields = list(SEGMENTED_HEADER.unpack_from(blob))
+    fields[field] = value
+    with pytest.raises(ValueError, match="Unsupported"):
+        _open(SEGMENTED_HEADER.pack(*fields) + blob[SEGMENTED_HEADER.size:])
+
+
+def test_resume_never_reencrypts_a_segment_on_disk(tmp_path, monkeypatch):
+    path = tmp_path / "c.sbk"
+    first, second = os.urandom(3 * SEGMENT + 100), os.urandom(4 * SEGMENT)
+    with open(path, "wb") as f:
+        writer = SegmentedWriter(f, PASSWORD, segment_size=SEGMENT, hold=100 * SEGMENT)
+        writer.write(first)
+        segments, tail = writer.commit()
+        writer.write(os.urandom(2 * SEGMENT))  # held in memory, lost with the "crash"
+    committed = path.read_bytes()
+    assert len(committed) == writer.committed_size(segments)
+
+    counters = []
+    nonce = crypto._segment_nonce
+    monkeypatch.setattr(crypto, "_segment_nonce", lambda prefix, counter, last: counters.append(counter) or nonce(prefix, counter, last))
+    with open(path, "r+b") as f:
+        writer = SegmentedWriter.reopen(f, PASSWORD)
+        writer.rewind(segments, tail)
+        writer.write(second)
+        writer.close()
+    assert min(counters) == segments
+    blob = path.read_bytes()
+    assert blob[:len(committed)] == committed
+    assert _open(blob) == first + second
@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+from app.jobs import run_job
+from app.shards import shard_paths
+from conftest import PASSWORD
+
+
+def _job(tmp_path, shards) -> dict:
+    src = tmp_path / "src"
+    src.mkdir(exist_ok=True)
+    for i in range(8):
+        (src / f"f{i}.bin").write_bytes(os.urandom(4096))
+    return {"name": "sharded", "sources": [str(src)], "destination": str(tmp_path / "out"), "password": PASSWORD,
+            "shards": shards}
+
+
+@pytest.mark.parametrize("shards", [0, -2, 2.5, "4", True])
+def test_bad_shard_count_is_refused(tmp_path, shards):
+    with pytest.raises(ValueError, match="shards must be a whole number of at least 1"):
+        run_job(_job(tmp_path, shards))
+    assert not (tmp_path / "out").exists()
+
+
+def test_shards_are_capped_at_the_cpu_count(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+    path = run_job(_job(tmp_path, 16))
+    assert "using 2" in caplog.text
+    # The metadata shard and one shard per core.
+    assert len(shard_paths(path)) == 3
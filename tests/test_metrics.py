@@ -0,0 +1,46 @@
+import time
+
+import pytest
+
+import app.metrics
+from app.metrics import Metrics, format_progress
+
+
+def test_eta_follows_the_rate_so_far():
+    metrics = Metrics(total_bytes=1000)
+    metrics._start = time.perf_counter() - 10
+    metrics.file_done(250)
+    snap = metrics.snapshot()
+    # 250 bytes in 10 seconds leaves 750 bytes for another 30.
+    assert snap["eta"] == pytest.approx(30, abs=0.5)
+    assert "ETA 0:" in format_progress(snap)
+    metrics.file_done(750)
+    assert metrics.snapshot()["eta"] is None
+
+
+def test_no_eta_without_a_total():
+    metrics = Metrics()
+    metrics._start = time.perf_counter() - 10
+    metrics.file_done(250)
+    assert metrics.snapshot()["eta"] is None
+
+
+@pytest.mark.parametrize("stage, bytes_in, bytes_out", [("compress", 1000, 250), ("decompress", 250, 1000)])
+def test_ratio_is_stored_over_raw_size(stage, bytes_in, bytes_out):
+    metrics = Metrics()
+    assert metrics.snapshot()["ratio"] is None
+    metrics.add(stage, bytes_in=bytes_in, bytes_out=bytes_out)
+    assert metrics.snapshot()["ratio"] == 0.25
+
+
+def test_keeps_the_newest_metrics_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(app.metrics, "METRICS_DIR", tmp_path)
+    monkeypatch.setattr(app.metrics, "MAX_METRICS_FILES", 5)
+    for i in range(8):
+        (tmp_path / f"20000101_0000{i:02d}_backup_old.jsonl").write_text("{}\n")
+    metrics = Metrics("backup", "new")
+    metrics.close()
+    kept = sorted(p.name for p in tmp_path.glob("*.jsonl"))
+    assert len(kept) == 5
+    assert kept[:4] == [f"20000101_0000{i:02d}_backup_old.jsonl" for i in range(4, 8)]
+    assert kept[4] == metrics.path.name
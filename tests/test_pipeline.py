@@ -0,0 +1,169 @@
+import errno
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from app.pipeline import BufferPool, FanOut, ReadAhead, WriteBehind
+
+
+class _FullDisk(io.BytesIO):
+    """Takes limit bytes, then fails like a full disk."""
+
+    def __init__(self, limit: int = 0):
+        super().__init__()
+        self._limit = limit
+
+    def write(self, data) -> int:
+        if self.tell() + len(data) > self._limit:
+            raise OSError(errno.ENOSPC, "No space left on device")
+        return super().write(data)
+
+
+class _Failing(io.BytesIO):
+    def readinto(self, buf) -> int:
+        if self.tell() >= 3000:
+            raise OSError(errno.EIO, "Input/output error")
+        return super().readinto(memoryview(buf)[:1000])
+
+
+class _Stuck(io.BytesIO):
+    """Writes block until release is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+        self.entered = threading.Event()
+
+    def write(self, data) -> int:
+        self.entered.set()
+        self.release.wait()
+        return super().write(data)
+
+
+def test_buffer_pool_reuses_buffers():
+    pool = BufferPool()
+    buf = pool.get(100)
+    pool.put(buf)
+    assert pool.get(50) is buf
+    pool.put(buf)
+    assert len(pool.get(200)) == 200
+
+
+def test_read_ahead_keeps_order_to_the_end():
+    data = os.urandom(100_000)
+    with ReadAhead(io.BytesIO(data), chunk_size=4096, depth=2, adaptive=False) as f:
+        parts = [f.read(1), f.read(5000), f.read(0)]
+        parts += [bytes(view) for view in f.chunks()]
+        assert f.read() == b"" and f.read(10) == b""
+    assert b"".join(parts) == data
+
+
+def test_read_ahead_raises_the_read_error():
+    with ReadAhead(_Failing(os.urandom(10_000)), chunk_size=1000, adaptive=False) as f:
+        assert len(f.read(3000)) == 3000
+        with pytest.raises(OSError) as e:
+            f.read()
+    assert e.value.errno == errno.EIO
+
+
+def test_read_ahead_closes_before_the_end():
+    source = io.BytesIO(os.urandom(1_000_000))
+    f = ReadAhead(source, chunk_size=1000, depth=1, adaptive=False)
+    f.read(10)
+    f.close()  # the reader thread is waiting for room in the queue; close must not hang on it
+    assert source.closed
+
+
+def test_write_behind_raises_the_write_error():
+    f = WriteBehind(_FullDisk())
+    f.write(b"abc")
+    with pytest.raises(OSError) as e:
+        f.flush()
+    assert e.value.errno == errno.ENOSPC
+    with pytest.raises(OSError):
+        f.write(b"def")
+    with pytest.raises(OSError):
+        f.close()
+
+
+def test_write_behind_abort_lets_go_of_a_hung_file():
+    target = _Stuck()
+    f = WriteBehind(target)
+    f.write(b"abc")
+    f.write(b"def")
+    assert target.entered.wait(5)
+    started = time.monotonic()
+    f.abort()
+    assert time.monotonic() - started < 1 and not target.closed
+    target.release.set()
+    f._thread.join(5)
+    # The write in progress finishes, what was still queued is dropped, and the file is closed.
+    assert target.closed
+
+
+def test_write_behind_stall_timeout():
+    target = _Stuck()
+    f = WriteBehind(target, max_bytes=4, stall_timeout=0.2)
+    f.write(b"abcd")
+    assert target.entered.wait(5)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        f.write(b"efgh")  # no room until the stuck write returns
+    assert 0.2 <= time.monotonic() - started < 2
+    with pytest.raises(TimeoutError):
+        f.close()
+    target.release.set()
+
+
+def _fan_out(*files) -> FanOut:
+    return FanOut([WriteBehind(f) for f in files], [f"d{i}" for i in range(len(files))])
+
+
+def test_fan_out_drops_a_failed_target():
+    good = io.BytesIO()
+    fout = _fan_out(good, _FullDisk())
+    fout.write(b"abc")
+    fout.flush()
+    assert fout.live() == ["d0"] and "No space left" in fout.failed["d1"]
+    fout.write(b"def")
+    fout.flush()
+    assert good.getvalue() == b"abcdef"
+
+
+def test_fan_out_raises_once_every_target_failed():
+    fout = _fan_out(_FullDisk(), _FullDisk())
+    fout.write(b"abc")
+    with pytest.raises(OSError, match="Every destination failed"):
+        fout.flush()
+    # Every later call fails too, rather than quietly writing nowhere.
+    with pytest.raises(OSError, match="Every destination failed"):
+        fout.write(b"def")
+    with pytest.raises(OSError, match="Every destination failed"):
+        fout.flush()
+    with pytest.raises(OSError, match="Every destination failed"):
+        fout.close()
+
+
+def test_single_target_keeps_its_error():
+    fout = _fan_out(_FullDisk())
+    fout.write(b"abc")
+    with pytest.raises(OSError) as e:
+        fout.flush()
+    assert e.value.errno == errno.ENOSPC
+    with pytest.raises(OSError, match="Every destination failed: d0"):
+        fout.write(b"def")
+
+
+def test_fan_out_drops_a_hung_target():
+    good, hung = io.BytesIO(), _Stuck()
+    fout = FanOut([WriteBehind(good), WriteBehind(hung, max_bytes=4, stall_timeout=0.2)], ["good", "hung"])
+    fout.write(b"abcd")
+    fout.write(b"efgh")
+    assert fout.live() == ["good"] and "No write progress" in fout.failed["hung"]
+    fout.flush()
+    assert good.getvalue() == b"abcdefgh"
+    fout.close()
+    hung.release.set()
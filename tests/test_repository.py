@@ -0,0 +1,21 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.repository import Chunker
+
+KiB = 1024
+
+
+@pytest.mark.parametrize("size", [0, 100, 32 * KiB, 32 * KiB + 1, 200 * KiB + 17, 3 * 1024 * KiB])
+@pytest.mark.parametrize("kind", ["random", "zeros"])
+def test_parallel_chunking_cuts_where_one_pass_does(size, kind):
+    chunker = Chunker(os.urandom(16), min_size=32 * KiB, avg_size=64 * KiB, max_size=256 * KiB)
+    data = os.urandom(size) if kind == "random" else bytes(size)
+    expected = list(chunker.chunks(io.BytesIO(data)))
+    # The hash workers are plain functions; threads stand in for the worker processes.
+    with ThreadPoolExecutor(2) as pool:
+        assert list(chunker.chunks(io.BytesIO(data), pool)) == expected
+    assert b"".join(expected) == data
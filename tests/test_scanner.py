@@ -0,0 +1,24 @@
+import os
+import threading
+
+from app.scanner import ScanStats, scan, total_size
+
+
+def test_total_size_counts_what_scan_finds(tmp_path):
+    for i in range(50):
+        path = tmp_path / "src" / f"d{i % 7}" / f"e{i % 3}" / f"f{i}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(i * 100))
+    (tmp_path / "src" / "link").symlink_to(tmp_path / "src" / "d1")
+    (tmp_path / "loose").write_bytes(b"x" * 7)
+    sources = [str(tmp_path / "src"), str(tmp_path / "loose"), str(tmp_path / "missing")]
+    stats = ScanStats()
+    list(scan(sources, stats))
+    assert total_size(sources) == stats.bytes
+
+
+def test_total_size_stops_when_asked(tmp_path):
+    stop = threading.Event()
+    stop.set()
+    (tmp_path / "d").mkdir()
+    assert total_size([str(tmp_path)], stop) is None
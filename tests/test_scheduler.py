@@ -0,0 +1,128 @@
+import threading
+import time
+
+import pytest
+
+import app.scheduler
+from app.scheduler import JobExecutor
+
+
+@pytest.fixture
+def executor():
+    executors = []
+
+    def make(**kwargs) -> JobExecutor:
+        ex = JobExecutor(**kwargs)
+        executors.append(ex)
+        return ex
+    yield make
+    for ex in executors:
+        ex.stop()
+
+
+@pytest.fixture(autouse=True)
+def devices(monkeypatch):
+    # Destinations named after the device they are on.
+    monkeypatch.setattr(app.scheduler, "_device", lambda path: int(path.split(":")[0]))
+
+
+def _wait(predicate, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class _Gate:
+    """A run that stays running until opened."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self._open = threading.Event()
+
+    def __call__(self) -> None:
+        self.started.set()
+        assert self._open.wait(5)
+
+    def open(self) -> None:
+        self._open.set()
+
+
+def test_earliest_deadline_starts_first(executor):
+    ex = executor(max_concurrent=1)
+    order = []
+    for job, deadline in (("late", 30.0), ("none", None), ("soon", 10.0), ("middle", 20.0)):
+        ex.submit(job, lambda job=job: order.append(job), "1:", deadline=deadline)
+    assert ex.pending() == ["soon", "middle", "late", "none"]
+    ex.start()
+    assert _wait(lambda: len(order) == 4)
+    assert order == ["soon", "middle", "late", "none"]
+
+
+def test_longest_run_first_among_equal_deadlines(executor):
+    ex = executor(max_concurrent=1)
+    ex.start()
+    ex.submit("quick", lambda: None, "1:")
+    assert _wait(lambda: not ex.running() and not ex.pending())
+    ex.stop()
+    # Runs never seen before count as the longest.
+    ex.submit("quick", lambda: None, "1:", deadline=5.0)
+    ex.submit("unknown", lambda: None, "2:", deadline=5.0)
+    assert ex.pending() == ["unknown", "quick"]
+
+
+def test_one_run_per_device(executor):
+    ex = executor(max_concurrent=4, per_device=1)
+    ex.start()
+    first, second, other = _Gate(), _Gate(), _Gate()
+    ex.submit("first", first, "1:/a")
+    assert first.started.wait(5)
+    ex.submit("second", second, "1:/b")
+    ex.submit("other", other, "2:/c")
+    # The run for another device does not wait behind the one for the busy device.
+    assert other.started.wait(5)
+    assert not second.started.wait(0.2) and ex.pending() == ["second"]
+    first.open()
+    assert second.started.wait(5)
+    second.open()
+    other.open()
+
+
+def test_a_run_fanning_out_holds_every_device(executor):
+    ex = executor(max_concurrent=4, per_device=1)
+    ex.start()
+    both, single = _Gate(), _Gate()
+    ex.submit("both", both, ["1:/a", "2:/b"])
+    assert both.started.wait(5)
+    ex.submit("single", single, "2:/c")
+    assert not single.started.wait(0.2)
+    both.open()
+    assert single.started.wait(5)
+    single.open()
+
+
+def test_memory_budget(executor):
+    ex = executor(max_concurrent=4, memory_budget=100)
+    ex.start()
+    first, second, big = _Gate(), _Gate(), _Gate()
+    ex.submit("first", first, "1:", memory=60)
+    assert first.started.wait(5)
+    ex.submit("second", second, "2:", memory=60)
+    assert not second.started.wait(0.2)
+    first.open()
+    assert second.started.wait(5)
+    second.open()
+    assert _wait(lambda: not ex.running())
+    # More than the whole budget still runs, on its own.
+    ex.submit("big", big, "3:", memory=500)
+    assert big.started.wait(5)
+    big.open()
+
+
+def test_a_job_is_queued_once(executor):
+    ex = executor()
+    assert ex.submit("job", lambda: None, "1:")
+    assert not ex.submit("job", lambda: None, "1:")
+    assert ex.pending() == ["job"]
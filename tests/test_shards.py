@@ -0,0 +1,53 @@
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+from app.backup import run_backup
+from app.restore import run_restore, verify_archive
+from app.shards import shard_paths
+from conftest import PASSWORD
+
+
+def _tree(root: Path, count: int = 30) -> dict:
+    files = {}
+    for i in range(count):
+        path = root / f"d{i % 3}" / f"f{i:02d}.bin"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(20 * 1024 + i))
+        files[path.relative_to(root)] = path.read_bytes()
+    return files
+
+
+def _backup(tmp_path: Path, folder: str) -> Path:
+    _tree(tmp_path / folder / "src")
+    return run_backup([str(tmp_path / folder / "src")], str(tmp_path / folder / "out"), PASSWORD, "s.sbk", shards=3)
+
+
+def test_sharded_round_trip(tmp_path):
+    files = _tree(tmp_path / "src")
+    path = run_backup([str(tmp_path / "src")], str(tmp_path / "out"), PASSWORD, "s.sbk", shards=3)
+    assert len(shard_paths(path)) == 4
+    run_restore(str(path), str(tmp_path / "restored"), PASSWORD)
+    assert {p.relative_to(tmp_path / "restored" / "src"): p.read_bytes()
+            for p in (tmp_path / "restored" / "src").rglob("*") if p.is_file()} == files
+
+
+def test_shard_from_another_backup_is_refused(tmp_path):
+    ours, theirs = _backup(tmp_path, "a"), _backup(tmp_path, "b")
+    shutil.copyfile(shard_paths(theirs)[1], shard_paths(ours)[1])
+    with pytest.raises(ValueError, match="does not belong"):
+        run_restore(str(ours), str(tmp_path / "restored"), PASSWORD)
+    with pytest.raises(ValueError, match="does not belong"):
+        verify_archive(str(ours), PASSWORD)
+
+
+def test_swapped_shards_are_refused(tmp_path):
+    path = _backup(tmp_path, "a")
+    first, second = shard_paths(path)[1:3]
+    first.rename(tmp_path / "tmp")
+    second.rename(first)
+    (tmp_path / "tmp").rename(second)
+    with pytest.raises(ValueError, match="does not belong"):
+        run_restore(str(path), str(tmp_path / "restored"), PASSWORD)
@@ -0,0 +1,56 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from app.crypto import _pool
+from app.throttle import BACKGROUND_NICE, Throttle, TokenBucket
+
+
+def _nice() -> int:
+    return os.getpriority(os.PRIO_PROCESS, threading.get_native_id())
+
+
+def test_token_bucket_holds_the_rate():
+    bucket = TokenBucket(1000)
+    start = time.monotonic()
+    for _ in range(4):
+        bucket.take(500)
+    # A second's burst goes through at once; the other 1000 units take about a second.
+    assert 0.8 <= time.monotonic() - start < 2.0
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="background priority is Linux only")
+def test_background_runs_do_not_share_pool_threads():
+    normal = _nice()
+    background = Throttle(background=True)
+    assert _pool().submit(_nice).result() == normal
+    # Pool work of a background run runs at its priority, even though the normal pool exists...
+    assert background.call(lambda: _pool().submit(_nice).result()) == max(normal, BACKGROUND_NICE)
+    # ...and the normal pool is not lowered by it.
+    assert _pool().submit(_nice).result() == normal
+    assert _nice() == normal
+
+
+def test_waits_from_every_thread_add_up():
+    throttle = Throttle(read_bps=1, write_bps=1)
+
+    class Fixed:
+        def take(self, n: int) -> float:
+            return 0.25
+
+    throttle._read = throttle._write = Fixed()
+
+    def run() -> None:
+        for _ in range(20000):
+            throttle.read(1)
+            throttle.wrote(1)
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert throttle.waited == 8 * 20000 * 2 * 0.25
@@ -0,0 +1,72 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from app.backup import run_backup
+from app.restore import run_restore, verify_archive
+from app.volumes import volume_paths
+from conftest import PASSWORD
+
+MiB = 1024 * 1024
+
+
+def _tree(root: Path, count: int = 160, size: int = 128 * 1024) -> dict:
+    files = {}
+    for i in range(count):
+        path = root / f"d{i % 8}" / f"f{i:03d}.bin"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(size))
+        files[path.relative_to(root)] = path.read_bytes()
+    return files
+
+
+def _flip(path: Path) -> None:
+    data = bytearray(path.read_bytes())
+    data[len(data) // 2] ^= 0x01
+    path.write_bytes(bytes(data))
+
+
+def _restored(root: Path) -> dict:
+    return {p.relative_to(root): p.read_bytes() for p in root.rglob("*") if p.is_file()}
+
+
+def test_split_backup_round_trip(tmp_path):
+    files = _tree(tmp_path / "src", count=40)
+    path = run_backup([str(tmp_path / "src")], str(tmp_path / "out"), PASSWORD, "v.sbk", volume_size=2 * MiB)
+    assert len(volume_paths(path)) > 1
+    assert verify_archive(str(path), PASSWORD)["entries"] == len(files) + 9  # the folders too
+    run_restore(str(path), str(tmp_path / "restored"), PASSWORD)
+    assert _restored(tmp_path / "restored" / "src") == files
+
+
+@pytest.mark.parametrize("chain", [True, False])
+def test_damaged_volumes_lose_only_their_entries(tmp_path, chain):
+    files = _tree(tmp_path / "src")
+    path = run_backup([str(tmp_path / "src")], str(tmp_path / "out"), PASSWORD, "v.sbk", volume_size=2 * MiB)
+    volumes = volume_paths(path)
+    assert len(volumes) >= 8
+    # The first volume holds the archive's header and chain metadata; a middle one only file data.
+    _flip(volumes[0])
+    _flip(volumes[len(volumes) // 2])
+
+    with pytest.raises(ValueError, match="damaged volumes"):
+        run_restore(str(path), str(tmp_path / "restored"), PASSWORD, chain=chain)
+    restored = _restored(tmp_path / "restored" / "src")
+    # Each damaged segment takes out the compression block around it, and no more.
+    assert len(files) // 2 <= len(restored) < len(files)
+    assert all(files[name] == data for name, data in restored.items())
+
+    with pytest.raises(ValueError, match="problems found"):
+        verify_archive(str(path), PASSWORD, chain=chain)
+
+
+def test_index_survives_a_damaged_last_volume(tmp_path):
+    files = _tree(tmp_path / "src", count=80)
+    path = run_backup([str(tmp_path / "src")], str(tmp_path / "out"), PASSWORD, "v.sbk", volume_size=2 * MiB)
+    _flip(volume_paths(path)[-1])
+    with pytest.raises(ValueError, match="damaged volumes"):
+        run_restore(str(path), str(tmp_path / "restored"), PASSWORD)
+    restored = _restored(tmp_path / "restored" / "src")
+    assert len(files) // 2 <= len(restored) < len(files)
+    assert all(files[name] == data for name, data in restored.items())
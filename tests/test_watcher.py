@@ -0,0 +1,166 @@
+import os
+import shutil
+import time
+from pathlib import Path
+
+import pytest
+
+from app.backup import run_backup
+from app.restore import list_archive, run_restore
+from app.watcher import _EVENT, _IN_Q_OVERFLOW, Watcher, supported
+from conftest import PASSWORD
+
+pytestmark = pytest.mark.skipif(not supported(), reason="needs Linux inotify")
+
+
+def _files(root: Path) -> dict:
+    return {p.relative_to(root).as_posix(): p.read_bytes() for p in root.rglob("*") if p.is_file()}
+
+
+def _source(tmp_path: Path) -> Path:
+    src = tmp_path / "src"
+    for name in ("a.txt", "b.txt", "c.txt", "sub/d.txt", "sub/deeper/e.txt", "gone/f.txt"):
+        (src / name).parent.mkdir(parents=True, exist_ok=True)
+        (src / name).write_bytes(os.urandom(100) + name.encode())
+    return src
+
+
+def _job(tmp_path: Path, name: str) -> dict:
+    return {"name": name, "sources": [str(tmp_path / "src")], "password": PASSWORD}
+
+
+def _settle(watcher: Watcher, quiet: float = 0.3) -> None:
+    """Waits until no event has come in for quiet seconds, so a file's last events are not left for later."""
+    seq, since = watcher.take()[0], time.monotonic()
+    while time.monotonic() - since < quiet:
+        time.sleep(0.05)
+        if watcher.take()[0] != seq:
+            seq, since = watcher.take()[0], time.monotonic()
+
+
+def _backup(tmp_path: Path, job: dict, name: str, watcher=None) -> Path:
+    if watcher is not None:
+        _settle(watcher)
+    seq, changes = watcher.take() if watcher is not None else (0, None)
+    path = run_backup(job["sources"], str(tmp_path / "out"), PASSWORD, name, job_name=job["name"],
+                      incremental=True, changes=changes)
+    if watcher is not None:
+        watcher.done(seq)
+    return path
+
+
+def _wait_for(watcher: Watcher, expected: set) -> set:
+    """Everything take() reports once it includes expected (or the deadline passes)."""
+    deadline = time.monotonic() + 10
+    while True:
+        _, changes = watcher.take()
+        seen = changes.paths | changes.trees if changes is not None else set()
+        if expected <= seen or time.monotonic() > deadline:
+            return seen
+        time.sleep(0.05)
+
+
+def _watching(watcher: Watcher) -> None:
+    """Waits until the watcher has set up its watches."""
+    deadline = time.monotonic() + 10
+    while watcher.take()[1] is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def watcher_factory():
+    watchers = []
+
+    def start(job: dict) -> Watcher:
+        watcher = Watcher(job, delay=0)
+        watcher.start()
+        watchers.append(watcher)
+        _watching(watcher)
+        return watcher
+    yield start
+    for watcher in watchers:
+        watcher.stop()
+
+
+def test_watched_changes_reach_the_next_run(tmp_path, watcher_factory):
+    src = _source(tmp_path)
+    job = _job(tmp_path, "watched")
+    _backup(tmp_path, job, "w_1.sbk")
+    watcher = watcher_factory(job)
+    assert watcher.take()[1] == (set(), set())
+
+    (src / "new.txt").write_bytes(b"created")
+    (src / "a.txt").write_bytes(b"modified")
+    (src / "b.txt").rename(src / "b2.txt")
+    (src / "c.txt").unlink()
+    (src / "made" / "inner").mkdir(parents=True)
+    (src / "made" / "inner" / "g.txt").write_bytes(b"in a new folder")
+    (src / "sub").rename(src / "moved")
+    shutil.rmtree(src / "gone")
+    expected = {"src/new.txt", "src/a.txt", "src/b.txt", "src/b2.txt", "src/c.txt", "src/made",
+                "src/sub", "src/moved", "src/gone"}
+    seen = _wait_for(watcher, expected)
+    assert expected <= seen
+    # A folder renamed inside the sources is watched under its new name only.
+    watched = {arc for _, arc in watcher._wds.values()}
+    assert {"src/moved", "src/moved/deeper"} <= watched and not any(a.startswith("src/sub") for a in watched)
+    (src / "moved" / "deeper" / "h.txt").write_bytes(b"in a moved folder")
+    assert "src/moved/deeper/h.txt" in _wait_for(watcher, {"src/moved/deeper/h.txt"})
+    # One moved out of the sources is no longer watched at all.
+    (src / "made").rename(tmp_path / "outside")
+    (tmp_path / "outside" / "inner" / "x.txt").write_bytes(b"not ours any more")
+    (src / "last.txt").write_bytes(b"after the move")
+    seen = _wait_for(watcher, {"src/last.txt"})
+    assert "src/last.txt" in seen and "src/made/inner/x.txt" not in seen
+    assert not any(arc.startswith("src/made") for _, arc in watcher._wds.values())
+
+    path = _backup(tmp_path, job, "w_2.sbk", watcher)
+    archived = {r["name"] for r in list_archive(str(path), PASSWORD)}
+    assert {"src/new.txt", "src/a.txt", "src/b2.txt", "src/last.txt", "src/moved/d.txt",
+            "src/moved/deeper/e.txt", "src/moved/deeper/h.txt"} <= archived
+    assert watcher.take()[1] == (set(), set())
+    run_restore(str(path), str(tmp_path / "restored"), PASSWORD)
+    assert _files(tmp_path / "restored" / "src") == _files(src)
+
+
+def test_setup_catches_what_changed_unwatched(tmp_path, watcher_factory):
+    src = _source(tmp_path)
+    job = _job(tmp_path, "unwatched")
+    _backup(tmp_path, job, "u_1.sbk")
+    (src / "a.txt").write_bytes(b"changed while nothing was watching")
+    (src / "c.txt").unlink()
+    (src / "sub" / "new.txt").write_bytes(b"added")
+
+    watcher = watcher_factory(job)
+    _, changes = watcher.take()
+    assert {"src/a.txt", "src/c.txt", "src/sub/new.txt"} <= changes.paths
+    path = _backup(tmp_path, job, "u_2.sbk", watcher)
+    run_restore(str(path), str(tmp_path / "restored"), PASSWORD)
+    assert _files(tmp_path / "restored" / "src") == _files(src)
+
+
+def test_done_keeps_what_changed_during_the_run(tmp_path, watcher_factory):
+    src = _source(tmp_path)
+    job = _job(tmp_path, "during")
+    _backup(tmp_path, job, "d_1.sbk")
+    watcher = watcher_factory(job)
+    (src / "a.txt").write_bytes(b"before the run")
+    _wait_for(watcher, {"src/a.txt"})
+    _settle(watcher)
+    seq, _ = watcher.take()
+    (src / "b.txt").write_bytes(b"during the run")
+    _wait_for(watcher, {"src/b.txt"})
+    watcher.done(seq)
+    assert "src/a.txt" not in watcher.take()[1].paths
+    assert "src/b.txt" in watcher.take()[1].paths
+
+
+def test_overflow_makes_the_next_run_scan_everything(tmp_path, watcher_factory):
+    _source(tmp_path)
+    job = _job(tmp_path, "overflow")
+    watcher = watcher_factory(job)
+    watcher._handle(_EVENT.pack(-1, _IN_Q_OVERFLOW, 0, 0))
+    seq, changes = watcher.take()
+    assert changes is None
+    watcher.done(seq)
+    assert watcher.take()[1] is not None